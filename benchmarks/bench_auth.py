@@ -0,0 +1,198 @@
+'''
+Benchmark/check: per request auth overhead of the session modes that
+login_required can sit on:
+    - cookie: flask's signed cookie session (AUTH['mode'] = 'session')
+    - file:   a server-side session, 1 file read per request (what e.g.
+              Flask-Session's filesystem backend does), for reference
+    - token:  auth_token.py (AUTH['mode'] = 'token'), cookie & bearer header
+
+    python3 benchmarks/bench_auth.py -n 20000
+
+For each: open+save of the session alone, then a whole request to a
+login_required route thru the test client. Also checks that token mode
+turns away tampered, expired, rotated-out & revoked tokens (exits non-zero
+if not). No db needed, the revocation list is set in memory.
+'''
+import argparse
+import json
+import os
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from functools import wraps
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask, session
+from flask.sessions import SecureCookieSession, SessionInterface
+
+import auth_token
+
+
+PLAYER_ID = '424242424242424242'
+USERNAME = 'bench'
+
+
+# --------------------------- file sessions ---------------------------
+class FileSessionInterface(SessionInterface):
+    def __init__(self, path):
+        self.path = path
+
+    def open_session(self, app, request):
+        sid = request.cookies.get('sid')
+        s = SecureCookieSession()
+        if sid and sid.isalnum():
+            try:
+                with open(os.path.join(self.path, sid)) as f:
+                    s = SecureCookieSession(json.load(f))
+            except FileNotFoundError:
+                pass
+        s.sid = sid
+        return s
+
+    def save_session(self, app, session, response):
+        if not session.modified:
+            return
+        sid = session.sid or secrets.token_hex(16)
+        with open(os.path.join(self.path, sid), 'w') as f:
+            json.dump(dict(session), f)
+        response.set_cookie('sid', sid, httponly=True)
+
+
+# --------------------------- setup ---------------------------
+def make_app(mode, tmp):
+    app = Flask(__name__)
+    app.secret_key = 'bench-auth'
+    if mode == 'file':
+        app.session_interface = FileSessionInterface(tmp)
+    elif mode == 'token':
+        app.auth_tokens = auth_token.TokenSigner(auth_token.parse_keys('k1:bench-auth'))
+        app.session_interface = auth_token.TokenSessionInterface()
+
+    # same check as server.login_required
+    def login_required(f):
+        @wraps(f)
+        def check_login(*args, **kwargs):
+            if 'id' not in session:
+                return 'login', 302
+            return f(*args, **kwargs)
+        return check_login
+
+    @app.route('/login/<pid>')
+    def login(pid):
+        session['id'] = pid
+        session['username'] = USERNAME
+        return ''
+
+    @app.route('/me')
+    @login_required
+    def me():
+        return session['id']
+    return app
+
+
+# logged in client, w/ whatever the mode's cookie is
+def logged_in(app):
+    client = app.test_client()
+    client.get(f'/login/{PLAYER_ID}')
+    return client
+
+
+def latency(fn, n):
+    lat = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        lat.append((time.perf_counter() - start) * 1e6)
+    q = statistics.quantiles(lat, n=100)
+    return f'mean {statistics.mean(lat):7.1f}us  p50 {q[49]:7.1f}us  p99 {q[98]:7.1f}us'
+
+
+# open+save of the session of a request w/ the given headers
+def session_only(app, headers):
+    iface = app.session_interface
+    ctx = app.test_request_context('/me', headers=headers)
+    resp = app.response_class()
+
+    def run():
+        s = iface.open_session(app, ctx.request)
+        assert 'id' in s
+        iface.save_session(app, s, resp)
+    return run
+
+
+# --------------------------- checks ---------------------------
+def check_tokens():
+    app = make_app('token', None)
+    signer = app.auth_tokens
+    client = app.test_client()
+
+    def status(token):
+        return client.get('/me', headers={'Authorization': f'Bearer {token}'}).status_code
+
+    ok = {}
+    token, claims = signer.issue(PLAYER_ID, USERNAME)
+    ok['valid token accepted'] = status(token) == 200
+    kid, payload, sig = token.split('.')
+    forged = auth_token.b64encode(json.dumps(['1', 'x', claims['exp'], claims['jti']]).encode())
+    ok['tampered payload rejected'] = status(f'{kid}.{forged}.{sig}') == 302
+    ok['tampered sig rejected'] = status(f'{kid}.{payload}.{sig[:-2]}AA') == 302
+    ok['unknown kid rejected'] = status(f'k9.{payload}.{sig}') == 302
+    ok['garbage rejected'] = status('not-a-token') == 302
+    ok['non-ascii sig rejected'] = status(f'{kid}.{payload}.é') == 302
+
+    signer.ttl = -1
+    expired, _ = signer.issue(PLAYER_ID, USERNAME)
+    signer.ttl = 3600
+    ok['expired rejected'] = status(expired) == 302
+
+    # rotation: k2 signs now, k1 still verifies until it's dropped
+    signer.keys = auth_token.parse_keys('k2:new-secret,k1:bench-auth')
+    signer.kid = 'k2'
+    new, _ = signer.issue(PLAYER_ID, USERNAME)
+    ok['old key still verifies after rotation'] = status(token) == 200
+    ok['new key verifies'] = status(new) == 200 and new.startswith('k2.')
+    signer.keys = auth_token.parse_keys('k2:new-secret')
+    ok['rotated out key rejected'] = status(token) == 302
+
+    signer.revoked = frozenset({signer.verify(new)['jti']})
+    ok['revoked rejected'] = status(new) == 302
+
+    # renewed once past half its ttl
+    signer.ttl = 7200
+    old, _ = signer.issue(PLAYER_ID, USERNAME)
+    signer.ttl = 3600 * 6
+    r = client.get('/me', headers={'Authorization': f'Bearer {old}'})
+    ok['renewed past half its ttl'] = 'auth=' in r.headers.get('Set-Cookie', '')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='requests per mode')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('cookie', 'file', 'token'):
+            app = make_app(mode, tmp)
+            client = logged_in(app)
+            cookie = '; '.join(f'{c.key}={c.value}' for c in client._cookies.values())
+            print(f'{mode:>6}  session:  {latency(session_only(app, {"Cookie": cookie}), args.n)}')
+            print(f'{mode:>6}  request:  {latency(lambda: client.get("/me"), args.n)}')
+            if mode == 'token':
+                token = app.auth_tokens.issue(PLAYER_ID, USERNAME)[0]
+                bearer = {'Authorization': f'Bearer {token}'}
+                print(f'{"bearer":>6}  request:  '
+                      f'{latency(lambda: app.test_client().get("/me", headers=bearer), args.n)}')
+
+    ok = check_tokens()
+    for name, passed in ok.items():
+        print(f'{"ok  " if passed else "FAIL"} {name}')
+    if not all(ok.values()):
+        sys.exit('token checks failed')
+
+
+if __name__ == '__main__':
+    main()
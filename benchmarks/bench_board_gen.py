@@ -0,0 +1,70 @@
+'''
+Microbenchmark: minesweeper board gen, the pure python path (gen_mines +
+init_board) vs the numpy one (board.random_board), for growing ndim at a
+fixed mine density. Also times the 1st click's flood reveal and the
+to_bytes() the game state stores, since that's the rest of /verify.
+
+    python3 benchmarks/bench_board_gen.py --sizes 8 100 300 1000
+
+Needs numpy (pip install .[big_board]).
+'''
+import argparse
+import os
+import sys
+import time
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from games.board import Board, random_board, np
+from games.minesweeper import gen_mines, init_board
+
+
+def python_board(ndim, nmines):
+    board = Board(ndim)
+    init_board(gen_mines(nmines, ndim, Random()), board)
+    return board
+
+
+def numpy_board(ndim, nmines):
+    return random_board(ndim, nmines)
+
+
+# return: best of `repeat` [s]
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 100, 300, 1000])
+    parser.add_argument('--density', type=float, default=10/64, help='mines per tile')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if np is None:
+        sys.exit('numpy not installed')
+
+    print(f'{"ndim":>6} {"nmines":>8} {"python":>10} {"numpy":>10} {"speedup":>8} '
+          f'{"flood":>10} {"bytes":>9}')
+    for ndim in args.sizes:
+        nmines = max(1, int(ndim*ndim*args.density))
+        safe = (ndim//2, ndim//2)
+        t_py = best(lambda: python_board(ndim, nmines), args.repeat)
+        t_np = best(lambda: numpy_board(ndim, nmines), args.repeat)
+
+        board = numpy_board(ndim, nmines)
+        start = time.perf_counter()
+        board.flood_reveal(*safe)
+        t_flood = time.perf_counter() - start
+        nbytes = len(board.to_bytes())
+        print(f'{ndim:>6} {nmines:>8} {t_py*1000:>8.1f}ms {t_np*1000:>8.1f}ms '
+              f'{t_py/t_np:>7.1f}x {t_flood*1000:>8.1f}ms {nbytes:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Benchmark: the per player history/streak queries & per game averages over
+a score_history w/ millions of rows (default 5000 players x 3 games x 365
+days, ~70% of days played, so ~3.8M rows across 13 monthly partitions).
+
+    DB_URL=postgresql://... python3 benchmarks/bench_history.py -p 5000 -d 365
+
+Needs the schema in DB_URL (python3 discord_games/migrate.py).
+Writes throwaway players (negative ids) & games ('bench_*'), deleted after.
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask
+
+import config
+import db
+import db_utils
+import reset_job
+
+
+GAMES = ['bench_a', 'bench_b', 'bench_c']
+# periods way past any real ones
+PERIOD_OFFSET = 10**6
+
+
+def populate(app, nplayers, ndays, played):
+    today = date.today()
+    start = today - timedelta(days=ndays)
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("set local statement_timeout = 0;")
+            day = start.replace(day=1)
+            while day <= today:
+                reset_job.ensure_partition(cur, day)
+                day = (day + timedelta(days=32)).replace(day=1)
+            cur.execute("""
+                insert into score_history (day, period, player_id, game_id, score, rank)
+                select
+                    %(start)s::date + d,
+                    %(offset)s + d,
+                    -p,
+                    g,
+                    (random()*10)::int,
+                    1 + (random()*10)::int
+                from generate_series(1, %(nplayers)s) p,
+                     generate_series(0, %(ndays)s - 1) d,
+                     unnest(%(games)s::text[]) g
+                where random() < %(played)s
+                on conflict do nothing;
+            """, {'start': start, 'offset': PERIOD_OFFSET, 'nplayers': nplayers,
+                  'ndays': ndays, 'games': GAMES, 'played': played})
+            nrows = cur.rowcount
+            cur.execute("""
+                insert into daily_stats (game_id, day, period, nplayers, average)
+                select game_id, day, min(period), count(*), avg(score)
+                from score_history
+                where game_id = any(%s)
+                group by game_id, day
+                on conflict do nothing;
+            """, (GAMES,))
+            cur.execute("analyze score_history;")
+    return nrows
+
+
+def cleanup(app):
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("set local statement_timeout = 0;")
+            cur.execute("delete from score_history where game_id = any(%s);", (GAMES,))
+            cur.execute("delete from daily_stats where game_id = any(%s);", (GAMES,))
+
+
+# return: latencies [ms]
+def run(app, fn, n):
+    lat = []
+    for _ in range(n):
+        with app.app_context():
+            start = time.perf_counter()
+            fn()
+            lat.append((time.perf_counter() - start) * 1000)
+            db.close_conn()
+    return lat
+
+
+def report(label, lat):
+    q = statistics.quantiles(lat, n=100)
+    print(f'{label:>14}: mean {statistics.mean(lat):6.3f}ms  p50 {q[49]:6.3f}ms  '
+          f'p99 {q[98]:6.3f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', type=int, default=5000, help='players')
+    parser.add_argument('-d', type=int, default=365, help='days')
+    parser.add_argument('--played', type=float, default=0.7, help='chance a day is played')
+    parser.add_argument('-n', type=int, default=2000, help='queries per kind')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if not app.config['DB_URL']:
+        sys.exit('DB_URL not set')
+    db.init_app(app)
+
+    start = time.perf_counter()
+    nrows = populate(app, args.p, args.d, args.played)
+    print(f'{nrows} rows in {time.perf_counter() - start:.1f}s')
+    try:
+        def player():
+            return -random.randint(1, args.p), random.choice(GAMES)
+        report('history 30d', run(app, lambda: db_utils.get_history(*player(), 30), args.n))
+        report('history 365d', run(app, lambda: db_utils.get_history(*player(), 365), args.n))
+        report('streaks/avg', run(app, lambda: db_utils.get_player_stats(*player()), args.n))
+        report('game averages', run(app, lambda: db_utils.get_daily_averages(random.choice(GAMES), 30), args.n))
+    finally:
+        cleanup(app)
+        with app.app_context():
+            db.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Benchmark: per request overhead of the /metrics instrumentation
+(metrics.py), on a route shaped like the game routes: login check, 1 game
+state load/save & a couple of queries.
+
+    DB_URL=postgresql://... python3 benchmarks/bench_metrics.py -n 5000
+
+Runs the same requests w/ METRICS off, then on w/ sample_rate 0 (route
+latency & pool wait only), 0.1 (the default) & 1 (every request timed
+down to the query). No tables needed, the queries are selects of consts.
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask, session
+
+import config
+import db
+import game_state
+import metrics
+
+
+def make_app(enabled, sample_rate):
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config['METRICS'] = {'enabled': enabled, 'sample_rate': sample_rate}
+    app.secret_key = 'bench-metrics'
+    game_state.init_app(app)
+    db.init_app(app)
+    metrics.init_app(app)
+
+    @app.route('/login')
+    def login():
+        session['id'] = 1
+        session['username'] = 'bench'
+        return ''
+
+    @app.route('/move/<game_id>')
+    def move(game_id):
+        if 'id' not in session:
+            return 'login', 302
+        st = game_state.get(game_id)
+        st['moves'] = st.get('moves', 0) + 1
+        with db.cursor() as cur:
+            cur.execute('select %s;', (st['moves'],))
+            cur.fetchone()
+            cur.execute('select 1;')
+            cur.fetchone()
+        return str(st['moves'])
+    return app
+
+
+def run(app, n):
+    client = app.test_client()
+    client.get('/login')
+    # warm up: pool conn, state entry
+    for _ in range(200):
+        client.get('/move/simon')
+    lat = []
+    for _ in range(n):
+        start = time.perf_counter()
+        client.get('/move/simon')
+        lat.append((time.perf_counter() - start) * 1e6)
+    q = statistics.quantiles(lat, n=100)
+    return statistics.mean(lat), q[49], q[98]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5000, help='requests per mode')
+    args = parser.parse_args()
+    if not config.DB_URL:
+        sys.exit('DB_URL not set')
+
+    base = None
+    for name, enabled, rate in (('off', False, 0), ('on, sample 0', True, 0),
+                                ('on, sample 0.1', True, 0.1), ('on, sample 1', True, 1)):
+        app = make_app(enabled, rate)
+        try:
+            mean, p50, p99 = run(app, args.n)
+        finally:
+            with app.app_context():
+                db.close_all()
+        base = base or mean
+        print(f'{name:>15}: mean {mean:7.1f}us ({mean - base:+6.1f}us)  '
+              f'p50 {p50:7.1f}us  p99 {p99:7.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+'''
+Throughput benchmark: the prefork deployment (gunicorn.conf.py) w/ 1..N
+worker procs, driven by logged in players hitting /play/<game> (db upsert,
+game state, template) and the live leaderboard api.
+
+    DB_URL=postgresql://... python3 benchmarks/bench_prefork.py -w 1 2 4 -c 64 -d 10
+
+Needs the 'prefork' extras (pip install .[prefork]). The load comes from
+several client procs w/ keep-alive conns, so it's best run on a different
+box/cores than the server for numbers that mean anything. W/ >1 worker
+the game state is on the shared sqlite backend (see gunicorn.conf.py),
+so 1 vs 2 workers also compares the 2 backends.
+Writes throwaway players (negative ids), deleted after.
+'''
+import argparse
+import http.client
+import multiprocessing
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'discord_games')
+sys.path.insert(0, APP_DIR)
+
+import psycopg2
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+
+SECRET_KEY = 'bench-prefork'
+GAME_ID = 'simon'
+PATHS = [f'/play/{GAME_ID}', f'/api/leaderboard/{GAME_ID}']
+
+
+# signed session cookie of player_id, like after /auth
+def session_cookie(player_id):
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    s = SecureCookieSessionInterface().get_signing_serializer(app)
+    return s.dumps({'id': player_id, 'username': 'bench'})
+
+
+def start_server(port, workers):
+    env = dict(os.environ, SECRET_KEY=SECRET_KEY, PUZZLE_SECRET='bench',
+               WORKERS=str(workers), BIND=f'127.0.0.1:{port}')
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'server:app'],
+                            cwd=APP_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit('gunicorn did not come up')
+
+
+# 1 client proc: nthreads keep-alive conns, each a different player
+# return: (nr of requests, latencies [ms], nr of errors) via q
+def client(port, pids, duration, q):
+    lat, errors = [], []
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def run(pid):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        headers = {'Cookie': f'session={session_cookie(pid)}'}
+        mine, i, failed = [], 0, 0
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', PATHS[i % len(PATHS)], headers=headers)
+                r = conn.getresponse()
+                r.read()
+                if r.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            mine.append((time.perf_counter() - start) * 1000)
+            i += 1
+        with lock:
+            lat.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=run, args=(pid,)) for pid in pids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    q.put((len(lat), lat, sum(errors)))
+
+
+def run(port, workers, pids, nprocs, duration):
+    proc = start_server(port, workers)
+    try:
+        # warm up: every worker booted & every player's rows exist
+        time.sleep(1)
+        q = multiprocessing.Queue()
+        chunks = [pids[i::nprocs] for i in range(nprocs)]
+        clients = [multiprocessing.Process(target=client, args=(port, c, duration, q))
+                   for c in chunks if c]
+        for c in clients:
+            c.start()
+        results = [q.get() for _ in clients]
+        for c in clients:
+            c.join()
+    finally:
+        # graceful shutdown, like a deploy would
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=60)
+    n = sum(r[0] for r in results)
+    lat = [v for r in results for v in r[1]]
+    errors = sum(r[2] for r in results)
+    q = statistics.quantiles(lat, n=100)
+    return n / duration, q[49], q[98], errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', type=int, nargs='+', default=[1, 2, 4], help='worker counts')
+    parser.add_argument('-c', type=int, default=64, help='concurrent players')
+    parser.add_argument('-p', type=int, default=4, help='client procs')
+    parser.add_argument('-d', type=float, default=10, help='secs per run')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    if not os.environ.get('DB_URL'):
+        sys.exit('DB_URL not set')
+    pids = [-i for i in range(1, args.c + 1)]
+    conn = psycopg2.connect(os.environ['DB_URL'])
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into players select unnest(%s::bigint[]), 'bench'
+            on conflict (id) do nothing;
+        """, (pids,))
+    try:
+        base = None
+        for workers in args.w:
+            rps, p50, p99, errors = run(args.port, workers, pids, args.p, args.d)
+            base = base or rps
+            print(f'{workers:>2} workers: {rps:8.1f} req/s  ({rps / base:4.2f}x)  '
+                  f'p50 {p50:6.1f}ms  p99 {p99:6.1f}ms  errors {errors}')
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("delete from players where id = any(%s);", (pids,))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
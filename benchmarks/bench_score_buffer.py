@@ -0,0 +1,98 @@
+'''
+Microbenchmark: end of game score writes (record_game + commit, like a
+game's last /verify) done synchronously vs accepted into
+the write-behind score buffer (score_buffer.py), plus how long the
+buffer's batched flush takes for all of them.
+
+    DB_URL=postgresql://... python3 benchmarks/bench_score_buffer.py -n 2000
+
+Needs the schema in DB_URL (python3 discord_games/migrate.py).
+Writes throwaway players (negative ids) and their rows.
+'''
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask
+
+import config
+import db
+import db_utils
+import game_registry
+import leaderboard
+import score_buffer
+
+
+GAME_ID = 'minesweeper'
+
+
+def end_of_game(app, pid, score):
+    with app.app_context():
+        db_utils.record_game(score, pid, GAME_ID)
+    # committed here
+
+
+def run(label, app, n):
+    lat = []
+    for i in range(n):
+        start = time.perf_counter()
+        end_of_game(app, -(i % 1000) - 1, i % 10)
+        lat.append((time.perf_counter() - start) * 1000)
+    q = statistics.quantiles(lat, n=100)
+    print(f'{label:>9}: mean {statistics.mean(lat):6.3f}ms  p50 {q[49]:6.3f}ms  '
+          f'p99 {q[98]:6.3f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000, help='games ended per mode')
+    parser.add_argument('--fsync', action='store_true', help='fsync the journal')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if not app.config['DB_URL']:
+        sys.exit('DB_URL not set')
+    db.init_app(app)
+    game_registry.init_app(app)
+    leaderboard.init_app(app)
+
+    pids = [-i for i in range(1, 1001)]
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("""
+                insert into players select unnest(%s::bigint[]), 'bench'
+                on conflict (id) do nothing;
+            """, (pids,))
+        for pid in pids:
+            db_utils.init_highscores_db(pid, GAME_ID)
+            db_utils.init_scores_db(pid, GAME_ID)
+
+    journal = os.path.join(tempfile.mkdtemp(), 'score_journal.log')
+    try:
+        run('sync', app, args.n)
+
+        # big max_pending & no flush thread, so only the flush below writes
+        app.score_buffer = score_buffer.ScoreBuffer(app, app.games.rank_orders(), args.n + 1,
+                                                    journal, args.fsync)
+        run('buffered', app, args.n)
+        npending = len(app.score_buffer.scores)
+        start = time.perf_counter()
+        app.score_buffer.flush()
+        print(f'    flush: {npending} players in {(time.perf_counter() - start)*1000:.1f}ms')
+        app.score_buffer.close()
+    finally:
+        with app.app_context():
+            with db.cursor() as cur:
+                cur.execute("delete from players where id = any(%s);", (pids,))
+            db.close_conn()
+            db.close_all()
+
+
+if __name__ == '__main__':
+    main()
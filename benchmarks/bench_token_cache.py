@@ -0,0 +1,237 @@
+'''
+Benchmark/check: discord access token cache (token_cache.py) vs the old
+uncached get_access_token, against a local stub of discord's token
+endpoint that rotates refresh tokens like the real one (a used refresh
+token gets a 400 invalid_grant).
+
+    DB_URL=postgresql://... python3 benchmarks/bench_token_cache.py -n 32
+
+For 1 player whose token is about to expire, n threads ask for it at once:
+    - old: every caller refreshes, all but 1 fail on the rotated token
+    - cache: exactly 1 refresh (exits non-zero if not), all get its token
+    - 2 caches (like 2 worker procs) sharing the db: still exactly 1
+Then the per call latency of a cache hit vs the old db read, and the
+background refresh renewing a token before anyone asks for it.
+
+Needs the schema in DB_URL (python3 discord_games/migrate.py).
+Writes a throwaway player (negative id), deleted after.
+'''
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask
+from psycopg2.extras import RealDictCursor
+
+import config
+import db
+import discord_api
+import token_cache
+
+
+PLAYER_ID = -424242
+
+
+# --------------------------- stub discord ---------------------------
+class StubDiscord:
+    def __init__(self, delay):
+        self.delay = delay
+        self.valid = None
+        self.refreshes = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    # return: (status, body)
+    def token(self, form):
+        time.sleep(self.delay)
+        with self._lock:
+            if form.get('refresh_token') != self.valid:
+                self.rejected += 1
+                return 400, {'error': 'invalid_grant'}
+            self.valid = uuid.uuid4().hex
+            self.refreshes += 1
+            return 200, {'access_token': uuid.uuid4().hex,
+                         'refresh_token': self.valid,
+                         'expires_in': 604800,
+                         'token_type': 'Bearer',
+                         'scope': 'identify'}
+
+    def serve(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                status, data = stub.token(form)
+                out = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{srv.server_port}'
+
+
+# --------------------------- setup ---------------------------
+def make_app():
+    app = Flask(__name__)
+    app.config.from_object(config)
+    # no background thread unless asked for
+    app.config['TOKENS'] = dict(app.config['TOKENS'], check_every=0)
+    db.init_app(app)
+    token_cache.init_app(app)
+    return app
+
+
+# token row that's expires_in secs from expiring
+def reset_token(app, stub, expires_in):
+    stub.valid = uuid.uuid4().hex
+    stub.refreshes = stub.rejected = 0
+    with app.app_context():
+        with db.cursor() as cur:
+            token_cache.write(cur, PLAYER_ID, 'old-' + uuid.uuid4().hex, stub.valid,
+                              int(time.time()) + expires_in)
+
+
+# the old server.get_access_token, 1 db read per call, no single-flight
+def old_get_access_token(app, id):
+    with app.app_context():
+        with db.cursor(RealDictCursor) as cur:
+            cur.execute("""
+                select access_t, refresh_t, expires_at from tokens
+                where id = %s;
+            """, (id,))
+            row = cur.fetchone()
+        if row['expires_at'] - 60 <= int(time.time()):
+            r = discord_api.refresh_token(row['refresh_t'])
+            with db.cursor() as cur:
+                token_cache.write(cur, id, r['access_token'], r['refresh_token'],
+                                  r['expires_in'] + int(time.time()))
+            return r['access_token']
+        return row['access_t']
+
+
+# n threads call fn at once
+# return: (results, nr of exceptions)
+def burst(fn, n):
+    results, errors = [], []
+    start = threading.Barrier(n)
+
+    def run():
+        start.wait()
+        try:
+            results.append(fn())
+        except Exception:
+            errors.append(1)
+    threads = [threading.Thread(target=run) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, len(errors)
+
+
+def latency(fn, n):
+    lat = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        lat.append((time.perf_counter() - start) * 1000)
+    q = statistics.quantiles(lat, n=100)
+    return f'mean {statistics.mean(lat):7.4f}ms  p50 {q[49]:7.4f}ms  p99 {q[98]:7.4f}ms'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=32, help='concurrent callers')
+    parser.add_argument('--delay', type=float, default=0.1, help='stub discord latency [secs]')
+    parser.add_argument('--calls', type=int, default=5000, help='calls for the latency run')
+    args = parser.parse_args()
+
+    stub = StubDiscord(args.delay)
+    config.API_ENDPOINT = stub.serve()
+    # a rejected refresh is final, no point retrying it
+    config.DISCORD_HTTP['retries'] = 0
+    app = make_app()
+    if not app.config['DB_URL']:
+        sys.exit('DB_URL not set')
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("""
+                insert into players values (%s, 'bench')
+                on conflict (id) do nothing;
+            """, (PLAYER_ID,))
+
+    ok = True
+    apps = [app]
+    try:
+        reset_token(app, stub, 30)
+        _, errors = burst(lambda: old_get_access_token(app, PLAYER_ID), args.n)
+        print(f'old:     {stub.refreshes} refresh ok, {stub.rejected} rejected, {errors} callers failed')
+
+        reset_token(app, stub, 30)
+        results, errors = burst(lambda: app.tokens.get(PLAYER_ID), args.n)
+        same = len(set(results)) == 1
+        print(f'cache:   {stub.refreshes} refresh ok, {stub.rejected} rejected, {errors} callers failed, '
+              f'all got the same token: {same}')
+        ok &= stub.refreshes == 1 and not stub.rejected and not errors and same
+
+        # 2 procs' worth of fresh caches on the same db
+        reset_token(app, stub, 30)
+        procs = [make_app(), make_app()]
+        apps += procs
+        counter = iter(range(args.n * 2))
+        lock = threading.Lock()
+
+        def either():
+            with lock:
+                a = procs[next(counter) % 2]
+            return a.tokens.get(PLAYER_ID)
+        results, errors = burst(either, args.n * 2)
+        print(f'2 procs: {stub.refreshes} refresh ok, {stub.rejected} rejected, {errors} callers failed, '
+              f'all got the same token: {len(set(results)) == 1}')
+        ok &= stub.refreshes == 1 and not stub.rejected and not errors and len(set(results)) == 1
+
+        print(f'old get (db read): {latency(lambda: old_get_access_token(app, PLAYER_ID), args.calls)}')
+        print(f'cache hit:         {latency(lambda: app.tokens.get(PLAYER_ID), args.calls)}')
+
+        # expires in 5 min, refresh_ahead 10 min: renewed w/o a single get
+        reset_token(app, stub, 300)
+        app.tokens.put(PLAYER_ID, 'about-to-expire', int(time.time()) + 300)
+        app.tokens.start(0.2, app.config['TOKENS']['refresh_ahead'])
+        time.sleep(1 + args.delay)
+        renewed = app.tokens.get(PLAYER_ID) != 'about-to-expire'
+        print(f'background: {stub.refreshes} refresh, renewed before use: {renewed}')
+        ok &= renewed and stub.refreshes == 1
+        print('cache stats:', app.tokens.stats)
+    finally:
+        with app.app_context():
+            with db.cursor() as cur:
+                cur.execute("delete from players where id = %s;", (PLAYER_ID,))
+                cur.execute("delete from tokens where id = %s;", (PLAYER_ID,))
+            db.close_conn()
+        for a in apps:
+            with a.app_context():
+                db.close_all()
+    if not ok:
+        sys.exit('single-flight check failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Microbenchmark: per-call conn checkout + commit (old db_utils) vs one
+request-scoped unit of work (db.py), on a minesweeper.init()-like request
+of get_score + get_hscore + update_score.
+
+    DB_URL=postgresql://... python3 benchmarks/bench_uow.py -n 2000
+
+Needs the schema in DB_URL (python3 discord_games/migrate.py).
+Writes a throwaway player (id -1) and its rows.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask
+from psycopg2.extras import RealDictCursor
+
+import config
+import db
+import db_utils
+import game_registry
+import leaderboard
+
+
+PLAYER_ID = -1
+GAME_ID = 'minesweeper'
+
+
+# ---------------- old: checkout/commit/return per statement -------------
+def legacy_query(pool, sql, params, fetch=False):
+    conn = pool.getconn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql, params)
+            row = cur.fetchone() if fetch else None
+        conn.commit()
+        return row
+    finally:
+        pool.putconn(conn)
+
+
+def legacy_request(pool):
+    legacy_query(pool, """
+        select score from scores where player_id = %s and game_id = %s;
+    """, (PLAYER_ID, GAME_ID), fetch=True)
+    legacy_query(pool, """
+        select hscore from highscores where player_id = %s and game_id = %s;
+    """, (PLAYER_ID, GAME_ID), fetch=True)
+    legacy_query(pool, """
+        update scores set score = %s where player_id = %s and game_id = %s;
+    """, (1, PLAYER_ID, GAME_ID))
+
+
+# ---------------- new: one unit of work per request ----------------------
+def uow_request(app):
+    with app.app_context():
+        db_utils.get_score(PLAYER_ID, GAME_ID)
+        db_utils.get_hscore(PLAYER_ID, GAME_ID)
+        db_utils.update_score(1, PLAYER_ID, GAME_ID)
+
+
+def run(label, fn, n, nqueries):
+    # warmup
+    for _ in range(min(n, 50)):
+        fn()
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f'{label:>8}: {n} reqs in {elapsed:.3f}s  '
+          f'{n/elapsed:8.1f} req/s  {n*nqueries/elapsed:8.1f} queries/s')
+    return n*nqueries/elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000, help='requests per mode')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if not app.config['DB_URL']:
+        sys.exit('DB_URL not set')
+    db.init_app(app)
+    game_registry.init_app(app)
+    leaderboard.init_app(app)
+
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("""
+                insert into players values (%s, 'bench')
+                on conflict (id) do nothing;
+            """, (PLAYER_ID,))
+        db_utils.init_highscores_db(PLAYER_ID, GAME_ID)
+        db_utils.init_scores_db(PLAYER_ID, GAME_ID)
+
+    try:
+        before = run('before', lambda: legacy_request(app.db), args.n, 3)
+        after = run('after', lambda: uow_request(app), args.n, 3)
+        print(f'speedup: {after/before:.2f}x')
+    finally:
+        with app.app_context():
+            with db.cursor() as cur:
+                cur.execute("delete from players where id = %s;", (PLAYER_ID,))
+            db.close_conn()
+            db.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+'''
+Check: single-flight refreshes of the discord access token cache
+(token_cache.py), w/o Postgres or discord. The tokens table read is
+stubbed w/ a dict whose lock stands in for the row's FOR UPDATE, and
+discord w/ a stub that rotates refresh tokens like the real one (a used
+refresh token gets rejected).
+
+    python3 benchmarks/check_token_cache.py -n 32
+
+For 1 player whose token is about to expire, n threads ask for it at once:
+    - 1 cache: exactly 1 refresh & 1 table read, all get its token
+    - 2 caches (like 2 worker procs) sharing the table: still exactly 1
+      refresh, 1 read per cache
+    - a refresh that fails: every caller gets the error, the next get retries
+Then the background refresh renewing a token before anyone asks for it.
+Exits non-zero if any of it fails. bench_token_cache.py does the same
+against a real db & http stub, plus latencies.
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+from flask import Flask
+
+import config
+import token_cache
+
+
+PLAYER_ID = -424242
+
+
+# --------------------------- stubs ---------------------------
+class StubDiscord:
+    def __init__(self, delay):
+        self.delay = delay
+        self.valid = None
+        self.refreshes = 0
+        self.rejected = 0
+        self.fail = False
+        self._lock = threading.Lock()
+
+    # return: same as discord_api.refresh_token
+    def refresh_token(self, refresh_t):
+        time.sleep(self.delay)
+        with self._lock:
+            if self.fail or refresh_t != self.valid:
+                self.rejected += 1
+                raise RuntimeError('invalid_grant')
+            self.valid = uuid.uuid4().hex
+            self.refreshes += 1
+            return {'access_token': uuid.uuid4().hex,
+                    'refresh_token': self.valid,
+                    'expires_in': 604800}
+
+
+# the tokens table, shared by every cache like the db is by every proc
+class StubTable:
+    def __init__(self, discord):
+        self.discord = discord
+        self.rows = {}
+        self.reads = 0
+        # held for the whole read (+ refresh), like the row lock till commit
+        self.row_lock = threading.Lock()
+
+    def reset(self, player_id, expires_in):
+        self.discord.valid = uuid.uuid4().hex
+        self.discord.refreshes = self.discord.rejected = 0
+        self.reads = 0
+        self.rows[player_id] = {'access_t': 'old-' + uuid.uuid4().hex,
+                                'refresh_t': self.discord.valid,
+                                'expires_at': int(time.time()) + expires_in}
+
+    # stands in for TokenCache._read
+    def read(self, cache, player_id, ahead):
+        with self.row_lock:
+            self.reads += 1
+            row = self.rows.get(player_id)
+            if row is None:
+                return
+            if not cache.fresh(row['expires_at'], ahead):
+                r = self.discord.refresh_token(row['refresh_t'])
+                row = {'access_t': r['access_token'],
+                       'refresh_t': r['refresh_token'],
+                       'expires_at': r['expires_in'] + int(time.time())}
+                self.rows[player_id] = row
+                with cache._lock:
+                    cache.stats['refreshes'] += 1
+            return {'access_t': row['access_t'], 'expires_at': row['expires_at']}
+
+
+# --------------------------- setup ---------------------------
+# an app w/ only the token cache, its _read going to table
+def make_app(table):
+    app = Flask(__name__)
+    app.config.from_object(config)
+    # no background thread unless asked for
+    app.config['TOKENS'] = dict(app.config['TOKENS'], check_every=0)
+    token_cache.init_app(app)
+    cache = app.tokens
+    cache._read = lambda player_id, ahead: table.read(cache, player_id, ahead)
+    return app
+
+
+# n threads call fn at once
+# return: (results, nr of exceptions)
+def burst(fn, n):
+    results, errors = [], []
+    start = threading.Barrier(n)
+
+    def run():
+        start.wait()
+        try:
+            results.append(fn())
+        except Exception:
+            errors.append(1)
+    threads = [threading.Thread(target=run) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=32, help='concurrent callers')
+    parser.add_argument('--delay', type=float, default=0.1, help='stub discord latency [secs]')
+    args = parser.parse_args()
+
+    discord = StubDiscord(args.delay)
+    table = StubTable(discord)
+    app = make_app(table)
+    ok = True
+
+    table.reset(PLAYER_ID, 30)
+    results, errors = burst(lambda: app.tokens.get(PLAYER_ID), args.n)
+    same = len(results) == args.n and len(set(results)) == 1
+    print(f'1 cache: {discord.refreshes} refresh ok, {discord.rejected} rejected, {errors} callers failed, '
+          f'{table.reads} table reads, all got the same token: {same}')
+    ok &= discord.refreshes == 1 and not discord.rejected and not errors and same and table.reads == 1
+
+    # 2 procs' worth of fresh caches on the same table
+    table.reset(PLAYER_ID, 30)
+    procs = [make_app(table), make_app(table)]
+    counter = iter(range(args.n * 2))
+    lock = threading.Lock()
+
+    def either():
+        with lock:
+            a = procs[next(counter) % 2]
+        return a.tokens.get(PLAYER_ID)
+    results, errors = burst(either, args.n * 2)
+    same = len(results) == args.n * 2 and len(set(results)) == 1
+    print(f'2 procs: {discord.refreshes} refresh ok, {discord.rejected} rejected, {errors} callers failed, '
+          f'{table.reads} table reads, all got the same token: {same}')
+    ok &= discord.refreshes == 1 and not discord.rejected and not errors and same and table.reads == 2
+
+    # discord down: nobody gets a stale token, nothing's left in flight
+    app = make_app(table)
+    table.reset(PLAYER_ID, 30)
+    discord.fail = True
+    results, errors = burst(lambda: app.tokens.get(PLAYER_ID), args.n)
+    discord.fail = False
+    retried = app.tokens.get(PLAYER_ID) == table.rows[PLAYER_ID]['access_t']
+    print(f'failing: {errors} callers failed, {len(results)} got a token, '
+          f'next get refreshed: {retried}, in flight: {len(app.tokens._flights)}')
+    ok &= errors == args.n and not results and retried and not app.tokens._flights
+
+    # expires in 5 min, refresh_ahead 10 min: renewed w/o a single get
+    app = make_app(table)
+    table.reset(PLAYER_ID, 300)
+    app.tokens.put(PLAYER_ID, 'about-to-expire', int(time.time()) + 300)
+    app.tokens.start(0.2, app.config['TOKENS']['refresh_ahead'])
+    time.sleep(1 + args.delay)
+    renewed = app.tokens.get(PLAYER_ID) != 'about-to-expire'
+    print(f'background: {discord.refreshes} refresh, renewed before use: {renewed}')
+    ok &= renewed and discord.refreshes == 1
+
+    # never auth'd
+    ok &= app.tokens.get(-1) is None
+    print('cache stats:', app.tokens.stats)
+    if not ok:
+        sys.exit('single-flight check failed')
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+'''
+Load test: sync flask server vs the async (ASGI) server on the /auth login
+path, against a local stub of the discord api w/ an artificial delay.
+
+    DB_URL=postgresql://... python3 benchmarks/loadtest_async.py -n 500 -c 200
+
+The flask app runs on werkzeug w/ a fixed number of worker threads (like a
+gthread worker), the async app on hypercorn w/ one event loop.
+Both talk to the same DB_URL and log in fake players (tokens & players
+rows get written), so point it at a scratch db.
+'''
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'discord_games'))
+
+import aiohttp
+from aiohttp import web
+from werkzeug.serving import make_server
+
+
+# --------------------------- stub discord ---------------------------
+def stub_discord(delay):
+    app = web.Application()
+
+    async def token(req):
+        await asyncio.sleep(delay)
+        form = await req.post()
+        return web.json_response({
+            'access_token': f'{form["code"]}-{uuid.uuid4().hex}',
+            'refresh_token': uuid.uuid4().hex,
+            'expires_in': 604800,
+            'token_type': 'Bearer',
+            'scope': 'identify',
+        })
+
+    async def me(req):
+        await asyncio.sleep(delay)
+        code = req.headers['Authorization'].split()[1].split('-')[0]
+        return web.json_response({'id': str(10**6 + int(code)), 'username': f'p{code}'})
+
+    app.router.add_post('/oauth2/token', token)
+    app.router.add_get('/users/@me', me)
+    return app
+
+
+def run_in_thread(coro_fn):
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def target():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(coro_fn(ready))
+    threading.Thread(target=target, daemon=True).start()
+    ready.wait()
+    return loop
+
+
+def start_stub(port, delay):
+    async def serve(ready):
+        runner = web.AppRunner(stub_discord(delay))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+    run_in_thread(serve)
+
+
+# --------------------------- servers ---------------------------
+def start_flask(port, threads):
+    import server
+    sem = threading.BoundedSemaphore(threads)
+
+    # only `threads` requests in flight at once, like a fixed worker pool
+    def bounded(environ, start_response):
+        with sem:
+            return list(server.app(environ, start_response))
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    srv = make_server('127.0.0.1', port, bounded, threaded=True)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def start_asgi(port):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    import asgi
+
+    cfg = Config()
+    cfg.bind = [f'127.0.0.1:{port}']
+    cfg.accesslog = None
+
+    async def run(ready):
+        # no signal handlers off the main thread
+        task = asyncio.ensure_future(
+                serve(asgi.app, cfg, shutdown_trigger=asyncio.Event().wait))
+        # wait for the socket to open
+        while True:
+            try:
+                _, w = await asyncio.open_connection('127.0.0.1', port)
+                w.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+        ready.set()
+        await task
+    run_in_thread(run)
+
+
+# --------------------------- client ---------------------------
+async def load(base, n, concurrency, offset):
+    lat = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    conn = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=conn) as sesh:
+        async def one(i):
+            nonlocal errors
+            async with sem:
+                start = time.perf_counter()
+                async with sesh.get(f'{base}/auth?code={offset + i}',
+                                    allow_redirects=False) as r:
+                    await r.read()
+                    if r.status != 302:
+                        errors += 1
+                lat.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        elapsed = time.perf_counter() - start
+    return elapsed, lat, errors
+
+
+def report(label, elapsed, lat, errors):
+    lat = sorted(lat)
+    q = statistics.quantiles(lat, n=100)
+    print(f'{label:>6}: {len(lat)/elapsed:8.1f} req/s  '
+          f'p50 {q[49]*1000:7.1f}ms  p95 {q[94]*1000:7.1f}ms  '
+          f'p99 {q[98]*1000:7.1f}ms  errors {errors}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500, help='logins per server')
+    parser.add_argument('-c', type=int, default=200, help='concurrent clients')
+    parser.add_argument('--threads', type=int, default=8, help='flask worker threads')
+    parser.add_argument('--delay', type=float, default=0.2, help='stub discord delay [s]')
+    args = parser.parse_args()
+
+    import config
+    stub_port, flask_port, asgi_port = 5801, 5802, 5803
+    config.API_ENDPOINT = f'http://127.0.0.1:{stub_port}'
+    config.REDIR_URI = config.REDIR_URI or 'http://127.0.0.1/auth'
+    config.CLIENT_ID = config.CLIENT_ID or 'bench'
+    config.CLIENT_SECRET = config.CLIENT_SECRET or 'bench'
+
+    start_stub(stub_port, args.delay)
+    start_flask(flask_port, args.threads)
+    start_asgi(asgi_port)
+
+    print(f'{args.n} logins, {args.c} concurrent, discord delay {args.delay}s '
+          f'(x2 calls per login), flask threads {args.threads}')
+    res = asyncio.run(load(f'http://127.0.0.1:{flask_port}', args.n, args.c, 0))
+    report('flask', *res)
+    res = asyncio.run(load(f'http://127.0.0.1:{asgi_port}', args.n, args.c, args.n))
+    report('asgi', *res)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+'''
+Load test of the whole game server: the real flask app (server.py) against
+DB_URL, driven in-process thru its test client, so the numbers are the
+app's & the db's w/o any http server in the way.
+
+    DB_URL=postgresql://... python3 benchmarks/loadtest_games.py -n 200 -c 16 --json out.json
+
+    - every simulated player logs in thru the real /auth, against a local
+      stub of discord's OAuth & users api, then plays a full simon,
+      minesweeper & num_guess game thru the blueprint endpoints, the same
+      calls the templates' JS makes
+    - pollers hit /api/rankings the whole time, like the bot, and once
+      --reset-at of the players are done the daily reset fires (reset_time
+      moved to now, then reset_job.run_reset()) while games go on
+    - reports throughput, p50/p95/p99 per route, db queries per game,
+      session bytes per player (cookie + server-side game state) & how long
+      the reset took, w/ --json for diffing runs between commits
+
+Queries are counted thru metrics.py (sample_rate 1), so w/ the score
+buffer on (the default) the batched score writes of its flush thread
+aren't in the per game counts, --no-score-buffer puts them back.
+
+It fires a real daily reset (archives & swaps the scores table), so point
+it at a scratch db, it gets migrated on boot. The bench players (negative
+ids) & their rows are deleted after, the archived period stays.
+'''
+import argparse
+import json
+import os
+import pickle
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'discord_games')
+sys.path.insert(0, APP_DIR)
+
+# only read config thru the app, unlike server.py & the game blueprints
+import config
+import db
+import game_state
+import metrics
+import reset_job
+
+
+# player n is PLAYER_BASE - n
+PLAYER_BASE = -700000
+GAMES = ('simon', 'minesweeper', 'num_guess')
+
+
+# --------------------------- stub discord ---------------------------
+# the code handed to /auth is the player's nr, & ends up in its access token
+def stub_discord():
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, data):
+            out = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            self.reply({'access_token': f'{form["code"]}.{time.time_ns()}',
+                        'refresh_token': f'r{time.time_ns()}',
+                        'expires_in': 604800,
+                        'token_type': 'Bearer',
+                        'scope': 'identify'})
+
+        def do_GET(self):
+            n = int(self.headers['Authorization'].split()[1].split('.')[0])
+            self.reply({'id': str(PLAYER_BASE - n), 'username': f'bench{n}'})
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{srv.server_port}'
+
+
+# --------------------------- setup ---------------------------
+# the real app, w/ the discord api stubbed & every request's queries counted
+def make_app(args):
+    config.API_ENDPOINT = stub_discord()
+    config.CLIENT_ID = config.CLIENT_SECRET = 'bench'
+    config.REDIR_URI = 'http://127.0.0.1/auth'
+    # same puzzles for every run of the same period
+    config.PUZZLE_SECRET = 'bench'
+    # the harness fires the reset itself
+    config.RESET['run_in_server'] = False
+    config.METRICS.update(enabled=True, sample_rate=1)
+    config.SCORE_BUFFER.update(enabled=not args.no_score_buffer, journal=None)
+    config.TOKENS['check_every'] = 0
+    config.PROFILER.update(token=None, sample_rate=0)
+    config.GAME_STATE['backend'] = args.game_state
+    if args.game_state == 'sqlite':
+        config.GAME_STATE['path'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                 'loadtest_state.sqlite3')
+    import server
+    server.app.wsgi_app = Capture(server.app.wsgi_app)
+    return server.app
+
+
+# keeps the environ the app saw (the test client hands it a copy), per
+# thread, so metrics' route label & query count can be read back after
+class Capture:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.local = threading.local()
+
+    def __call__(self, environ, start_response):
+        self.local.environ = environ
+        return self.wsgi_app(environ, start_response)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --------------------------- recording ---------------------------
+class Recorder:
+    def __init__(self):
+        # '<METHOD> <route>' -> [ms]
+        self.latency = {}
+        self.errors = 0
+        self.resetting = False
+        self._lock = threading.Lock()
+
+    def add(self, name, ms, ok):
+        with self._lock:
+            self.latency.setdefault(name, []).append(ms)
+            self.errors += not ok
+
+
+def stats(ms):
+    if len(ms) < 2:
+        return {'n': len(ms), 'mean': ms[0] if ms else None, 'p50': None, 'p95': None, 'p99': None}
+    q = statistics.quantiles(ms, n=100)
+    return {'n': len(ms), 'mean': round(statistics.mean(ms), 3),
+            'p50': round(q[49], 3), 'p95': round(q[94], 3), 'p99': round(q[98], 3)}
+
+
+# --------------------------- players ---------------------------
+class Player:
+    def __init__(self, app, rec, n, seed):
+        self.app = app
+        self.rec = rec
+        self.n = n
+        self.id = PLAYER_BASE - n
+        self.rng = random.Random(seed * 1000003 + n)
+        self.client = app.test_client()
+        # per game: requests, db queries
+        self.games = {}
+        self._game = None
+
+    # return: json body (None if there's none)
+    def call(self, method, path, json=None):
+        start = time.perf_counter()
+        r = self.client.open(path, method=method, json=json)
+        ms = (time.perf_counter() - start) * 1000
+        environ = self.app.wsgi_app.local.environ
+        route = environ.get(metrics.ROUTE, r.request.path)
+        self.rec.add(f'{method} {route}', ms, r.status_code < 400)
+        if self._game is not None:
+            g = self.games[self._game]
+            g['requests'] += 1
+            sample = environ.get(metrics.SAMPLE)
+            g['queries'] += sample.queries if sample is not None else 0
+        return r.get_json(silent=True)
+
+    def login(self):
+        self.call('GET', f'/auth?code={self.n}')
+        self.call('GET', '/home')
+
+    def play(self, game_id):
+        self._game = game_id
+        self.games[game_id] = {'requests': 0, 'queries': 0}
+        self.call('GET', f'/play/{game_id}')
+        getattr(self, f'play_{game_id}')()
+        self._game = None
+
+    # right colours up to a random score, then a wrong one
+    def play_simon(self):
+        self.call('GET', '/simon/init')
+        self.call('POST', '/simon/start')
+        target = self.rng.randint(1, 8)
+        while True:
+            seq = self.call('POST', '/simon/get_sequence')['sequence']
+            if len(seq) - 1 == target:
+                wrong = self.rng.choice([c for c in 'rgbo' if c != seq[0]])
+                self.call('POST', '/simon/verify', {'choice': wrong})
+                return
+            for c in seq:
+                r = self.call('POST', '/simon/verify', {'choice': c})
+            if r['status'] != 'continue':
+                return
+
+    # random clicks on covered tiles until a mine (or a win)
+    def play_minesweeper(self):
+        ndim = self.call('GET', '/minesweeper/init')['ndim']
+        revealed = set()
+        tiles = [(i, j) for i in range(ndim) for j in range(ndim)]
+        self.rng.shuffle(tiles)
+        for tile in tiles:
+            if tile in revealed:
+                continue
+            r = self.call('POST', '/minesweeper/verify', {'choice': list(tile)})
+            revealed.update((t['r'], t['c']) for t in r.get('revealed', []))
+            # the score's recorded by the verify that ended it
+            if r['status'] in ('game_over', 'won'):
+                return
+
+    # random guesses within what the hints leave, so some games are lost
+    def play_num_guess(self):
+        self.call('GET', '/num_guess/start')
+        lo, hi = 1, 100
+        while True:
+            guess = self.rng.randint(lo, hi)
+            r = self.call('POST', '/num_guess/verify', {'guess': guess})
+            if r['status'] != 'continue':
+                return
+            if r['hint'] == 'higher':
+                lo = guess + 1
+            else:
+                hi = guess - 1
+
+    # return: (cookie bytes, game state bytes)
+    def session_bytes(self):
+        cfg = self.app.config
+        name = cfg['AUTH']['cookie'] if cfg['AUTH']['mode'] == 'token' else cfg['SESSION_COOKIE_NAME']
+        cookie = self.client.get_cookie(name)
+        state = 0
+        for gid in GAMES:
+            st = self.app.game_state.get(game_state.key(self.id, gid))
+            if st is not None:
+                state += len(pickle.dumps(st, pickle.HIGHEST_PROTOCOL))
+        return len(cookie.value) if cookie else 0, state
+
+
+def poll_rankings(app, rec, stop):
+    client = app.test_client()
+    while not stop.is_set():
+        start = time.perf_counter()
+        r = client.get('/api/rankings')
+        ms = (time.perf_counter() - start) * 1000
+        name = 'GET /api/rankings' + (' (during reset)' if rec.resetting else '')
+        rec.add(name, ms, r.status_code < 400)
+        time.sleep(0.01)
+
+
+# return: {period, secs}
+def fire_reset(app, rec):
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("update reset_time set time = now();")
+    rec.resetting = True
+    start = time.perf_counter()
+    try:
+        with app.app_context():
+            period = reset_job.run_reset()
+    finally:
+        rec.resetting = False
+    return {'period': period, 'secs': round(time.perf_counter() - start, 4)}
+
+
+def cleanup(app, ids):
+    if app.score_buffer is not None:
+        app.score_buffer.close()
+    with app.app_context():
+        with db.cursor() as cur:
+            for table, col in (('tokens', 'id'), ('scores', 'player_id'),
+                               ('highscores', 'player_id'), ('daily_results', 'player_id'),
+                               ('score_history', 'player_id'), ('players', 'id')):
+                cur.execute(f"delete from {table} where {col} = any(%s);", (ids,))
+    with app.app_context():
+        db.close_all()
+
+
+# --------------------------- main ---------------------------
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200, help='players, each plays every game once')
+    parser.add_argument('-c', type=int, default=16, help='concurrent players')
+    parser.add_argument('--pollers', type=int, default=2, help='threads polling /api/rankings')
+    parser.add_argument('--reset-at', type=float, default=0.5,
+                        help='fire the daily reset once this fraction of the players is done')
+    parser.add_argument('--game-state', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--no-score-buffer', action='store_true', help='score writes in the request')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results here, - for stdout')
+    args = parser.parse_args()
+    if not config.DB_URL:
+        sys.exit('DB_URL not set')
+
+    app = make_app(args)
+    rec = Recorder()
+    players = [Player(app, rec, n, args.seed) for n in range(1, args.n + 1)]
+    done = [0]
+    done_lock = threading.Lock()
+    reset_due = threading.Event()
+    reset = {}
+
+    def run(p):
+        p.login()
+        for gid in GAMES:
+            p.play(gid)
+        with done_lock:
+            done[0] += 1
+            if done[0] >= args.reset_at * args.n:
+                reset_due.set()
+
+    def resetter():
+        reset_due.wait()
+        if not stop.is_set():
+            reset.update(fire_reset(app, rec))
+
+    stop = threading.Event()
+    bg = [threading.Thread(target=poll_rankings, args=(app, rec, stop)) for _ in range(args.pollers)]
+    bg.append(threading.Thread(target=resetter))
+    try:
+        start = time.perf_counter()
+        for t in bg:
+            t.start()
+        with ThreadPoolExecutor(args.c) as pool:
+            for f in [pool.submit(run, p) for p in players]:
+                f.result()
+        wall = time.perf_counter() - start
+        stop.set()
+        reset_due.set()
+        for t in bg:
+            t.join()
+
+        sizes = [p.session_bytes() for p in players]
+        all_ms = [ms for name, v in rec.latency.items() if 'rankings' not in name for ms in v]
+        nrequests = sum(len(v) for v in rec.latency.values())
+        results = {
+            'commit': commit(),
+            'config': {'players': args.n, 'concurrency': args.c, 'pollers': args.pollers,
+                       'reset_at': args.reset_at, 'seed': args.seed,
+                       'game_state': args.game_state,
+                       'score_buffer': not args.no_score_buffer,
+                       'auth_mode': app.config['AUTH']['mode']},
+            'wall_secs': round(wall, 3),
+            'requests': nrequests,
+            'errors': rec.errors,
+            'throughput': {'requests_per_sec': round(nrequests / wall, 1),
+                           'games_per_sec': round(args.n * len(GAMES) / wall, 1)},
+            'latency_ms': {'games': stats(all_ms),
+                           'routes': {name: stats(v) for name, v in sorted(rec.latency.items())}},
+            'games': {gid: {'requests_per_game': round(statistics.mean(p.games[gid]['requests'] for p in players), 2),
+                            'db_queries_per_game': round(statistics.mean(p.games[gid]['queries'] for p in players), 2)}
+                      for gid in GAMES},
+            'session_bytes_per_player': {'cookie': round(statistics.mean(s[0] for s in sizes), 1),
+                                         'game_state': round(statistics.mean(s[1] for s in sizes), 1)},
+            'reset': reset or None,
+        }
+    finally:
+        stop.set()
+        reset_due.set()
+        cleanup(app, [p.id for p in players])
+        if args.game_state == 'sqlite':
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(config.GAME_STATE['path'] + suffix)
+                except FileNotFoundError:
+                    pass
+
+    t = results['throughput']
+    lat = results['latency_ms']['games']
+    print(f'{args.n} players x {len(GAMES)} games in {wall:.2f}s: {t["requests_per_sec"]} req/s, '
+          f'{t["games_per_sec"]} games/s, {rec.errors} errors')
+    print(f'game requests: p50 {lat["p50"]}ms  p95 {lat["p95"]}ms  p99 {lat["p99"]}ms')
+    for name, s in results['latency_ms']['routes'].items():
+        print(f'  {name:<40} n {s["n"]:>6}  p50 {s["p50"]}  p95 {s["p95"]}  p99 {s["p99"]}')
+    for gid, g in results['games'].items():
+        print(f'{gid:>12}: {g["requests_per_game"]} requests, {g["db_queries_per_game"]} db queries per game')
+    s = results['session_bytes_per_player']
+    print(f'session bytes per player: cookie {s["cookie"]}, game state {s["game_state"]}')
+    print(f'daily reset: {results["reset"]}')
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Async (ASGI) deployment mode, needs the 'async' extras:
+
+    pip install .[async]
+    cd discord_games && hypercorn asgi:app --bind 127.0.0.1:5000
+
+The route that waits on the network, /auth (2 round trips to discord),
+is served natively async w/ an aiohttp client and an asyncpg pool, so a
+slow OAuth exchange only parks a coroutine instead of a worker thread.
+
+Everything else (game blueprints, /play, /home, ...) is the same flask
+app from server.py, run on a bounded thread pool since it's session-bound
+sync code w/ quick indexed queries (/api/rankings only reads a cached
+snapshot, see reset_job.py).
+'''
+# native
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+# extra
+import aiohttp
+import asyncpg
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, request, redirect
+# custom
+import server
+
+
+aio_app = Quart(__name__)
+aio_app.config.from_object('config')
+
+# served by aio_app, the rest goes to the flask app
+ASYNC_ROUTES = {'/auth'}
+
+
+#============================== INIT ===================================
+@aio_app.before_serving
+async def startup():
+    cfg = aio_app.config['ASGI']
+    pool_cfg = aio_app.config['DB_POOL']
+    # threads that run the flask app
+    asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=cfg['wsgi_threads'])
+    )
+    aio_app.pg = await asyncpg.create_pool(
+            dsn=aio_app.config['DB_URL'],
+            min_size=pool_cfg['minconn'],
+            max_size=pool_cfg['maxconn'],
+            max_inactive_connection_lifetime=pool_cfg['max_idle'],
+            server_settings={'statement_timeout': str(pool_cfg['statement_timeout'])}
+    )
+    # 1 keep-alive session for all discord calls
+    aio_app.http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=cfg['http_timeout'])
+    )
+
+
+@aio_app.after_serving
+async def shutdown():
+    await aio_app.http.close()
+    await aio_app.pg.close()
+
+
+#================================= LOGIN/AUTH ====================================
+# same as server.auth() but w/o blocking a thread
+@aio_app.route('/auth', methods=['GET'])
+async def auth():
+    code = request.args.get('code')
+    if not code:
+        return "You look lost, friend", 400
+
+    r = await exchange_code(code)
+    access_t = r['access_token']
+    refresh_t = r['refresh_token']
+    expires_at = r['expires_in'] + int(time.time())
+
+    r = await get_user_deets(access_t)
+    async with aio_app.pg.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO tokens
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (id) DO UPDATE
+                SET access_t = EXCLUDED.access_t,
+                    refresh_t = EXCLUDED.refresh_t,
+                    expires_at = EXCLUDED.expires_at;
+            """, int(r['id']), access_t, refresh_t, expires_at)
+            await conn.execute("""
+                insert into players
+                values ($1, $2)
+                on conflict (id) do update
+                set username = excluded.username;
+            """, int(r['id']), r['username'])
+    # committed, so the flask app's token cache can have it too
+    # (the same dict update token_cache.store() does after its commit)
+    server.app.tokens.put(int(r['id']), access_t, expires_at)
+
+    # the flask app owns the session
+    t = server.handoff.dumps({'id': r['id'], 'username': r['username']})
+    return redirect(f'/auth/session?t={t}')
+
+
+# return: see discord_api.exchange_code()
+async def exchange_code(code):
+    data = {'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': aio_app.config['REDIR_URI']
+    }
+    auth = aiohttp.BasicAuth(aio_app.config['CLIENT_ID'], aio_app.config['CLIENT_SECRET'])
+    async with aio_app.http.post(f"{aio_app.config['API_ENDPOINT']}/oauth2/token",
+                                 data=data,
+                                 auth=auth) as r:
+        r.raise_for_status()
+        return await r.json()
+
+
+# return: see discord_api.get_user_deets()
+async def get_user_deets(access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    async with aio_app.http.get(f"{aio_app.config['API_ENDPOINT']}/users/@me",
+                                headers=headers) as r:
+        r.raise_for_status()
+        return await r.json()
+
+
+#=============================== ASGI ================================
+wsgi_app = AsyncioWSGIMiddleware(server.app)
+
+
+async def app(scope, receive, send):
+    # lifespan starts/stops the pools in aio_app
+    if scope['type'] == 'lifespan' or scope['path'] in ASYNC_ROUTES:
+        return await aio_app(scope, receive, send)
+    return await wsgi_app(scope, receive, send)
@@ -0,0 +1,192 @@
+# native
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+# extra
+from flask import current_app, session
+from flask.sessions import SecureCookieSession, SessionInterface
+from psycopg2.extras import RealDictCursor
+# custom
+import db
+
+
+'''
+Stateless signed-token auth mode (AUTH['mode'] = 'token'), instead of
+flask's default signed cookie session. Once /auth is done the player gets
+a compact token:
+
+    <kid>.<payload>.<sig>
+    payload: base64url json [id, username, expires_at, jti]
+    sig: base64url HMAC-SHA256 of '<kid>.<payload>' w/ key kid
+
+in the AUTH['cookie'] cookie, or as 'Authorization: Bearer <token>' for
+non-browser clients. It's plugged in as the session interface, so
+session['id'], login_required & the game code work the same in both
+modes. Verifying is 1 HMAC + a constant time compare, no storage access.
+
+Key rotation: AUTH['keys'] is 'kid:secret,kid:secret,...', the 1st one
+signs new tokens and every one listed still verifies. Put a new key 1st,
+then drop the old one once its tokens expired (ttl).
+
+Revocation: /logout revokes the token's jti into revoked_tokens (rows go
+once the token would've expired anyway, so the list stays small). Each
+proc keeps it in memory, reloaded every AUTH['revoked_sync'] secs.
+'''
+def init_app(app):
+    cfg = app.config['AUTH']
+    if cfg['mode'] != 'token':
+        return
+    app.auth_tokens = TokenSigner(parse_keys(cfg['keys']), cfg['ttl'])
+    app.session_interface = TokenSessionInterface(cfg['cookie'])
+    sync_revoked(app)
+    if cfg['revoked_sync']:
+        start_sync(app, cfg['revoked_sync'])
+
+
+# 'kid:secret,kid:secret' -> {kid: secret} in that order
+def parse_keys(s):
+    keys = {}
+    for part in s.split(','):
+        kid, _, secret = part.strip().partition(':')
+        if not kid or not secret or '.' in kid:
+            raise ValueError(f'bad auth key: {kid!r}')
+        keys[kid] = secret.encode()
+    return keys
+
+
+def b64encode(b):
+    return base64.urlsafe_b64encode(b).rstrip(b'=').decode()
+
+
+def b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+class TokenSigner:
+    def __init__(self, keys, ttl=7*24*3600):
+        # {kid: secret}, the 1st one signs
+        self.keys = keys
+        self.kid = next(iter(keys))
+        self.ttl = ttl
+        # jti of revoked tokens that haven't expired yet
+        self.revoked = frozenset()
+
+    def sign(self, kid, payload):
+        mac = hmac.new(self.keys[kid], f'{kid}.{payload}'.encode(), hashlib.sha256)
+        return b64encode(mac.digest())
+
+    # return: (token, claims)
+    def issue(self, player_id, username):
+        claims = {'id': player_id,
+                  'username': username,
+                  'exp': int(time.time()) + self.ttl,
+                  'jti': secrets.token_urlsafe(9)}
+        payload = b64encode(json.dumps([claims['id'], claims['username'],
+                                        claims['exp'], claims['jti']],
+                                       separators=(',', ':')).encode())
+        return f'{self.kid}.{payload}.{self.sign(self.kid, payload)}', claims
+
+    # return: claims {id, username, exp, jti}, None if it's not valid
+    def verify(self, token):
+        parts = token.split('.')
+        if len(parts) != 3 or parts[0] not in self.keys:
+            return
+        kid, payload, sig = parts
+        # as bytes, compare_digest raises on non-ascii strs
+        if not hmac.compare_digest(sig.encode(), self.sign(kid, payload).encode()):
+            return
+        try:
+            player_id, username, exp, jti = json.loads(b64decode(payload))
+        except ValueError:
+            return
+        if exp <= time.time() or jti in self.revoked:
+            return
+        return {'id': player_id, 'username': username, 'exp': exp, 'jti': jti}
+
+
+# session w/ the claims of the token it came from (None if it didn't)
+class TokenSession(SecureCookieSession):
+    claims = None
+
+
+class TokenSessionInterface(SessionInterface):
+    def __init__(self, cookie='auth'):
+        self.cookie = cookie
+
+    def open_session(self, app, request):
+        token = None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            token = header[len('Bearer '):]
+        elif self.cookie in request.cookies:
+            token = request.cookies[self.cookie]
+        claims = app.auth_tokens.verify(token) if token else None
+        if claims is None:
+            return TokenSession()
+        s = TokenSession({'id': claims['id'], 'username': claims['username']})
+        s.claims = claims
+        return s
+
+    # a new token only when who's logged in changed (e.g. /auth) or the
+    # current one is past half its ttl, so active players never get logged out
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                response.delete_cookie(self.cookie, domain=domain, path=path)
+            return
+        claims = session.claims
+        stale = claims is not None and claims['exp'] - time.time() < app.auth_tokens.ttl / 2
+        if not session.modified and not stale:
+            return
+        token, claims = app.auth_tokens.issue(session['id'], session['username'])
+        response.set_cookie(self.cookie, token,
+                            expires=claims['exp'],
+                            httponly=True,
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+
+# revokes the token of the current request, if it came w/ one
+def revoke_current():
+    claims = getattr(session, 'claims', None)
+    if claims is None:
+        return
+    with db.cursor() as cur:
+        cur.execute("""
+            insert into revoked_tokens (jti, expires_at)
+            values (%s, %s)
+            on conflict (jti) do nothing;
+        """, (claims['jti'], claims['exp']))
+    signer = current_app.auth_tokens
+    db.after_commit(lambda: setattr(signer, 'revoked', signer.revoked | {claims['jti']}))
+
+
+# reloads the revocation list (revoked in other procs too), dropping the
+# rows of tokens that expired since
+def sync_revoked(app):
+    with app.app_context():
+        with db.cursor(RealDictCursor) as cur:
+            now = int(time.time())
+            cur.execute("delete from revoked_tokens where expires_at <= %s;", (now,))
+            cur.execute("select jti from revoked_tokens;")
+            app.auth_tokens.revoked = frozenset(r['jti'] for r in cur.fetchall())
+
+
+def start_sync(app, every):
+    def loop():
+        while True:
+            time.sleep(every)
+            try:
+                sync_revoked(app)
+            except Exception:
+                app.logger.exception('revoked token sync failed')
+    threading.Thread(target=loop, name='revoked-sync', daemon=True).start()
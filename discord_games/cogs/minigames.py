@@ -11,6 +11,9 @@ class Minigames(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.API_URL = f'{config.BASE_URL}/api'
+        # period of the last announced rankings, so each gets announced once
+        # even across restarts, None if nothing's been announced yet
+        self.last_period = self.load_last_period()
         # start background reminder loop
         self.bot.loop.create_task(self.announce_rankings())
 
@@ -43,11 +46,19 @@ class Minigames(commands.Cog):
             channel = await self.bot.fetch_channel(config.CHANNEL_ID)
 
         while not self.bot.is_closed():
-            data = await self.fetch_rankings()
+            data = await self.fetch_rankings(self.last_period)
             # 'not' covers both None and []
             if not data:
                 await asyncio.sleep(3600)
                 continue
+            first = self.last_period is None
+            self.last_period = data['period']
+            self.save_last_period()
+            # 1st run ever: the latest snapshot could be from any time ago,
+            # only announce the ones that come after it
+            if first:
+                await asyncio.sleep(3600)
+                continue
 
             # rankings already sorted
             rankings = data['rankings']
@@ -86,10 +97,25 @@ class Minigames(commands.Cog):
             await asyncio.sleep(3600)
 
 
-    # return: {rankings: {...}, max_scores: {game_id: str, max_score: int}, streak: int}
-    async def fetch_rankings(self):
+    def load_last_period(self):
+        try:
+            with open(config.LAST_PERIOD_FILE) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def save_last_period(self):
+        with open(config.LAST_PERIOD_FILE, 'w') as f:
+            f.write(str(self.last_period))
+
+
+    # after: period of the last rankings seen, None for the latest
+    # return: {period: int, rankings: {...}, max_scores: {game_id: str, max_score: int}, streak: int}
+    async def fetch_rankings(self, after=None):
+        params = {} if after is None else {'after': after}
         async with aiohttp.ClientSession() as sesh:
-            async with sesh.get(f"{self.API_URL}/rankings") as r:
+            async with sesh.get(f"{self.API_URL}/rankings", params=params) as r:
                 if r.status == 200:
                     return await r.json()
 
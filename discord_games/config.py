@@ -9,17 +9,163 @@ load_dotenv()
 BOT_TOKEN = environ.get('BOT_TOKEN')
 CHANNEL_ID = environ.get('CHANNEL_ID')
 CMD_PREFIX = '!'
+# period of the last announced rankings, kept across bot restarts
+LAST_PERIOD_FILE = environ.get('LAST_PERIOD_FILE', 'last_period.txt')
+
+# daily puzzles are the same for everyone in the guild (see puzzles.py)
+GUILD_ID = environ.get('GUILD_ID', 'default')
+# keys the puzzle seeds, set it when running >1 worker proc
+PUZZLE_SECRET = environ.get('PUZZLE_SECRET', token_urlsafe(32))
 
 # for discord
 CLIENT_ID = environ.get('CLIENT_ID')
 CLIENT_SECRET = environ.get('CLIENT_SECRET')
 REDIR_URI = environ.get('REDIR_URI')
 API_ENDPOINT = 'https://discord.com/api/v10'
+# discord api client (see discord_api.py)
+DISCORD_HTTP = {
+        # keep-alive conns kept per host
+        'pool_size': 10,
+        # (connect, read) secs
+        'timeout': (3, 10),
+        # on 429/5xx or failed connects
+        'retries': 3,
+        # base secs of the exponential backoff
+        'backoff': 0.5,
+        # give up instead of waiting out a longer Retry-After [secs]
+        'max_retry_after': 10
+}
+
+# discord access token cache (see token_cache.py)
+TOKENS = {
+        # secs before expires_at a token counts as expired & gets refreshed on use
+        'margin': 60,
+        # secs between background checks for cached tokens about to expire, 0: never
+        # off till something calls get_access_token often enough to be worth it,
+        # get() refreshes on use anyway
+        'check_every': 0,
+        # the background refresh happens this many secs before the margin
+        'refresh_ahead': 600,
+        'max_entries': 10000
+}
 
 # for server
-SECRET_KEY = token_urlsafe(32)
+# signs the session cookies, set it so logins survive restarts
+SECRET_KEY = environ.get('SECRET_KEY', token_urlsafe(32))
 BASE_URL = environ.get('BASE_URL')
 DB_URL = environ.get('DB_URL')
+# db conn pool (see db.BlockingPool)
+DB_POOL = {
+        'minconn': 1,
+        'maxconn': 10,
+        # secs to wait for a free conn before giving up w/ a 503
+        'timeout': 5,
+        # secs a conn can sit idle before it gets recycled
+        'max_idle': 300,
+        # secs idle before a conn gets pinged on checkout
+        'ping_after': 30,
+        # ms before postgres cancels a query
+        'statement_timeout': 5000
+}
+# request latency & db instrumentation at /metrics (see metrics.py)
+METRICS = {
+        'enabled': True,
+        # fraction of requests that also get their db queries & session/game
+        # state load/save timed, route latency & pool wait are always on
+        'sample_rate': 0.1
+}
+# opt-in per request profiler (see profiler.py), off w/o a token & sample_rate
+PROFILER = {
+        # admin token: 'X-Profile: <token>' or ?profile=<token> profiles that
+        # request, & it's needed to read the profiles at /api/profiles
+        'token': environ.get('PROFILE_TOKEN'),
+        # fraction of all requests profiled w/o asking, keep it tiny
+        'sample_rate': 0,
+        # ring buffer of collapsed-stack files, shared by all worker procs
+        'dir': 'profiles',
+        'max_profiles': 100,
+        # heaviest stacks kept per profile
+        'max_stacks': 2000
+}
+# who the player is, once /auth is done
+AUTH = {
+        # 'session': flask's signed cookie session
+        # 'token': signed tokens w/ key rotation & revocation, see auth_token.py
+        'mode': environ.get('AUTH_MODE', 'session'),
+        # token signing keys as 'kid:secret,kid:secret', the 1st one signs new tokens
+        'keys': environ.get('AUTH_KEYS', f'k0:{SECRET_KEY}'),
+        # secs a token is valid for, renewed on use once half of it is gone
+        'ttl': 7*24*3600,
+        # cookie the token goes in (or 'Authorization: Bearer <token>')
+        'cookie': 'auth',
+        # secs between reloads of the revoked tokens from the db, 0: never
+        'revoked_sync': 30
+}
+# prefork multi-worker mode, see gunicorn.conf.py
+PREFORK = {
+        # worker procs, 0: 1 per cpu core
+        'workers': int(environ.get('WORKERS', 0)),
+        # threads per worker
+        'threads': 8,
+        'bind': environ.get('BIND', '127.0.0.1:5000'),
+        # secs a worker gets to finish its in-flight requests on shutdown
+        'graceful_timeout': 30
+}
+# async (ASGI) mode, see asgi.py
+ASGI = {
+        # threads running the sync flask routes (game blueprints, etc.)
+        'wsgi_threads': 32,
+        # secs before giving up on a discord api call
+        'http_timeout': 10
+}
+# per player game state (see game_state.py)
+GAME_STATE = {
+        # 'memory': in-process LRU, 'sqlite': shared by all worker procs
+        'backend': 'memory',
+        # secs since the last save before a player's state expires
+        'ttl': 2*24*3600,
+        # memory backend only
+        'max_entries': 10000,
+        # sqlite backend only
+        'path': 'game_state.sqlite3'
+}
+# daily reset job (see reset_job.py)
+RESET = {
+        # run the job on a background thread of the server
+        'run_in_server': True,
+        # secs between checks for a due reset
+        'check_every': 60,
+        # secs /api/rankings reuses the archived snapshot before checking for a newer one
+        'snapshot_ttl': 30
+}
+# write-behind buffer for end of game score writes (see score_buffer.py)
+SCORE_BUFFER = {
+        'enabled': True,
+        # secs between batched flushes to the db
+        'flush_every': 1.0,
+        # flush early once this many (player, game) scores are waiting
+        'max_pending': 500,
+        # append-only journal, 1 per proc: score_journal.<pid>.log
+        # None to go w/o
+        'journal': 'score_journal.log',
+        # on boot, replay & flush the journals of procs that are gone
+        # (gunicorn's master does it instead, see gunicorn.conf.py)
+        'recover': True,
+        # fsync every journal append, survives an OS crash too but slower
+        'fsync': False
+}
+# live leaderboard api (see /api/leaderboard in server.py)
+LEADERBOARD = {
+        # max players per page
+        'max_top': 100,
+        # max neighbours on either side for /me
+        'max_around': 10,
+        # secs clients & proxies can reuse a response w/o asking again
+        'max_age': 5,
+        # secs between reloads from the db so scores written by other worker
+        # procs show up, 0: never (1 proc), gunicorn.conf.py turns it on
+        'sync_every': 0
+}
 GAMES = [
         'minesweeper',
         'simon',
@@ -29,8 +175,14 @@ GAMES = [
 # adjustable game params
 MINESWEEPER = {
         'ndim': 8,
+        # == nmines
         'max_score': 10,
-        'rank_order': 'desc'
+        'rank_order': 'desc',
+        # for ndim ~100-1000: numpy board gen (pip install .[big_board])
+        # and the client only loads the board a viewport chunk at a time
+        'big_board': False,
+        # side of a viewport chunk [tiles]
+        'chunk': 32
 }
 SIMON = {
         'max_score': 20,
@@ -1,16 +1,33 @@
 # 'g' is a global obj with a runtime of a single request
-from flask import current_app, g
-from psycopg2.pool import SimpleConnectionPool
+import threading
+import time
+from contextlib import contextmanager
 
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from flask import current_app, g, jsonify
 
+import metrics
+
+
+'''
+Unit of work: a request holds ONE pooled conn (and so one txn) from its
+1st query until teardown, where it gets committed once (or rolled back if
+the request raised). Helpers never commit or return the conn themselves.
+Outside of a request, an app context is the unit of work:
+
+    with app.app_context():
+        db_utils.update_score(...)
+        db_utils.update_hscore(...)
+    # committed here
+'''
 def init_app(app):
-    app.db = SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
-            dsn=app.config['DB_URL']
-    )
-    # return connection after each request
+    app.db = BlockingPool(dsn=app.config['DB_URL'], **app.config['DB_POOL'])
+    # commit & return connection after each request
     app.teardown_appcontext(close_conn)
+    # pool exhaustion is backpressure, not a crash
+    app.register_error_handler(PoolTimeout, pool_timeout)
 
 
 def get_conn():
@@ -19,12 +36,227 @@ def get_conn():
     return g.conn
 
 
+# cursor on the request's conn, e.g. with db.cursor(RealDictCursor) as cur:
+# timed if the request is sampled, see metrics.py
+@contextmanager
+def cursor(cursor_factory=None):
+    with get_conn().cursor(cursor_factory=cursor_factory) as cur:
+        sample = metrics.sample()
+        yield cur if sample is None else TimedCursor(cur, sample)
+
+
+# adds the time of each query to the request's metrics sample, the rest
+# goes straight to the cursor
+class TimedCursor:
+    def __init__(self, cur, sample):
+        self._cur = cur
+        self._sample = sample
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return self._cur.execute(query, vars)
+        finally:
+            self._sample.add_query(time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return self._cur.executemany(query, vars_list)
+        finally:
+            self._sample.add_query(time.perf_counter() - start)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+# fn() runs once the request's txn is committed, and never if it's rolled
+# back, e.g. to update in-memory copies of what was written
+def after_commit(fn):
+    g.setdefault('after_commit', []).append(fn)
+
+
+# e: unhandled exception of the request, if any
 def close_conn(e=None):
     c = g.pop('conn', None)
-    if c is not None:
+    callbacks = g.pop('after_commit', [])
+    if c is None:
+        return
+    try:
+        if e is not None:
+            if not c.closed:
+                c.rollback()
+            return
+        start = time.perf_counter()
+        c.commit()
+        sample = metrics.sample()
+        if sample is not None:
+            sample.db += time.perf_counter() - start
+    finally:
         current_app.db.putconn(c)
+    for fn in callbacks:
+        fn()
 
 
 def close_all():
     if hasattr(current_app, 'db'):
         current_app.db.closeall()
+
+
+def pool_timeout(e):
+    r = jsonify(error='Server busy, try again')
+    r.headers['Retry-After'] = '1'
+    return r, 503
+
+
+# ================================ POOL ==================================
+class PoolTimeout(Exception):
+    pass
+
+
+'''
+Thread-safe replacement for psycopg2's SimpleConnectionPool (same
+getconn/putconn/closeall interface). When all maxconn conns are checked
+out, getconn() waits up to timeout secs for one to come back instead of
+raising PoolError. Idle conns are recycled after max_idle secs and pinged
+on checkout if they sat for longer than ping_after secs.
+'''
+class BlockingPool:
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5,
+                 max_idle=300, ping_after=30, statement_timeout=None):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.statement_timeout = statement_timeout
+        self.closed = False
+        # secs waited per checkout
+        self.wait = metrics.Histogram(metrics.FAST_BUCKETS)
+        # LIFO stack of (conn, last returned) so hot conns get reused
+        self._idle = []
+        # checked out + idle
+        self._nopen = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'wait_time': 0.0,
+            'in_use': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'recycled': 0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._nopen += 1
+
+    def _connect(self):
+        kwargs = {}
+        if self.statement_timeout:
+            kwargs['options'] = f'-c statement_timeout={self.statement_timeout}'
+        return psycopg2.connect(self.dsn, **kwargs)
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        conn, last_used = None, None
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise PoolError('connection pool is closed')
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                # room to open a new one (outside the lock)
+                if self._nopen < self.maxconn:
+                    self._nopen += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'no free db conn after {self.timeout}s')
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            waited = time.monotonic() - start
+            self._stats['wait_time'] += waited
+        self.wait.observe(waited)
+
+        try:
+            if conn is None:
+                return self._connect()
+            return self._validate(conn, last_used)
+        except psycopg2.Error:
+            # give the slot back so waiters aren't stuck on a dead conn
+            with self._cond:
+                self._nopen -= 1
+                self._stats['in_use'] -= 1
+                self._stats['errors'] += 1
+                self._cond.notify()
+            raise
+
+    # returns a usable conn, replacing it if closed, stale or unresponsive
+    def _validate(self, conn, last_used):
+        idle = time.monotonic() - last_used
+        if not conn.closed and idle < self.ping_after:
+            return conn
+        if not conn.closed and idle < self.max_idle:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('select 1;')
+                conn.rollback()
+                return conn
+            except psycopg2.Error:
+                with self._cond:
+                    self._stats['errors'] += 1
+        # dead or idle for too long
+        with self._cond:
+            self._stats['recycled'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        return self._connect()
+
+    def putconn(self, conn, close=False):
+        # never hand out a conn w/ a half-done txn
+        if not close and not conn.closed:
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        close = close or bool(conn.closed) or self.closed
+        if close:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        with self._cond:
+            self._stats['in_use'] -= 1
+            if close:
+                self._nopen -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            for conn, _ in self._idle:
+                conn.close()
+            self._nopen -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['open'] = self._nopen
+            stats['idle'] = len(self._idle)
+        stats['maxconn'] = self.maxconn
+        return stats
@@ -2,129 +2,252 @@ from flask import current_app
 from psycopg2.extras import RealDictCursor
 
 import db
+import leaderboard
 
 
-# ensures db is initialized for any API calls
-def init_games_db(game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                insert into games (id, max_score, rank_order)
-                values (%s, %s, %s)
-                on conflict (id) do nothing;
-            """, (game_id,
-                  current_app.config[game_id.upper()]['max_score'],
-                  current_app.config[game_id.upper()]['rank_order'])
-            )
-        conn.commit()
-    finally:
-        db.close_conn()
+# all helpers run on the request's conn and get committed once at
+# teardown (see db.py), so none of them commit or return the conn
 
+# the games rows are synced once at boot (see game_registry.py)
 
 def init_highscores_db(player_id, game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                insert into highscores (player_id, game_id)
-                values (%s, %s)
-                on conflict (player_id, game_id) do nothing;
-            """, (player_id, game_id)
-            )
-        conn.commit()
-    finally:
-        db.close_conn()
+    with db.cursor() as cur:
+        cur.execute("""
+            insert into highscores (player_id, game_id)
+            values (%s, %s)
+            on conflict (player_id, game_id) do nothing;
+        """, (player_id, game_id)
+        )
 
 
 def init_scores_db(player_id, game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
+    with db.cursor() as cur:
+        cur.execute("""
+            insert into scores (player_id, game_id)
+            values (%s, %s)
+            on conflict (player_id, game_id) do nothing;
+        """, (player_id, game_id)
+        )
+        if cur.rowcount:
+            leaderboard.stage(game_id, player_id, 0)
+
+
+# bootstraps a player for a game in one round trip:
+# upserts the highscores and scores rows, and reads back the
+# score from BEFORE the upsert (data-modifying CTEs share one snapshot)
+# so callers can still tell if the scores db got truncated
+# return: {'score': int or None, 'hscore': int}
+def enter_game(player_id, game_id, init=0):
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            with h as (
+                insert into highscores (player_id, game_id)
+                values (%(pid)s, %(gid)s)
+                on conflict (player_id, game_id) do nothing
+            ), s as (
                 insert into scores (player_id, game_id)
-                values (%s, %s)
-                on conflict (player_id, game_id) do nothing;
-            """, (player_id, game_id)
+                values (%(pid)s, %(gid)s)
+                on conflict (player_id, game_id) do nothing
             )
-        conn.commit()
-    finally:
-        db.close_conn()
+            select
+                (select score from scores
+                 where player_id = %(pid)s and game_id = %(gid)s) as score,
+                (select hscore from highscores
+                 where player_id = %(pid)s and game_id = %(gid)s) as hscore;
+        """, {'pid': player_id, 'gid': game_id})
+        row = cur.fetchone()
+    # new scores row, on the board w/ the default 0 like in the db
+    if row['score'] is None:
+        leaderboard.stage(game_id, player_id, 0)
+    # scores that are accepted but not flushed yet win over the db's
+    buf = getattr(current_app, 'score_buffer', None)
+    if buf is not None:
+        score, hscore = buf.pending(player_id, game_id)
+        if score is not None and row['score'] is not None:
+            row['score'] = score
+        if hscore is not None:
+            row['hscore'] = buf.best(game_id, row['hscore'], hscore)
+    # hscore is none until the 1st game is finished
+    if row['hscore'] is None:
+        row['hscore'] = init
+    return row
 
 
 # get highscore or init it
 def get_hscore(player_id, game_id, init=0):
-    conn = db.get_conn()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                select hscore from highscores
-                where player_id = %s and game_id = %s;
-            """, (player_id, game_id))
-            hscore = cur.fetchone()['hscore']
-            # server inits others so only hscore can be none
-            if hscore is None:
-                return init
-            return hscore
-    finally:
-        db.close_conn()
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            select hscore from highscores
+            where player_id = %s and game_id = %s;
+        """, (player_id, game_id))
+        hscore = cur.fetchone()['hscore']
+        # server inits others so only hscore can be none
+        if hscore is None:
+            return init
+        return hscore
 
 
 # update all-time high score
+# w/ the score buffer on, it's only buffered (see score_buffer.py)
 def update_hscore(hscore, player_id, game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE highscores
-                SET hscore = %s
-                WHERE player_id = %s AND game_id = %s;
-            """, (hscore, player_id, game_id))
-            conn.commit()
-    finally:
-        db.close_conn()
+    buf = getattr(current_app, 'score_buffer', None)
+    if buf is not None:
+        hscore = buf.add_hscore(player_id, game_id, hscore)
+        current_app.alltime_boards.set(game_id, player_id, hscore)
+        return
+    with db.cursor() as cur:
+        cur.execute("""
+            UPDATE highscores
+            SET hscore = %s
+            WHERE player_id = %s AND game_id = %s;
+        """, (hscore, player_id, game_id))
+        if cur.rowcount:
+            leaderboard.stage_hscore(game_id, player_id, hscore)
 
 
 # get daily score (default 0 already)
 def get_score(player_id, game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                select score from scores
-                where player_id = %s and game_id = %s;
-            """, (player_id, game_id))
-            row = cur.fetchone()
-            if row is None:
-                return
-            return row['score']
-    finally:
-        db.close_conn()
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            select score from scores
+            where player_id = %s and game_id = %s;
+        """, (player_id, game_id))
+        row = cur.fetchone()
+        if row is None:
+            return
+        return row['score']
 
 
 # update daily score
+# w/ the score buffer on, it's only buffered (see score_buffer.py)
 def update_score(score, player_id, game_id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE scores
-                SET score = %s
-                WHERE player_id = %s AND game_id = %s;
-            """, (score, player_id, game_id))
-            conn.commit()
-    finally:
-        db.close_conn()
+    buf = getattr(current_app, 'score_buffer', None)
+    if buf is not None:
+        score = buf.add_score(player_id, game_id, score)
+        current_app.leaderboards.set(game_id, player_id, score)
+        return
+    with db.cursor() as cur:
+        cur.execute("""
+            UPDATE scores
+            SET score = %s
+            WHERE player_id = %s AND game_id = %s;
+        """, (score, player_id, game_id))
+        if cur.rowcount:
+            leaderboard.stage(game_id, player_id, score)
+
+
+# records a finished game in 1 statement: sets the daily score and only
+# raises (or lowers, for rank_order 'asc') the all-time highscore if the
+# score beats it, so 2 tabs finishing at once can't overwrite a better one
+# hscore: last known highscore, only used w/ the score buffer on since
+#         that path never reads the db
+# return: {'score': int or None, 'hscore': int} as stored
+#         (score is none if the scores row is gone, e.g. after a reset)
+def record_game(score, player_id, game_id, hscore=None):
+    buf = getattr(current_app, 'score_buffer', None)
+    if buf is not None:
+        daily = buf.add_score(player_id, game_id, score)
+        best = buf.best(game_id, hscore, buf.add_hscore(player_id, game_id, score))
+        current_app.leaderboards.set(game_id, player_id, daily)
+        current_app.alltime_boards.set(game_id, player_id, best)
+        return {'score': daily, 'hscore': best}
+
+    asc = current_app.games.rank_order(game_id) == 'asc'
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            with s as (
+                update scores
+                set score = %(score)s
+                where player_id = %(pid)s and game_id = %(gid)s
+                returning score
+            ), h as (
+                insert into highscores (player_id, game_id, hscore)
+                values (%(pid)s, %(gid)s, %(score)s)
+                on conflict (player_id, game_id) do update
+                set hscore = case
+                    when highscores.hscore is null then excluded.hscore
+                    when %(asc)s then least(highscores.hscore, excluded.hscore)
+                    else greatest(highscores.hscore, excluded.hscore)
+                end
+                returning hscore
+            )
+            select
+                (select score from s) as score,
+                (select hscore from h) as hscore;
+        """, {'score': score, 'pid': player_id, 'gid': game_id, 'asc': asc})
+        row = cur.fetchone()
+    if row['score'] is not None:
+        leaderboard.stage(game_id, player_id, row['score'])
+    leaderboard.stage_hscore(game_id, player_id, row['hscore'])
+    return row
 
 
 # reset time only exists if user successfully auth'd
 def get_reset_time():
-    conn = db.get_conn()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("select time from reset_time;")
-            row = cur.fetchone()
-            if row is not None:
-                return row['time']
-    finally:
-        db.close_conn()
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("select time from reset_time;")
+        row = cur.fetchone()
+        if row is not None:
+            return row['time']
+
+
+# ------------------------------ history ---------------------------------
+# all read from the archive written by the daily reset (see reset_job.py)
+
+# a player's last `days` days of a game, newest 1st
+# return: [{day, score, rank}]
+def get_history(player_id, game_id, days=30):
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            select day, score, rank from score_history
+            where player_id = %s and game_id = %s
+              and day >= current_date - %s
+            order by day desc;
+        """, (player_id, game_id, days))
+        return cur.fetchall()
+
+
+# streaks count consecutive reset periods a player played the game in
+# current: streak ending at the latest period, 0 if they missed it
+# return: {current, longest, average}, average over every day played
+def get_player_stats(player_id, game_id):
+    with db.cursor(RealDictCursor) as cur:
+        # period is a serial, so it can skip (e.g. a rolled back reset),
+        # islands are over each period's position in reset_log instead
+        cur.execute("""
+            with p as (
+                select period, row_number() over (order by period) as n
+                from reset_log
+            ), h as (
+                select
+                    s.period,
+                    s.score,
+                    p.n - row_number() over (order by s.period) as island
+                from score_history s
+                join p on p.period = s.period
+                where s.player_id = %s and s.game_id = %s
+            ), streaks as (
+                select max(period) as last, count(*) as len
+                from h
+                group by island
+            )
+            select
+                coalesce((select len from streaks
+                          where last = (select max(period) from reset_log)), 0) as current,
+                coalesce((select max(len) from streaks), 0) as longest,
+                (select avg(score)::float from h) as average;
+        """, (player_id, game_id))
+        return cur.fetchone()
+
+
+# everyone's daily average of a game over the last `days` days, newest 1st
+# return: [{day, nplayers, average}]
+def get_daily_averages(game_id, days=30):
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            select day, nplayers, average from daily_stats
+            where game_id = %s
+              and day >= current_date - %s
+            order by day desc;
+        """, (game_id, days))
+        return cur.fetchall()
@@ -0,0 +1,178 @@
+# native
+import random
+import threading
+import time
+# extra
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+# custom
+import config
+from metrics import Histogram
+
+
+'''
+Shared client for the discord api. One requests.Session w/ a pooled,
+keep-alive adapter so logins and token refreshes reuse TLS conns instead
+of handshaking w/ discord.com every time. Every call gets a timeout and is
+retried w/ exponential backoff on 429/5xx (honouring Retry-After) or if
+the conn couldn't be made. Non-idempotent calls (the token POSTs, which
+use up a one-time code or rotate the refresh token) only get retried if
+discord never saw them: the conn failed or a 429. Latency per endpoint
+(incl. retries) goes into a histogram, see stats().
+'''
+_session = None
+_lock = threading.Lock()
+# path -> Histogram
+latency = {}
+counters = {'retries': 0, 'errors': 0}
+_counters_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                cfg = config.DISCORD_HTTP
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=cfg['pool_size'],
+                                      pool_maxsize=cfg['pool_size'])
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                _session = s
+    return _session
+
+
+def incr(name):
+    with _counters_lock:
+        counters[name] += 1
+
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# secs to wait before retry #attempt+1, None to give up
+def retry_delay(r, attempt):
+    cfg = config.DISCORD_HTTP
+    if r is not None and 'Retry-After' in r.headers:
+        try:
+            delay = float(r.headers['Retry-After'])
+        except ValueError:
+            delay = None
+        if delay is not None:
+            # not worth holding the request for that long
+            return delay if delay <= cfg['max_retry_after'] else None
+    # full jitter so a burst of clients doesn't retry in lockstep
+    return random.uniform(0, cfg['backoff'] * 2**attempt)
+
+
+# true if the request failed before any of it was sent
+def never_sent(e):
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+# idempotent: False if a repeat could do something different, e.g. a 2nd
+#             exchange of the same OAuth code
+# return: decoded json body, raises requests.HTTPError on a final 4xx/5xx
+def request(method, path, idempotent=True, **kwargs):
+    cfg = config.DISCORD_HTTP
+    url = f'{config.API_ENDPOINT}{path}'
+    start = time.perf_counter()
+    try:
+        for attempt in range(cfg['retries'] + 1):
+            last = attempt == cfg['retries']
+            try:
+                r = get_session().request(method, url, timeout=cfg['timeout'], **kwargs)
+            # read timeouts aren't retried at all, discord could've already
+            # acted on it. a conn dropped mid request only if it's idempotent
+            except requests.ConnectionError as e:
+                retry = not last and (idempotent or never_sent(e))
+                delay = retry_delay(None, attempt) if retry else None
+                if delay is None:
+                    incr('errors')
+                    raise
+            else:
+                if r.status_code != 429 and (r.status_code < 500 or not idempotent):
+                    break
+                delay = None if last else retry_delay(r, attempt)
+                if delay is None:
+                    break
+            incr('retries')
+            time.sleep(delay)
+        if not r.ok:
+            incr('errors')
+        r.raise_for_status()
+        return r.json()
+    finally:
+        hist = latency.get(path)
+        if hist is None:
+            hist = latency.setdefault(path, Histogram())
+        hist.observe(time.perf_counter() - start)
+
+
+"""
+return:
+{
+    access_token: ...
+    token_type: 'Bearer'
+    expires_in: 604800  #secs (7 days)
+    refresh_token: ...
+    scope: 'identify'
+}
+"""
+def exchange_code(code):
+    # redirect_uri needs to match exactly with the one in the dev page
+    # url will get encoded since sending thru body as data
+    data = {'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': config.REDIR_URI
+    }
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    return request('POST', '/oauth2/token',
+                   idempotent=False,
+                   data=data,
+                   headers=headers,
+                   auth=(config.CLIENT_ID, config.CLIENT_SECRET)
+    )
+
+
+# return: identical to exchange_code()
+def refresh_token(refresh_token):
+    data = {'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
+    }
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    return request('POST', '/oauth2/token',
+                   idempotent=False,
+                   data=data,
+                   headers=headers,
+                   auth=(config.CLIENT_ID, config.CLIENT_SECRET)
+    )
+
+
+"""
+return:
+{
+    id: ...
+    username: ...
+    discriminator: digit that differentiations users w/ same username
+    ...
+}
+"""
+def get_user_deets(access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    return request('GET', '/users/@me', headers=headers)
+
+
+# return: {path: histogram snapshot, ...} + retry/error counters
+def stats():
+    with _counters_lock:
+        c = dict(counters)
+    return {'latency': {path: h.snapshot() for path, h in latency.items()}, **c}
@@ -0,0 +1,81 @@
+# extra
+from psycopg2.extras import execute_values
+# custom
+import db
+import leaderboard
+
+
+'''
+Static per game metadata (max_score, rank_order), built once at boot from
+config.GAMES & the per game config dicts and synced to the games table in
+1 statement, so requests read it from memory instead of upserting or
+reading the games table every time.
+
+    current_app.games.max_score(game_id)
+    current_app.games.rank_order(game_id)
+    game_id in current_app.games
+
+After changing a game's config at runtime (e.g. from a shell):
+    app.games.refresh(app)
+
+Per worker process, each one syncs the same rows at boot.
+'''
+def init_app(app):
+    app.games = GameRegistry()
+    app.games.refresh(app)
+
+
+class GameRegistry:
+    def __init__(self):
+        # game_id -> {max_score, rank_order}
+        self.games = {}
+
+    def __contains__(self, game_id):
+        return game_id in self.games
+
+    def __iter__(self):
+        return iter(self.games)
+
+    def max_score(self, game_id):
+        return self.games[game_id]['max_score']
+
+    def rank_order(self, game_id):
+        return self.games[game_id]['rank_order']
+
+    # {game_id: max_score}
+    def max_scores(self):
+        return {gid: g['max_score'] for gid, g in self.games.items()}
+
+    # {game_id: rank_order}
+    def rank_orders(self):
+        return {gid: g['rank_order'] for gid, g in self.games.items()}
+
+    # (re)reads every game from app.config & upserts the changed ones
+    # if a rank_order changed, the live boards & the score buffer get it too
+    def refresh(self, app):
+        games = {gid: {'max_score': app.config[gid.upper()]['max_score'],
+                       'rank_order': app.config[gid.upper()]['rank_order']}
+                 for gid in app.config['GAMES']}
+        with app.app_context():
+            with db.cursor() as cur:
+                execute_values(cur, """
+                    insert into games (id, max_score, rank_order)
+                    values %s
+                    on conflict (id) do update
+                    set max_score = excluded.max_score,
+                        rank_order = excluded.rank_order
+                    where (games.max_score, games.rank_order)
+                          is distinct from (excluded.max_score, excluded.rank_order);
+                """, [(gid, g['max_score'], g['rank_order']) for gid, g in games.items()])
+        old = self.rank_orders()
+        # swapped in whole, so readers never see half a refresh
+        self.games = games
+        if old and old != self.rank_orders():
+            self._reorder(app)
+
+    # the boards are sorted by rank_order, so they're rebuilt from the db
+    def _reorder(self, app):
+        if hasattr(app, 'leaderboards'):
+            leaderboard.init_app(app)
+        if getattr(app, 'score_buffer', None) is not None:
+            app.score_buffer.rank_orders = self.rank_orders()
@@ -0,0 +1,166 @@
+# native
+import copy
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+# extra
+from flask import current_app, g, session
+# custom
+import metrics
+
+
+'''
+Server-side game state, keyed by (player, game), e.g. a player's
+minesweeper board or simon sequence. The cookie session only keeps who the
+player is, and a request only loads (and saves back) the state of the
+game(s) it touches instead of every game's state at once.
+
+    st = game_state.get(gid)
+    st['board'] = ...
+    # saved after the request, only if it succeeded & st changed
+'''
+def init_app(app):
+    cfg = app.config['GAME_STATE']
+    if cfg['backend'] == 'memory':
+        app.game_state = MemoryStore(cfg['max_entries'], cfg['ttl'])
+    elif cfg['backend'] == 'sqlite':
+        app.game_state = SQLiteStore(cfg['path'], cfg['ttl'])
+    else:
+        raise ValueError(f"Unknown game state backend: {cfg['backend']}")
+    app.after_request(save_all)
+
+
+def key(player_id, game_id):
+    return f'{player_id}:{game_id}'
+
+
+# state of the logged in player for game_id, loaded at most once per request
+def get(game_id):
+    if 'game_state' not in g:
+        g.game_state = {}
+    k = key(session['id'], game_id)
+    if k not in g.game_state:
+        start = time.perf_counter()
+        st = current_app.game_state.get(k) or {}
+        # what it was, so read-only requests (polls, /chunk) don't write it back
+        g.game_state[k] = (st, dumps(st))
+        metrics.observe_sampled('game_state_load_seconds', start)
+    return g.game_state[k][0]
+
+
+# ~a memcpy even for big boards, unlike a write to the store
+def dumps(st):
+    return pickle.dumps(st, pickle.HIGHEST_PROTOCOL)
+
+
+# flask runs this after an unhandled error too (w/ the 500), so that's
+# skipped here & the stored state stays what it was before the request
+def save_all(response):
+    states = g.pop('game_state', None)
+    if not states or response.status_code >= 500:
+        return response
+    start = time.perf_counter()
+    for k, (st, loaded) in states.items():
+        if dumps(st) != loaded:
+            current_app.game_state.set(k, st)
+    metrics.observe_sampled('game_state_save_seconds', start)
+    return response
+
+
+# ============================== BACKENDS ================================
+'''
+In-process LRU w/ a TTL. Holds the state dicts themselves so there's no
+(de)serialization, but get() hands out a deep copy, so a request that
+fails halfway doesn't leave its changes in the store. It's per worker
+process, so only for a single process deployment.
+'''
+class MemoryStore:
+    def __init__(self, max_entries=10000, ttl=2*24*3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expires_at, state), oldest used 1st
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        with self._lock:
+            entry = self._data.get(k)
+            if entry is None:
+                return
+            if entry[0] <= time.monotonic():
+                del self._data[k]
+                return
+            self._data.move_to_end(k)
+            state = entry[1]
+        return copy.deepcopy(state)
+
+    def set(self, k, state):
+        with self._lock:
+            self._data[k] = (time.monotonic() + self.ttl, state)
+            self._data.move_to_end(k)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, k):
+        with self._lock:
+            self._data.pop(k, None)
+
+
+'''
+SQLite file shared by every worker process on the machine (WAL mode so
+readers don't block the writer). Each thread gets its own conn.
+'''
+class SQLiteStore:
+    # purge expired rows every ~N writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path='game_state.sqlite3', ttl=2*24*3600):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as conn:
+            conn.execute("""
+                create table if not exists game_state (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # a forked worker can't reuse its parent's conn
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('pragma journal_mode=wal;')
+            conn.execute('pragma synchronous=normal;')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, k):
+        row = self._conn().execute("""
+            select value from game_state
+            where key = ? and expires_at > ?;
+        """, (k, time.time())).fetchone()
+        if row is not None:
+            return pickle.loads(row[0])
+
+    def set(self, k, state):
+        conn = self._conn()
+        conn.execute("""
+            insert into game_state values (?, ?, ?)
+            on conflict (key) do update
+            set value = excluded.value,
+                expires_at = excluded.expires_at;
+        """, (k, pickle.dumps(state, pickle.HIGHEST_PROTOCOL), time.time() + self.ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("delete from game_state where expires_at <= ?;", (time.time(),))
+
+    def delete(self, k):
+        self._conn().execute("delete from game_state where key = ?;", (k,))
@@ -0,0 +1,240 @@
+import struct
+
+# only needed for vectorized big board gen
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+'''
+Compact minesweeper board. Each cell is 1 bit in each of the mines,
+revealed and flagged bitsets plus a 4-bit neighbour mine count (0-8),
+2 per byte, so an 8x8 board is 8+8+8+32 bytes instead of 3 nested lists.
+Cells are indexed row-major, k = i*ndim + j.
+
+It also keeps a running count of unrevealed safe cells so the win check
+is O(1). to_bytes()/from_bytes() are plain slices, cheap enough to do per
+request.
+'''
+# ndim, nsafe_left
+HEADER = struct.Struct('<HI')
+
+
+class Board:
+    __slots__ = ('ndim', 'nsafe_left', 'mines', 'revealed', 'flagged', 'counts')
+
+    def __init__(self, ndim, nsafe_left=None, mines=None, revealed=None,
+                 flagged=None, counts=None):
+        n = ndim * ndim
+        nbytes = (n + 7) // 8
+        self.ndim = ndim
+        # unrevealed non-mine cells
+        self.nsafe_left = n if nsafe_left is None else nsafe_left
+        self.mines = bytearray(nbytes) if mines is None else mines
+        self.revealed = bytearray(nbytes) if revealed is None else revealed
+        self.flagged = bytearray(nbytes) if flagged is None else flagged
+        # nibble array, even k in the low nibble
+        self.counts = bytearray((n + 1) // 2) if counts is None else counts
+
+    # ------------------------- (de)serialization ---------------------------
+    def to_bytes(self):
+        return b''.join((HEADER.pack(self.ndim, self.nsafe_left),
+                         self.mines, self.revealed, self.flagged, self.counts))
+
+    @classmethod
+    def from_bytes(cls, data):
+        ndim, nsafe_left = HEADER.unpack_from(data)
+        n = ndim * ndim
+        nbytes = (n + 7) // 8
+        view = memoryview(data)[HEADER.size:]
+        parts = []
+        for size in (nbytes, nbytes, nbytes, (n + 1) // 2):
+            parts.append(bytearray(view[:size]))
+            view = view[size:]
+        return cls(ndim, nsafe_left, *parts)
+
+    # --------------------------- cell access -----------------------------
+    def in_bounds(self, i, j):
+        return 0 <= i < self.ndim and 0 <= j < self.ndim
+
+    def is_mine(self, i, j):
+        return get_bit(self.mines, i*self.ndim + j)
+
+    def is_revealed(self, i, j):
+        return get_bit(self.revealed, i*self.ndim + j)
+
+    def is_flagged(self, i, j):
+        return get_bit(self.flagged, i*self.ndim + j)
+
+    def set_mine(self, i, j):
+        k = i*self.ndim + j
+        if not get_bit(self.mines, k):
+            set_bit(self.mines, k, True)
+            if not get_bit(self.revealed, k):
+                self.nsafe_left -= 1
+
+    # return: True if it wasn't revealed yet
+    def reveal(self, i, j):
+        k = i*self.ndim + j
+        if get_bit(self.revealed, k):
+            return False
+        set_bit(self.revealed, k, True)
+        if not get_bit(self.mines, k):
+            self.nsafe_left -= 1
+        return True
+
+    # moves the mine at src to the non-mine dst, fixing up the counts
+    def move_mine(self, src, dst):
+        i, j = src
+        set_bit(self.mines, i*self.ndim + j, False)
+        self.nsafe_left += 1
+        for r, c in self.neighbours(i, j):
+            if not self.is_mine(r, c):
+                self.set_count(r, c, self.count(r, c) - 1)
+        self.set_count(i, j, sum(self.is_mine(r, c) for r, c in self.neighbours(i, j)))
+
+        r0, c0 = dst
+        self.set_mine(r0, c0)
+        for r, c in self.neighbours(r0, c0):
+            if not self.is_mine(r, c):
+                self.set_count(r, c, self.count(r, c) + 1)
+
+    def set_flag(self, i, j, flag):
+        set_bit(self.flagged, i*self.ndim + j, flag)
+
+    # neighbouring mine count
+    def count(self, i, j):
+        k = i*self.ndim + j
+        b = self.counts[k >> 1]
+        return b >> 4 if k & 1 else b & 0xF
+
+    def set_count(self, i, j, v):
+        k = i*self.ndim + j
+        b = self.counts[k >> 1]
+        if k & 1:
+            self.counts[k >> 1] = (b & 0x0F) | (v << 4)
+        else:
+            self.counts[k >> 1] = (b & 0xF0) | v
+
+    # what the old list board held: -1 for mines, else the count
+    def num(self, i, j):
+        return -1 if self.is_mine(i, j) else self.count(i, j)
+
+    def neighbours(self, i, j):
+        for r in range(max(i-1, 0), min(i+2, self.ndim)):
+            for c in range(max(j-1, 0), min(j+2, self.ndim)):
+                if r != i or c != j:
+                    yield r, c
+
+    # ------------------------------ bulk ---------------------------------
+    # reveals (i, j) and floods out from empty tiles (no neighbouring mines),
+    # never thru flags. iterative w/ an explicit stack of flat indices so big
+    # boards can't hit the recursion limit. tiles get marked when pushed so
+    # each one is visited once.
+    # return: newly revealed (r, c), [] if (i, j) was revealed or flagged
+    def flood_reveal(self, i, j):
+        n = self.ndim
+        mines, revealed, flagged, counts = self.mines, self.revealed, self.flagged, self.counts
+        k = i*n + j
+        if (revealed[k >> 3] | flagged[k >> 3]) >> (k & 7) & 1:
+            return []
+        revealed[k >> 3] |= 1 << (k & 7)
+        new = []
+        stack = [k]
+        while stack:
+            k = stack.pop()
+            new.append(k)
+            if mines[k >> 3] >> (k & 7) & 1:
+                continue
+            count = counts[k >> 1] >> 4 if k & 1 else counts[k >> 1] & 0xF
+            # '0' is empty tile
+            if count:
+                continue
+            r, c = divmod(k, n)
+            for nr in range(max(r-1, 0), min(r+2, n)):
+                for nc in range(max(c-1, 0), min(c+2, n)):
+                    nk = nr*n + nc
+                    if not (revealed[nk >> 3] | flagged[nk >> 3]) >> (nk & 7) & 1:
+                        revealed[nk >> 3] |= 1 << (nk & 7)
+                        stack.append(nk)
+        self.nsafe_left -= sum(1 for k in new if not mines[k >> 3] >> (k & 7) & 1)
+        return [divmod(k, n) for k in new]
+
+    def revealed_coords(self):
+        return [divmod(k, self.ndim) for k in iter_bits(self.revealed, self.ndim**2)]
+
+    def flagged_coords(self):
+        return [divmod(k, self.ndim) for k in iter_bits(self.flagged, self.ndim**2)]
+
+    def nflagged_mines(self):
+        return (to_int(self.mines) & to_int(self.flagged)).bit_count()
+
+    # every non-mine tile is revealed
+    def all_safe_revealed(self):
+        return self.nsafe_left == 0
+
+
+# ------------------------------ bitsets ---------------------------------
+def get_bit(bits, k):
+    return bool(bits[k >> 3] >> (k & 7) & 1)
+
+
+def set_bit(bits, k, v):
+    if v:
+        bits[k >> 3] |= 1 << (k & 7)
+    else:
+        bits[k >> 3] &= ~(1 << (k & 7)) & 0xFF
+
+
+def to_int(bits):
+    return int.from_bytes(bits, 'little')
+
+
+# indices of set bits < n
+def iter_bits(bits, n):
+    for byte_i, b in enumerate(bits):
+        while b:
+            low = b & -b
+            k = (byte_i << 3) + low.bit_length() - 1
+            if k < n:
+                yield k
+            b ^= low
+
+
+# --------------------------- big boards -------------------------------
+'''
+Vectorized board gen for big boards (100x100 and up), needs numpy.
+Picks nmines distinct cells, then gets every cell's neighbour count in
+one go as a 3x3 box sum over the zero-padded mine mask.
+rng: numpy Generator, fresh entropy if None
+'''
+def random_board(ndim, nmines, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    n = ndim * ndim
+    picks = rng.choice(n, size=nmines, replace=False)
+    mask = np.zeros(n, dtype=np.uint8)
+    mask[picks] = 1
+    mask = mask.reshape(ndim, ndim)
+
+    padded = np.pad(mask, 1)
+    counts = np.zeros((ndim, ndim), dtype=np.uint8)
+    for dr in range(3):
+        for dc in range(3):
+            if dr != 1 or dc != 1:
+                counts += padded[dr:dr+ndim, dc:dc+ndim]
+    # counts of mines themselves are never read
+    counts[mask == 1] = 0
+
+    flat = counts.ravel()
+    if n & 1:
+        flat = np.append(flat, 0)
+    nibbles = flat[0::2] | (flat[1::2] << 4)
+    nbytes = (n + 7) // 8
+    return Board(ndim,
+                 n - nmines,
+                 bytearray(np.packbits(mask.ravel(), bitorder='little').tobytes()),
+                 bytearray(nbytes),
+                 bytearray(nbytes),
+                 bytearray(nibbles.astype(np.uint8).tobytes()))
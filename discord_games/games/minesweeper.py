@@ -1,5 +1,7 @@
+import struct
 from os import path
-from random import sample
+from random import Random
+from secrets import token_hex
 
 from flask import Blueprint, session, request, jsonify
 from psycopg2.extras import RealDictCursor
@@ -7,6 +9,9 @@ from psycopg2.extras import RealDictCursor
 import config
 import db
 import db_utils
+import game_state
+import puzzles
+from games.board import Board, random_board, np
 
 
 # game id
@@ -16,124 +21,296 @@ mines_bp = Blueprint(f'{gid}', __name__, url_prefix=f'/{gid}')
 # game params
 ndim = config.MINESWEEPER['ndim']
 nmines = config.MINESWEEPER['max_score']
+# big boards get sent a chunk at a time
+big_board = config.MINESWEEPER['big_board']
+chunk = config.MINESWEEPER['chunk']
+
+
+# move log record: kind, r, c, num (reveals only)
+MOVE = struct.Struct('<BHHb')
+# FLOOD: big boards only, a whole click's reveal as 1 record at the
+# clicked tile, clients reload their viewport thru /chunk instead
+REVEAL, FLAG, UNFLAG, FLOOD = 0, 1, 2, 3
 
 
 # --------------- helper ------------------
-def reset_state():
-    session['board'] = [[0 for _ in range(ndim)] for _ in range(ndim)]
-    session['revealed'] = [[False for _ in range(ndim)] for _ in range(ndim)]
-    session['flagged'] = [[False for _ in range(ndim)] for _ in range(ndim)]
-    session['mines'] = []
-    session['nflags'] = nmines
-    session['finished'][gid] = False
+# board is kept as bytes in the game state, see games/board.py
+def reset_state(st):
+    st['seed'] = puzzles.seed(gid)
+    st['board'] = Board(ndim).to_bytes()
+    st['nflags'] = nmines
+    st['finished'] = False
+    st['moves'] = bytearray()
+    # [r, c] of the mine that ended the game
+    st['tripped'] = None
+    # new every reset, so a version from yesterday's board never matches
+    st['epoch'] = token_hex(4)
+
+
+'''
+Append-only log of the day's board changes, packed MOVE records.
+The version the client has seen is '<epoch>.<nr of records>', so a client
+w/ version e.N only needs the records after N (see /changes), as long as
+it's still the same board (epoch e).
+'''
+def log_move(st, kind, r, c, num=0):
+    st.setdefault('moves', bytearray()).extend(MOVE.pack(kind, r, c, num))
+
+
+def nmoves(st):
+    return len(st.get('moves', b'')) // MOVE.size
+
+
+def version(st):
+    return f"{st.get('epoch', '0')}.{nmoves(st)}"
+
+
+# return: nr of records the client w/ version v has seen, None if it's
+#         not a version of the current board
+def parse_version(st, v):
+    epoch, _, n = v.partition('.')
+    if epoch != st.get('epoch', '0') or not n.isdigit() or int(n) > nmoves(st):
+        return
+    return int(n)
+
 
+# return: [(kind, r, c, num)] since version
+def read_moves(st, since):
+    return list(MOVE.iter_unpack(st.get('moves', b'')[since*MOVE.size:]))
 
-# generate mine coords excluding start tile
-def gen_mines(nmines, ndim, safe_tile):
+
+'''
+Reveals from the clicked tile, saves the board & logs the reveal.
+A flood on a big board can be ~all of its tiles, so it's 1 FLOOD record
+and the client only gets how many & where instead of every tile.
+return: what goes in the response, {revealed} or {nrevealed, bbox}
+'''
+def save_reveal(st, board, i, j):
+    coords = flood_reveal(i, j, board)
+    st['board'] = board.to_bytes()
+    if big_board:
+        log_move(st, FLOOD, i, j)
+        return dict(nrevealed=len(coords), bbox=bounding_box(coords))
+
+    revealed_tiles = to_tiles(coords, board)
+    for t in revealed_tiles:
+        log_move(st, REVEAL, t['r'], t['c'], t['num'])
+    return dict(revealed=revealed_tiles)
+
+
+# return: [r0, c0, r1, c1] (inclusive) around coords, None if empty
+def bounding_box(coords):
+    if not coords:
+        return
+    rows = [r for r, _ in coords]
+    cols = [c for _, c in coords]
+    return [min(rows), min(cols), max(rows), max(cols)]
+
+
+# generate mine coords
+# rng: random.Random
+def gen_mines(nmines, ndim, rng):
     coords = [(i,j) for i in range(ndim) for j in range(ndim)]
-    coords.remove(safe_tile)
-    return sample(coords, nmines)
+    return rng.sample(coords, nmines)
+
+
+# today's board, same for everyone, see puzzles.py
+# big boards get generated w/ numpy (if installed)
+@puzzles.builder(gid)
+def build_layout(seed):
+    if big_board and np is not None:
+        board = random_board(ndim, nmines, rng=np.random.default_rng(seed))
+    else:
+        board = Board(ndim)
+        init_board(gen_mines(nmines, ndim, Random(seed)), board)
+    return board.to_bytes()
 
 
 def init_board(mines, board):
     for mine in mines:
         i,j = mine
-        # mines are '-1'
-        board[i][j] = -1
+        board.set_mine(i, j)
         # loop thru all 8 neighbours of each mine
         # and incr mine counter to all neighbouring non-mines
-        for r in range(max(i-1, 0), min(i+2, ndim)):
-            for c in range(max(j-1, 0), min(j+2, ndim)):
-                if board[r][c] != -1:
-                    board[r][c] += 1
+        for r, c in board.neighbours(i, j):
+            if not board.is_mine(r, c):
+                board.set_count(r, c, board.count(r, c) + 1)
+
+
+# return: [[r, c]] of the tripped mine, [] if none
+def tripped(st):
+    return [st['tripped']] if st.get('tripped') else []
 
 
 # score == nmines correctly flagged
-def tally_score(mines, flagged):
-    score = 0
-    for (i,j) in mines:
-        if flagged[i][j]:
-            score += 1
-    return score
-
-
-def reveal_tiles(i, j, board, revealed, flagged):
-    flood_reveal(i, j, board, revealed, flagged)
-    return [
-        {"r": r, "c": c, "num": board[r][c]}
-        for r, row in enumerate(revealed)
-        for c, is_revealed in enumerate(row)
-        if is_revealed
-    ]
-
-
-# flood reveal empty tiles (no neighbouring mines)
-def flood_reveal(i, j, board, revealed, flagged):
-    # do nothing if already revealed or flagged
-    if revealed[i][j] or flagged[i][j]:
-        return
-    revealed[i][j] = True
-    # '0' is empty tile
-    if board[i][j] == 0:
-        for r in range(max(i-1, 0), min(i+2, ndim)):
-            for c in range(max(j-1, 0), min(j+2, ndim)):
-                if r == i and c == j:
-                    continue
-                if flagged[r][c]:
-                    continue
-                flood_reveal(r, c, board, revealed, flagged)
+def tally_score(board):
+    return board.nflagged_mines()
+
+
+# ends the game & records its score, the server's own tally so the client
+# never gets to say what it scored
+# return: hscore after
+def finish(st, score):
+    st['finished'] = True
+    # daily score + hscore if it's beaten, in 1 statement
+    st['hscore'] = db_utils.record_game(score, session['id'], gid, st['hscore'])['hscore']
+    return st['hscore']
+
+
+# return: [{"r", "c", "num"}] for the client
+def to_tiles(coords, board):
+    return [{"r": r, "c": c, "num": board.num(r, c)} for r, c in coords]
+
+
+# flood reveal empty tiles (no neighbouring mines), see Board.flood_reveal
+# return: newly revealed (r, c) in reveal order
+def flood_reveal(i, j, board):
+    return board.flood_reveal(i, j)
 
 
 # only need to check if all non-mine tiles are revealed
 # b/c win is checked after if mine was tripped
-def won(board, revealed):
-    for i in range(ndim):
-        for j in range(ndim):
-            if board[i][j] == -1:
-                continue
-            if not revealed[i][j]:
-                return False
-    return True
+# O(1), the board keeps count of unrevealed safe tiles
+def won(board):
+    return board.all_safe_revealed()
+
+
+# parses & bounds checks the clicked tile
+# return: ((i, j), None) or (None, error response)
+def parse_choice(choice):
+    if not isinstance(choice, list) or len(choice) != 2:
+        return None, (jsonify(error="Coordinate must be a list of size 2"), 400)
+    try:
+        i,j = map(int, choice)  # ensure coordinates are integers
+    except ValueError:
+        return None, (jsonify(error="Coordinate must be a pair of integers"), 400)
+    if not (0 <= i < ndim and 0 <= j < ndim):
+        return None, (jsonify(error="Coordinate out of bounds"), 400)
+    return (i,j), None
 
 
 # ---------------- main -------------------
 '''
 Called on page load/reload.
 Either resets the board to a fresh state or restores board state from today.
+Only sends the revealed tiles & flags (sparse). The board is everyone's
+for the day, so the mines never get sent, only the one that was tripped.
 '''
 @mines_bp.route('/init', methods=['GET'])
 def init():
+    st = game_state.get(gid)
     # only reset if 1st time loading for the day
     # else finished stays True so verify() does nothing
-    if not session['played'][gid]:
-        reset_state()
+    if not st['played']:
+        reset_state(st)
 
     # else load prev board state
-    session['score'][gid] = db_utils.get_score(session['id'], gid)
-    session['hscore'][gid] = db_utils.get_hscore(session['id'], gid)
-    return jsonify(ndim=ndim,
-                   nmines=nmines,
-                   board=session['board'],
-                   revealed=session['revealed'],
-                   flagged=session['flagged'],
-                   mines=session['mines'],
-                   nflags=session['nflags'],
-                   score=session['score'][gid],
-                   hscore=session['hscore'][gid],
-                   played=session['played'][gid],
-                   finished=session['finished'][gid])
+    row = db_utils.enter_game(session['id'], gid)
+    # 0 if the scores db got truncated since /play
+    st['score'] = row['score'] or 0
+    st['hscore'] = row['hscore']
+    state = dict(ndim=ndim,
+                 nmines=nmines,
+                 big_board=big_board,
+                 nflags=st['nflags'],
+                 score=st['score'],
+                 hscore=st['hscore'],
+                 played=st['played'],
+                 finished=st['finished'],
+                 version=version(st))
+    # client loads the board thru /chunk instead
+    if big_board:
+        return jsonify(chunk=chunk, **state)
+
+    board = Board.from_bytes(st['board'])
+    return jsonify(revealed=to_tiles(board.revealed_coords(), board),
+                   flagged=board.flagged_coords(),
+                   mines=tripped(st),
+                   **state)
+
+
+'''
+Board changes since the client's version, e.g. from another tab.
+since: version the client last saw
+return: revealed tiles, flags w/ their latest state [r, c, on], nflags
+        and the current version. resync if since isn't a version of
+        this board (new day), then the client should just /init again.
+        reload if there was a
+        big board flood, then the client should reload its viewport.
+'''
+@mines_bp.route('/changes', methods=['GET'])
+def get_changes():
+    st = game_state.get(gid)
+    since = parse_version(st, request.args.get('since', ''))
+    if since is None:
+        return jsonify(resync=True)
+
+    revealed = []
+    flags = {}
+    reload = False
+    for kind, r, c, num in read_moves(st, since):
+        if kind == REVEAL:
+            revealed.append({"r": r, "c": c, "num": num})
+        elif kind == FLOOD:
+            reload = True
+        else:
+            flags[(r, c)] = kind == FLAG
+    return jsonify(resync=False,
+                   version=version(st),
+                   revealed=revealed,
+                   reload=reload,
+                   flagged=[[r, c, on] for (r, c), on in flags.items()],
+                   nflags=st.get('nflags', nmines),
+                   finished=st.get('finished', False))
+
+
+'''
+Big board mode only: the board a viewport at a time.
+r, c: top left tile of the chunk
+Only the tripped mine gets sent, see init().
+'''
+@mines_bp.route('/chunk', methods=['GET'])
+def get_chunk():
+    r0 = request.args.get('r', 0, type=int)
+    c0 = request.args.get('c', 0, type=int)
+    if not (0 <= r0 < ndim and 0 <= c0 < ndim):
+        return jsonify(error="Coordinate out of bounds"), 400
+
+    st = game_state.get(gid)
+    board = Board.from_bytes(st['board'])
+    rows = range(r0, min(r0+chunk, ndim))
+    cols = range(c0, min(c0+chunk, ndim))
+    tiles, flags = [], []
+    for r in rows:
+        for c in cols:
+            if board.is_revealed(r, c):
+                tiles.append({"r": r, "c": c, "num": board.num(r, c)})
+            elif board.is_flagged(r, c):
+                flags.append([r, c])
+    mines = [m for m in tripped(st) if m[0] in rows and m[1] in cols]
+    return jsonify(r=r0, c=c0, tiles=tiles, flags=flags, mines=mines)
 
 
 '''
 Only called on the 1st move of the day.
-The 1st tile clicked becomes safe and is excluded in mine coord gen.
-session['played'][gid] = True here so unfinished boards don't get reset.
+Loads today's board, and if the 1st tile clicked is a mine, the mine
+gets moved to the 1st free tile from the top left so it's still the
+same board for everyone else.
+st['played'] = True here so unfinished boards don't get reset.
+return: the board, w/ any flags placed before the 1st click
 '''
-def start(safe_tile):
+def start(st, board, safe_tile):
+    new = Board.from_bytes(puzzles.layout(gid, st['seed']))
     # start tile is always safe
-    session['mines'] = gen_mines(nmines, ndim, safe_tile)
-    init_board(session['mines'], session['board'])
-    session['played'][gid] = True
+    if new.is_mine(*safe_tile):
+        for k in range(ndim*ndim):
+            tile = divmod(k, ndim)
+            if tile != safe_tile and not new.is_mine(*tile):
+                new.move_mine(safe_tile, tile)
+                break
+    new.flagged = board.flagged
+    st['played'] = True
+    return new
 
 
 '''
@@ -141,89 +318,76 @@ Called after every tile click.
 '''
 @mines_bp.route('/verify', methods=['POST'])
 def verify():
+    st = game_state.get(gid)
     # clicks do nothing once game done
-    if session['finished'][gid]:
+    if st['finished']:
         return jsonify(status='finished')
 
-    choice = request.json.get("choice")
-    if not isinstance(choice, list) or len(choice) != 2:
-        return jsonify(error="Coordinate must be a list of size 2"), 400
-    try:
-        i,j = map(int, choice)  # ensure coordinates are integers
-    except ValueError:
-        return jsonify(error="Coordinate must be a pair of integers"), 400
+    tile, err = parse_choice(request.json.get("choice"))
+    if err:
+        return err
+    i,j = tile
 
-    board = session['board']
-    revealed = session['revealed']
-    flagged = session['flagged']
+    board = Board.from_bytes(st['board'])
 
     # if 1st time playing for the day, start
-    if not session['played'][gid]:
-        start(tuple(choice))
-        revealed_tiles = reveal_tiles(i, j, board, revealed, flagged)
-        return jsonify(status='started', revealed=revealed_tiles)
+    if not st['played']:
+        board = start(st, board, tile)
+        revealed = save_reveal(st, board, i, j)
+        return jsonify(status='started', version=version(st), **revealed)
 
     # order matters!
     # clicked flag, do nothing
-    if flagged[i][j]:
+    if board.is_flagged(i, j):
         return jsonify(status='flagged')
 
     # clicked mine, game over
-    mines = session['mines']
-    if (i,j) in mines:
-        session['finished'][gid] = True
-        score = tally_score(mines, flagged)
-        return jsonify(status='game_over', mines=mines, score=score)
+    if board.is_mine(i, j):
+        st['tripped'] = [i, j]
+        score = tally_score(board)
+        hscore = finish(st, score)
+        return jsonify(status='game_over', mines=tripped(st), score=score, hscore=hscore)
 
     # else flood reveal tiles if necessary EXCEPT flags & mines
-    revealed_tiles = reveal_tiles(i, j, board, revealed, flagged)
+    revealed = save_reveal(st, board, i, j)
 
     # check win after revealing
-    if won(board, revealed):
-        session['finished'][gid] = True
-        return jsonify(status='won', revealed=revealed_tiles, score=nmines)
+    if won(board):
+        hscore = finish(st, nmines)
+        return jsonify(status='won', score=nmines, hscore=hscore, version=version(st), **revealed)
 
-    return jsonify(status='continue', revealed=revealed_tiles)
+    return jsonify(status='continue', version=version(st), **revealed)
 
 
 @mines_bp.route('/flag', methods=['POST'])
 def toggle_flag():
+    st = game_state.get(gid)
     # stop responding after gg
-    if session['finished'][gid]:
+    if st['finished']:
         return jsonify(status='finished')
 
-    choice = request.json.get("choice")
-    if not isinstance(choice, list) or len(choice) != 2:
-        return jsonify(error="Coordinate must be a list of size 2"), 400
-    try:
-        i,j = map(int, choice)  # ensure coordinates are integers
-    except ValueError:
-        return jsonify(error="Coordinate must be a pair of integers"), 400
+    tile, err = parse_choice(request.json.get("choice"))
+    if err:
+        return err
+    i,j = tile
 
-    flagged = session['flagged']
-    nflags = session['nflags']
+    board = Board.from_bytes(st['board'])
+    nflags = st['nflags']
     # if flagged, unflag and incr counter
-    if (flagged[i][j]):
-        flagged[i][j] = False
+    if board.is_flagged(i, j):
+        board.set_flag(i, j, False)
+        log_move(st, UNFLAG, i, j)
         nflags += 1
     # else, vice versa but dont decr if nflags == 0
     else:
         if (nflags == 0):
             return jsonify(toggle=False)
-        flagged[i][j] = True
+        board.set_flag(i, j, True)
+        log_move(st, FLAG, i, j)
         nflags -= 1
 
-    session['flagged'][i][j] = flagged[i][j]
-    session['nflags'] = nflags
-    return jsonify(toggle=True, nflags=nflags)
-
-
-@mines_bp.route('/update', methods=['POST'])
-def update_scores():
-    score = request.json.get('score')
-    if score > session['hscore'][gid]:
-        db_utils.update_hscore(score, session['id'], gid)
-    db_utils.update_score(score, session['id'], gid)
-    return jsonify(status='success')
+    st['board'] = board.to_bytes()
+    st['nflags'] = nflags
+    return jsonify(toggle=True, nflags=nflags, version=version(st))
 
 
@@ -1,10 +1,12 @@
 from os import path
-from random import randint
+from random import Random
 from flask import Blueprint, session, request, jsonify
 from psycopg2.extras import RealDictCursor
 import config
 import db
 import db_utils
+import game_state
+import puzzles
 
 # game id
 gid = path.splitext(path.basename(__file__))[0]
@@ -15,17 +17,36 @@ max_turn = config.NUM_GUESS['max_score']
 
 
 # --------------- helper ------------------
-def reset_state():
-    session['ans'] = randint(1, 100)
-    session['score'][gid] = 1
+def reset_state(st):
+    st['seed'] = puzzles.seed(gid)
+    st['score'] = 1
+    st['finished'] = False
+
+
+# today's answer, same for everyone, see puzzles.py
+@puzzles.builder(gid)
+def build_ans(seed):
+    return Random(seed).randint(1, 100)
 
 
 # ---------------- main -------------------
+'''
+Called on page load/reload.
+Only a new game on the 1st load of the day, after that it picks up where
+it was (the answer is the same all day, so a restart would be a free
+retry), and a finished game stays finished until the reset.
+'''
 @guess_bp.route('/start', methods=['GET'])
 def start():
-    reset_state()
-    session['hscore'][gid] = db_utils.get_hscore(session['id'], gid, init=max_turn)
-    return jsonify(max_turn=max_turn, hscore=session['hscore'][gid])
+    st = game_state.get(gid)
+    if not st['played']:
+        reset_state(st)
+        st['played'] = True
+    st['hscore'] = db_utils.enter_game(session['id'], gid, init=max_turn)['hscore']
+    return jsonify(max_turn=max_turn,
+                   score=st['score'],
+                   hscore=st['hscore'],
+                   finished=st['finished'])
 
 
 @guess_bp.route('/verify', methods=['POST'])
@@ -36,25 +57,29 @@ def verify_guess():
     if guess < 1 or guess > 100:
         return jsonify(error='Guess should be between 1-100'), 400
 
-    ans = session['ans']
-    score = session['score'][gid]
+    st = game_state.get(gid)
+    # 1 scored game a day
+    if st['finished']:
+        return jsonify(status='finished')
+    ans = puzzles.layout(gid, st['seed'])
+    score = st['score']
     # game over if not correct on max_turn
     # [0, max_turn) amount of tries
     if guess == ans or score == max_turn:
-        # update daily score
-        db_utils.update_score(score, session['id'], gid)
-        hscore = session['hscore'][gid]
+        st['finished'] = True
         if guess == ans:
-            # a lower score is better, so update hscore
-            if score < hscore:
-                hscore = score
-                db_utils.update_hscore(hscore, session['id'], gid)
+            # daily score + hscore if it's lower (better), in 1 statement
+            hscore = db_utils.record_game(score, session['id'], gid, st['hscore'])['hscore']
+            st['hscore'] = hscore
             return jsonify(status='win', hscore=hscore, final=score)
+        # a loss never counts towards the hscore, only the daily score
+        db_utils.update_score(score, session['id'], gid)
         # score is 'X'/max_turn on client side
-        return jsonify(status='game_over', ans=ans, hscore=hscore)
+        # no ans, it's everyone else's answer too until the reset
+        return jsonify(status='game_over', hscore=st['hscore'])
     # else continue to next turn
     score += 1
-    session['score'][gid] = score
+    st['score'] = score
     if guess < ans:
         return jsonify(status='continue', hint='higher', score=score)
     else:
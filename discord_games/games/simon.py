@@ -1,5 +1,5 @@
 from os import path
-from random import choice
+from random import Random
 
 from flask import Blueprint, session, request, jsonify
 from psycopg2.extras import RealDictCursor
@@ -7,6 +7,8 @@ from psycopg2.extras import RealDictCursor
 import config
 import db
 import db_utils
+import game_state
+import puzzles
 
 
 # game id
@@ -20,11 +22,18 @@ colours = ["r", "g", "b", "o"]
 
 
 # --------------- helper ------------------
-def reset_state():
-    session['sequence'] = [choice(colours) for _ in range(max_seq)]
-    session['turn_num'] = 0
-    session['user_turn'] = False
-    session['finished'][gid] = False
+def reset_state(st):
+    st['seed'] = puzzles.seed(gid)
+    st['turn_num'] = 0
+    st['user_turn'] = False
+    st['finished'] = False
+
+
+# today's sequence, same for everyone, see puzzles.py
+@puzzles.builder(gid)
+def build_sequence(seed):
+    rng = Random(seed)
+    return tuple(rng.choice(colours) for _ in range(max_seq))
 
 
 # ---------------- main -------------------
@@ -34,59 +43,63 @@ def reset_state():
 # not that POST is infallable since all the info is still visible to men-in-the-middle
 @simon_bp.route('/init', methods=['GET'])
 def init():
-    if not session['played'][gid]:
-        reset_state()
+    st = game_state.get(gid)
+    if not st['played']:
+        reset_state(st)
 
-    session['score'][gid] = db_utils.get_score(session['id'], gid)
-    session['hscore'][gid] = db_utils.get_hscore(session['id'], gid)
-    return jsonify(user_turn=session['user_turn'],
-                   score=session['score'][gid],
-                   hscore=session['hscore'][gid],
-                   played=session['played'][gid],
-                   finished=session['finished'][gid])
+    row = db_utils.enter_game(session['id'], gid)
+    # 0 if the scores db got truncated since /play
+    st['score'] = row['score'] or 0
+    st['hscore'] = row['hscore']
+    return jsonify(user_turn=st['user_turn'],
+                   score=st['score'],
+                   hscore=st['hscore'],
+                   played=st['played'],
+                   finished=st['finished'])
 
 
 @simon_bp.route('/start', methods=['POST'])
 def start():
-    session['played'][gid] = True
+    game_state.get(gid)['played'] = True
     return jsonify(None)
 
 
 # the current score gives the max turn num
 @simon_bp.route('/get_sequence', methods=['POST'])
 def get_sequence():
-    if session['user_turn']:
+    st = game_state.get(gid)
+    # 1 scored game a day, the rest of the sequence stays hidden
+    if st['finished']:
+        return jsonify(error='Already played today'), 400
+    if st['user_turn']:
         return jsonify(error='Should be house turn'), 400
-    session['user_turn'] = True
-    seq = session['sequence']
-    score = session['score'][gid]
+    st['user_turn'] = True
+    seq = puzzles.layout(gid, st['seed'])
+    score = st['score']
     return jsonify(sequence=seq[:score+1])
 
 
 # state change driver using status
 @simon_bp.route('/verify', methods=['POST'])
 def verify_choice():
-    if not session['user_turn']:
+    st = game_state.get(gid)
+    if not st['user_turn']:
         return jsonify(error='Should be user turn'), 400
 
     colour = request.json.get('choice')
     if colour not in colours:
         return jsonify(error='Unexpected choice'), 400
 
-    turn_num = session['turn_num']
-    score = session['score'][gid]
+    turn_num = st['turn_num']
+    score = st['score']
 
     # game over
-    if colour != session['sequence'][turn_num]:
-        session['user_turn'] = False
-        session['finished'][gid] = True
-        hscore = session['hscore'][gid]
-        # only update hscore if ending score > hscore
-        if score > hscore:
-            hscore = score
-            db_utils.update_hscore(hscore, session['id'], gid)
-        # update daily score
-        db_utils.update_score(score, session['id'], gid)
+    if colour != puzzles.layout(gid, st['seed'])[turn_num]:
+        st['user_turn'] = False
+        st['finished'] = True
+        # daily score + hscore if it's beaten, in 1 statement
+        hscore = db_utils.record_game(score, session['id'], gid, st['hscore'])['hscore']
+        st['hscore'] = hscore
         return jsonify(status='game_over', hscore=hscore, score=score)
 
     # success
@@ -94,13 +107,13 @@ def verify_choice():
     # if last possible turn, continue to next round
     # better than turn_num > score if they somehow get out of sync
     if turn_num == score+1:
-        session['user_turn'] = False
+        st['user_turn'] = False
         # reset and incr score by 1
-        session['turn_num'] = 0
-        session['score'][gid] = turn_num
+        st['turn_num'] = 0
+        st['score'] = turn_num
         return jsonify(status='continue', score=turn_num)
     # else goto next colour in seq
-    session['turn_num'] = turn_num
+    st['turn_num'] = turn_num
     return jsonify(status='next')
 
 
@@ -0,0 +1,114 @@
+'''
+Prefork multi-worker deployment mode (gunicorn), needs the 'prefork' extras:
+
+    pip install .[prefork]
+    cd discord_games && SECRET_KEY=... PUZZLE_SECRET=... WORKERS=4 gunicorn server:app
+
+gunicorn picks this file up from the cwd, settings are in PREFORK in
+config.py. Terminate TLS in front of it (nginx, caddy, ...).
+
+The master applies the schema migrations and flushes score journals left
+behind by a crashed run once, then forks. There's no preload_app, so each
+worker imports server.py itself after the fork: its db pool, leaderboards,
+score buffer and background threads are all its own, no conn ever gets
+shared across a fork.
+
+What the workers have to agree on:
+    - session cookies/auth tokens & puzzle seeds: SECRET_KEY (& AUTH_KEYS)
+      & PUZZLE_SECRET, from the env or else made up once here in the
+      master & inherited
+    - game state: the sqlite backend instead of a per proc LRU
+    - leaderboards: reloaded from the db every LEADERBOARD['sync_every']
+    - score journals: 1 per worker, flushed by the master if it dies
+
+SIGTERM/SIGINT: workers stop accepting, finish their in-flight requests
+(up to graceful_timeout secs), then flush their score buffer and close
+their pools. SIGHUP: same, but w/ fresh workers taking over.
+'''
+# native
+import os
+from contextlib import contextmanager
+# extra
+from flask import Flask
+# custom
+# not `import config`, gunicorn would take it for its own config setting
+from config import GAME_STATE, LEADERBOARD, PREFORK, SCORE_BUFFER
+import db
+import game_registry
+import migrate
+import score_buffer
+
+
+bind = PREFORK['bind']
+workers = PREFORK['workers'] or os.cpu_count()
+worker_class = 'gthread'
+threads = PREFORK['threads']
+graceful_timeout = PREFORK['graceful_timeout']
+# each worker imports the app (& opens its db pool) after the fork
+preload_app = False
+
+# config is imported here in the master, so every worker inherits these
+# (the dicts are config's own, changed in place)
+if workers > 1:
+    # a per proc LRU would lose a player's game once their next request
+    # lands on another worker
+    if GAME_STATE['backend'] == 'memory':
+        GAME_STATE['backend'] = 'sqlite'
+    if not LEADERBOARD['sync_every']:
+        LEADERBOARD['sync_every'] = 2
+# the master recovers dead workers' journals, not 2 booting workers at once
+SCORE_BUFFER['recover'] = False
+
+
+# short lived app for the master's own db work
+@contextmanager
+def master_app():
+    app = Flask('prefork')
+    app.config.from_object('config')
+    db.init_app(app)
+    try:
+        yield app
+    finally:
+        with app.app_context():
+            db.close_all()
+
+
+def on_starting(server):
+    for name in ('SECRET_KEY', 'PUZZLE_SECRET'):
+        if name not in os.environ:
+            server.log.warning(f'{name} not set, logins & puzzles change on every restart')
+    with master_app() as app:
+        migrate.init_app(app)
+        journal = SCORE_BUFFER['journal']
+        if journal:
+            game_registry.init_app(app)
+            # not the ones of another master's workers that are still up
+            for path in score_buffer.stale_journals(journal):
+                score_buffer.recover(app, app.games.rank_orders(), path)
+
+
+# in the worker, once it's done serving
+def worker_exit(server, worker):
+    app = getattr(worker, 'wsgi', None)
+    if app is None:
+        return
+    # already imported by server.py
+    import discord_api
+    if app.score_buffer is not None:
+        app.score_buffer.close()
+    discord_api.close()
+    with app.app_context():
+        db.close_all()
+
+
+# in the master, whenever a worker is gone (crashed or not)
+def child_exit(server, worker):
+    journal = SCORE_BUFFER['journal']
+    if not journal:
+        return
+    journal = score_buffer.worker_journal(journal, worker.pid)
+    if journal not in score_buffer.find_journals(journal):
+        return
+    with master_app() as app:
+        game_registry.init_app(app)
+        score_buffer.recover(app, app.games.rank_orders(), journal)
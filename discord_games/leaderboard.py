@@ -0,0 +1,253 @@
+# native
+import threading
+import time
+from secrets import token_hex
+# extra
+from flask import current_app
+from psycopg2.extras import RealDictCursor
+from sortedcontainers import SortedList
+# custom
+import db
+
+
+'''
+In-memory daily leaderboards, 1 per game, so rankings don't need a
+window query over the whole scores table. Postgres stays the source of
+truth: db_utils writes the scores table as usual and the boards only get
+the change once the request's txn commits (see db.after_commit). On boot
+they're warm started from the scores table, and they're cleared when
+/api/rankings truncates it. The all-time boards are the same thing over
+the highscores table.
+
+    boards = current_app.leaderboards    (or current_app.alltime_boards)
+    boards.rank(game_id, player_id)  -> dense rank, 1 is best
+    boards.top(game_id, k)           -> [{id, score, rank}]
+
+Per worker process, like game_state's memory backend. W/ several worker
+procs, LEADERBOARD['sync_every'] reloads them from the db every few secs
+so the other workers' scores show up too (see sync()).
+'''
+def init_app(app):
+    rank_orders = app.games.rank_orders()
+    app.leaderboards = Leaderboards(rank_orders)
+    app.alltime_boards = Leaderboards(rank_orders)
+    daily, alltime = read_boards(app)
+    app.leaderboards.load(daily)
+    app.alltime_boards.load(alltime)
+    every = app.config['LEADERBOARD']['sync_every']
+    # init_app runs again if a rank_order changes, 1 sync thread is enough
+    if every and not hasattr(app, 'leaderboard_sync'):
+        app.leaderboard_sync = start_sync(app, every)
+
+
+# return: (daily rows, all-time rows), both [{game_id, player_id, score}]
+def read_boards(app):
+    games = list(app.games)
+    with app.app_context():
+        with db.cursor(RealDictCursor) as cur:
+            cur.execute("""
+                select game_id, player_id, score from scores
+                where score is not null and game_id = any(%s);
+            """, (games,))
+            daily = cur.fetchall()
+            # hscore is null until the 1st game is finished
+            cur.execute("""
+                select game_id, player_id, hscore as score from highscores
+                where hscore is not null and game_id = any(%s);
+            """, (games,))
+            alltime = cur.fetchall()
+    return daily, alltime
+
+
+'''
+Swaps in boards reloaded from the db, plus this proc's buffered scores
+that aren't in the db yet. Eventually consistent: another worker's score
+shows up within sync_every (+ SCORE_BUFFER's flush_every) secs, and a
+daily reset by another worker clears these boards on the next sync.
+'''
+def sync(app):
+    daily, alltime = read_boards(app)
+    buf = getattr(app, 'score_buffer', None)
+    if buf is not None:
+        scores, hscores = buf.snapshot()
+        daily = overlay(daily, scores, lambda gid, old, new: new, only_existing=True)
+        alltime = overlay(alltime, hscores, buf.best)
+    app.leaderboards.replace(daily)
+    app.alltime_boards.replace(alltime)
+
+
+# rows w/ pending {(player_id, game_id): score} merged in by pick(game_id, old, new)
+# only_existing: skip pending scores whose row isn't in the db (anymore)
+def overlay(rows, pending, pick, only_existing=False):
+    merged = {(r['player_id'], r['game_id']): r['score'] for r in rows}
+    for k, score in pending.items():
+        if k in merged or not only_existing:
+            merged[k] = pick(k[1], merged.get(k), score)
+    return [{'game_id': gid, 'player_id': pid, 'score': score}
+            for (pid, gid), score in merged.items()]
+
+
+def start_sync(app, every):
+    def loop():
+        while True:
+            time.sleep(every)
+            try:
+                sync(app)
+            except Exception:
+                app.logger.exception('leaderboard sync failed')
+    t = threading.Thread(target=loop, name='leaderboard-sync', daemon=True)
+    t.start()
+    return t
+
+
+# score of player_id in game_id's daily board after the txn commits
+def stage(game_id, player_id, score):
+    boards = current_app.leaderboards
+    db.after_commit(lambda: boards.set(game_id, player_id, score))
+
+
+# same for the all-time board
+def stage_hscore(game_id, player_id, hscore):
+    boards = current_app.alltime_boards
+    db.after_commit(lambda: boards.set(game_id, player_id, hscore))
+
+
+'''
+Scores of 1 game, ordered by rank_order ('asc': lowest score is best).
+entries: (key, player_id) sorted, key is the score negated for 'desc'
+keys: distinct keys, so dense rank == nr of better keys + 1
+Updates, rank lookups and top-k are all O(log n) (+k).
+'''
+class Leaderboard:
+    def __init__(self, rank_order='desc'):
+        self.desc = rank_order == 'desc'
+        # player_id -> score
+        self.scores = {}
+        self.entries = SortedList()
+        self.keys = SortedList()
+        # key -> nr of players w/ that key
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def key(self, score):
+        return -score if self.desc else score
+
+    def set(self, player_id, score):
+        self.remove(player_id)
+        k = self.key(score)
+        self.scores[player_id] = score
+        self.entries.add((k, player_id))
+        if k not in self.counts:
+            self.counts[k] = 0
+            self.keys.add(k)
+        self.counts[k] += 1
+
+    def remove(self, player_id):
+        score = self.scores.pop(player_id, None)
+        if score is None:
+            return
+        k = self.key(score)
+        self.entries.remove((k, player_id))
+        self.counts[k] -= 1
+        if self.counts[k] == 0:
+            del self.counts[k]
+            self.keys.remove(k)
+
+    # return: dense rank or None if not on the board
+    def rank(self, player_id):
+        score = self.scores.get(player_id)
+        if score is None:
+            return
+        return self.keys.bisect_left(self.key(score)) + 1
+
+    # return: k [{id, score, rank}] from the start-th best, all if k is None
+    def top(self, k=None, start=0):
+        players = []
+        rank = 0
+        last = None
+        stop = None if k is None else start + k
+        for key, pid in self.entries.islice(start, stop):
+            if key != last:
+                rank = self.keys.bisect_left(key) + 1 if last is None else rank + 1
+                last = key
+            players.append({'id': pid, 'score': self.scores[pid], 'rank': rank})
+        return players
+
+    # return: player_id and up to n players on either side of it,
+    #         [] if not on the board
+    def around(self, player_id, n):
+        score = self.scores.get(player_id)
+        if score is None:
+            return []
+        i = self.entries.index((self.key(score), player_id))
+        start = max(i - n, 0)
+        return self.top(i - start + n + 1, start)
+
+
+'''
+All games' boards behind 1 lock, flask serves requests on threads.
+Each board has a version that goes up on every change, so
+(epoch, version) can be used as an ETag. epoch is random per process so
+a restart never reuses an old ETag.
+'''
+class Leaderboards:
+    def __init__(self, rank_orders):
+        self.rank_orders = rank_orders
+        self.boards = {gid: Leaderboard(order) for gid, order in rank_orders.items()}
+        self.epoch = token_hex(4)
+        self.versions = dict.fromkeys(rank_orders, 0)
+        self._lock = threading.Lock()
+
+    def __contains__(self, game_id):
+        return game_id in self.boards
+
+    # rows: [{game_id, player_id, score}]
+    def load(self, rows):
+        with self._lock:
+            for r in rows:
+                self.boards[r['game_id']].set(r['player_id'], r['score'])
+                self.versions[r['game_id']] += 1
+
+    # rows: [{game_id, player_id, score}], everything there is
+    # only the boards that changed get swapped & a new version (ETag)
+    def replace(self, rows):
+        boards = {gid: Leaderboard(order) for gid, order in self.rank_orders.items()}
+        for r in rows:
+            boards[r['game_id']].set(r['player_id'], r['score'])
+        with self._lock:
+            for gid, b in boards.items():
+                if b.scores != self.boards[gid].scores:
+                    self.boards[gid] = b
+                    self.versions[gid] += 1
+
+    def set(self, game_id, player_id, score):
+        with self._lock:
+            self.boards[game_id].set(player_id, score)
+            self.versions[game_id] += 1
+
+    def version(self, game_id):
+        return f'{self.epoch}.{self.versions[game_id]}'
+
+    def size(self, game_id):
+        with self._lock:
+            return len(self.boards[game_id])
+
+    def rank(self, game_id, player_id):
+        with self._lock:
+            return self.boards[game_id].rank(player_id)
+
+    def top(self, game_id, k=None, start=0):
+        with self._lock:
+            return self.boards[game_id].top(k, start)
+
+    def around(self, game_id, player_id, n):
+        with self._lock:
+            return self.boards[game_id].around(player_id, n)
+
+    def clear(self):
+        with self._lock:
+            self.boards = {gid: Leaderboard(order) for gid, order in self.rank_orders.items()}
+            for gid in self.versions:
+                self.versions[gid] += 1
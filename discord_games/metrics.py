@@ -0,0 +1,258 @@
+# native
+import random
+import threading
+import time
+from bisect import bisect_left
+# extra
+from flask import current_app, g, request
+from flask.sessions import SessionInterface
+
+
+# upper bounds [secs], prometheus style (each bucket counts v <= le)
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# for in-process & db timings, mostly well under a ms
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+# nr of queries per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name -> (help, buckets) of the histograms kept in Registry
+FAMILIES = {
+    'http_request_duration_seconds':
+        ('Request latency by route, incl. session load/save & the db commit', FAST_BUCKETS),
+    'db_queries_per_request':
+        ('Queries per request (sampled)', COUNT_BUCKETS),
+    'db_time_per_request_seconds':
+        ('Time in db queries & the commit per request (sampled)', FAST_BUCKETS),
+    'db_query_duration_seconds':
+        ('Time per db query (sampled)', FAST_BUCKETS),
+    'session_load_seconds':
+        ('Time to load the login session (sampled)', FAST_BUCKETS),
+    'session_save_seconds':
+        ('Time to save the login session (sampled)', FAST_BUCKETS),
+    'game_state_load_seconds':
+        ('Time to load a game state (sampled)', FAST_BUCKETS),
+    'game_state_save_seconds':
+        ('Time to save the request\'s game states (sampled)', FAST_BUCKETS),
+}
+
+# environ keys
+SAMPLE = 'discord_games.metrics_sample'
+ROUTE = 'discord_games.route'
+
+
+# thread-safe latency histogram w/ fixed buckets, O(log buckets) per observe
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        # last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, v):
+        i = bisect_left(self.buckets, v)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += v
+            self.count += 1
+
+    # return: {'buckets': {le: cumulative count}, 'sum': float, 'count': int}
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, n = self.sum, self.count
+        cumulative = {}
+        running = 0
+        for le, c in zip(self.buckets + ('+Inf',), counts):
+            running += c
+            cumulative[str(le)] = running
+        return {'buckets': cumulative, 'sum': total, 'count': n}
+
+
+'''
+Request-level instrumentation, served at /metrics in prometheus text
+format (per proc, so behind gunicorn each scrape sees 1 worker's).
+
+Always on, a couple of perf_counter calls & 1 histogram update each:
+    - latency per route/method/status, timed around the whole wsgi call
+    - db pool wait per checkout (BlockingPool.wait)
+Only on METRICS['sample_rate'] of the requests, which carry a Sample:
+    - db queries & time per request, thru db.TimedCursor, & per query
+    - login session load/save, game state load/save
+
+So a slow /minesweeper/verify splits into db, session & game state time,
+and the rest is the route itself (e.g. the flood fill).
+'''
+def init_app(app):
+    cfg = app.config['METRICS']
+    if not cfg['enabled']:
+        app.metrics = None
+        return
+    app.metrics = Registry(cfg['sample_rate'])
+    app.wsgi_app = Middleware(app.wsgi_app, app.metrics)
+    app.session_interface = TimedSessionInterface(app.session_interface)
+    app.before_request(start_request)
+
+
+class Registry:
+    def __init__(self, sample_rate=0.1):
+        self.sample_rate = sample_rate
+        # (name, labels) -> Histogram
+        self.hists = {}
+
+    # labels: tuple of (name, value) pairs
+    def observe(self, name, v, labels=()):
+        hist = self.hists.get((name, labels))
+        if hist is None:
+            hist = self.hists.setdefault((name, labels), Histogram(FAMILIES[name][1]))
+        hist.observe(v)
+
+
+# what a sampled request spent where, only touched by its own thread
+class Sample:
+    def __init__(self, registry):
+        self.registry = registry
+        self.queries = 0
+        self.db = 0.0
+
+    def add_query(self, secs):
+        self.queries += 1
+        self.db += secs
+        self.registry.observe('db_query_duration_seconds', secs)
+
+
+class Middleware:
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        sample = None
+        if random.random() < self.registry.sample_rate:
+            sample = environ[SAMPLE] = Sample(self.registry)
+        status = []
+
+        def record_status(s, headers, exc_info=None):
+            status.append(s[:3])
+            return start_response(s, headers, exc_info)
+        try:
+            return self.wsgi_app(environ, record_status)
+        finally:
+            labels = (('route', environ.get(ROUTE, 'unmatched')),
+                      ('method', environ['REQUEST_METHOD']),
+                      ('status', status[-1] if status else '500'))
+            self.registry.observe('http_request_duration_seconds',
+                                  time.perf_counter() - start, labels)
+            if sample is not None:
+                self.registry.observe('db_queries_per_request', sample.queries)
+                self.registry.observe('db_time_per_request_seconds', sample.db)
+
+
+# url rule (not the path) so the label set stays small
+def start_request():
+    request.environ[ROUTE] = request.url_rule.rule if request.url_rule else 'unmatched'
+    sample = request.environ.get(SAMPLE)
+    if sample is not None:
+        g.metrics = sample
+
+
+# Sample of the current request, None if it's not sampled (or not a request)
+def sample():
+    return g.get('metrics')
+
+
+# observes the secs since start into name, only on sampled requests
+def observe_sampled(name, start):
+    if 'metrics' in g:
+        current_app.metrics.observe(name, time.perf_counter() - start)
+
+
+# times whichever session interface the app ends up w/ (e.g. auth_token's)
+class TimedSessionInterface(SessionInterface):
+    def __init__(self, inner):
+        self.inner = inner
+
+    def open_session(self, app, request):
+        if SAMPLE not in request.environ:
+            return self.inner.open_session(app, request)
+        start = time.perf_counter()
+        s = self.inner.open_session(app, request)
+        app.metrics.observe('session_load_seconds', time.perf_counter() - start)
+        return s
+
+    def make_null_session(self, app):
+        return self.inner.make_null_session(app)
+
+    def is_null_session(self, obj):
+        return self.inner.is_null_session(obj)
+
+    def save_session(self, app, session, response):
+        if SAMPLE not in request.environ:
+            return self.inner.save_session(app, session, response)
+        start = time.perf_counter()
+        self.inner.save_session(app, session, response)
+        app.metrics.observe('session_save_seconds', time.perf_counter() - start)
+
+
+def escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def fmt_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+# series: [(labels, Histogram)]
+def render_histogram(out, name, help, series):
+    out.append(f'# HELP {name} {help}')
+    out.append(f'# TYPE {name} histogram')
+    for labels, hist in series:
+        snap = hist.snapshot()
+        for le, n in snap['buckets'].items():
+            out.append(f'{name}_bucket{fmt_labels(labels + (("le", le),))} {n}')
+        out.append(f'{name}_sum{fmt_labels(labels)} {snap["sum"]}')
+        out.append(f'{name}_count{fmt_labels(labels)} {snap["count"]}')
+
+
+# kind: 'gauge' or 'counter', series: [(labels, value)]
+def render_simple(out, name, kind, help, series):
+    out.append(f'# HELP {name} {help}')
+    out.append(f'# TYPE {name} {kind}')
+    for labels, v in series:
+        out.append(f'{name}{fmt_labels(labels)} {v}')
+
+
+# return: everything above + the db pool & discord api stats, in
+#         prometheus text format
+def render(app):
+    # already imported by server.py
+    import discord_api
+
+    out = []
+    hists = sorted(app.metrics.hists.items())
+    for name, (help, _) in FAMILIES.items():
+        series = [(labels, hist) for (n, labels), hist in hists if n == name]
+        if series:
+            render_histogram(out, name, help, series)
+
+    render_histogram(out, 'db_pool_wait_seconds', 'Wait for a free db conn per checkout',
+                     [((), app.db.wait)])
+    pool = app.db.get_stats()
+    render_simple(out, 'db_pool_conns', 'gauge', 'Db conns by state',
+                  [((('state', 'in_use'),), pool['in_use']),
+                   ((('state', 'idle'),), pool['idle']),
+                   ((('state', 'open'),), pool['open']),
+                   ((('state', 'max'),), pool['maxconn'])])
+    for k in ('checkouts', 'timeouts', 'errors', 'recycled'):
+        render_simple(out, f'db_pool_{k}_total', 'counter', f'Db pool {k}', [((), pool[k])])
+
+    render_histogram(out, 'discord_api_request_duration_seconds',
+                     'Discord api latency by endpoint, incl. retries',
+                     [((('path', path),), hist) for path, hist in sorted(discord_api.latency.items())])
+    render_simple(out, 'discord_api_events_total', 'counter', 'Discord api retries & errors',
+                  [((('event', k),), v) for k, v in discord_api.counters.items()])
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,119 @@
+# native
+import argparse
+import os
+import re
+# extra
+from psycopg2 import errors
+# custom
+import db
+
+
+# advisory lock id, any constant as long as it's the same in every proc
+LOCK_KEY = 0x5c4e3a
+# migrations/NNNN_name.sql, applied in NNNN order
+DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+'''
+Versioned schema migrations: every migrations/NNNN_name.sql newer than
+the db's schema_version gets applied in order, in 1 txn together w/ the
+version rows, so a migration that fails leaves the db as it was.
+
+Any nr of workers can boot at once. When the db is up to date it's a
+single read of schema_version, otherwise they queue on an advisory lock
+and re-check the version under it, so each migration runs exactly once.
+
+Never edit a migration that's already been applied, add a new one.
+
+    python3 discord_games/migrate.py            applies the pending ones
+    python3 discord_games/migrate.py --status   lists applied & pending
+'''
+def init_app(app):
+    for version, name in migrate(app):
+        app.logger.info(f'schema migrated to {version} ({name})')
+
+
+# return: [(version, name, path)] of every migration file, in order
+def load():
+    found = []
+    for f in os.listdir(DIR):
+        m = FILENAME.match(f)
+        if m:
+            found.append((int(m[1]), m[2], os.path.join(DIR, f)))
+    return sorted(found)
+
+
+# return: latest version applied, 0 for a db that's never been migrated
+def current_version():
+    try:
+        with db.cursor() as cur:
+            cur.execute("select coalesce(max(version), 0) from schema_version;")
+            return cur.fetchone()[0]
+    except errors.UndefinedTable:
+        # the failed select aborted the txn
+        db.get_conn().rollback()
+        return 0
+
+
+# return: [(version, name)] applied by this call
+def migrate(app):
+    found = load()
+    latest = found[-1][0] if found else 0
+    with app.app_context():
+        if current_version() >= latest:
+            return []
+        applied = []
+        with db.cursor() as cur:
+            # waits for any other proc mid migration, released on commit
+            cur.execute("select pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+            cur.execute("set local statement_timeout = 0;")
+            cur.execute("""
+                create table if not exists schema_version (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT now()
+                );
+            """)
+            # someone else may have migrated while this one waited
+            cur.execute("select coalesce(max(version), 0) from schema_version;")
+            current = cur.fetchone()[0]
+            for version, name, path in found:
+                if version <= current:
+                    continue
+                with open(path) as f:
+                    cur.execute(f.read())
+                cur.execute("""
+                    insert into schema_version (version, name)
+                    values (%s, %s);
+                """, (version, name))
+                applied.append((version, name))
+    # committed here
+    return applied
+
+
+if __name__ == '__main__':
+    from flask import Flask
+
+    parser = argparse.ArgumentParser(description='apply pending schema migrations')
+    parser.add_argument('--status', action='store_true', help='only list applied & pending')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object('config')
+    db.init_app(app)
+    try:
+        if args.status:
+            with app.app_context():
+                current = current_version()
+            for version, name, _ in load():
+                print(f"{version:04d} {name:<24} {'applied' if version <= current else 'pending'}")
+        else:
+            applied = migrate(app)
+            for version, name in applied:
+                print(f'applied {version:04d} {name}')
+            if not applied:
+                print('up to date')
+    finally:
+        with app.app_context():
+            db.close_all()
@@ -0,0 +1,100 @@
+-- schema as the server used to (re)create it on every boot
+-- IF NOT EXISTS so dbs made before migrations get adopted as is
+
+-- id: discord id
+-- access_t: access token from discord to request info about player
+-- refresh_t: use to get a new access_t after expiry
+-- expires_at: access_t expiry time [secs since unix epoch UTC]
+CREATE TABLE IF NOT EXISTS tokens (
+    id BIGINT PRIMARY KEY,
+    access_t TEXT UNIQUE NOT NULL,
+    refresh_t TEXT UNIQUE NOT NULL,
+    expires_at BIGINT NOT NULL
+);
+
+-- id: discord id
+-- username: discord username
+CREATE TABLE IF NOT EXISTS players (
+    id BIGINT PRIMARY KEY,
+    username TEXT NOT NULL
+);
+
+-- id: game name ('simon', 'minesweeper', ...)
+-- max_score: max possible score per game
+-- rank_order: 'asc' or 'desc'
+CREATE TABLE IF NOT EXISTS games (
+    id TEXT PRIMARY KEY,
+    max_score INT NOT NULL,
+    rank_order TEXT NOT NULL
+);
+
+-- hscore: all-time highscore (IS NULL TO BE INIT'D)
+CREATE TABLE IF NOT EXISTS highscores (
+    player_id BIGINT REFERENCES players(id) ON DELETE CASCADE,
+    game_id TEXT REFERENCES games(id) ON DELETE CASCADE,
+    hscore INT,
+    PRIMARY KEY (player_id, game_id)
+);
+
+-- score: daily score that resets every 24h
+-- the daily reset swaps in a fresh copy of this table (see reset_job.py),
+-- so anything added here has to survive CREATE TABLE ... (LIKE scores INCLUDING ALL)
+CREATE TABLE IF NOT EXISTS scores (
+    player_id BIGINT REFERENCES players(id) ON DELETE CASCADE,
+    game_id TEXT REFERENCES games(id) ON DELETE CASCADE,
+    score INT DEFAULT 0,
+    PRIMARY KEY (player_id, game_id)
+);
+
+-- to track when the rankings should be announced
+-- time: TIMESTAMP in UTC for standarization
+CREATE TABLE IF NOT EXISTS reset_time (
+    id INT PRIMARY KEY DEFAULT 1,
+    time TIMESTAMPTZ,
+    streak INT DEFAULT 0
+);
+
+-- 1 row per daily reset (see reset_job.py)
+-- ends_at: reset time the period ended at, at most 1 reset each
+-- streak, max_scores: as announced for the period
+CREATE TABLE IF NOT EXISTS reset_log (
+    period SERIAL PRIMARY KEY,
+    ends_at TIMESTAMPTZ UNIQUE NOT NULL,
+    streak INT NOT NULL,
+    max_scores JSONB NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+-- archived daily rankings, kept across resets
+CREATE TABLE IF NOT EXISTS daily_results (
+    period INT REFERENCES reset_log(period) ON DELETE CASCADE,
+    game_id TEXT NOT NULL,
+    player_id BIGINT NOT NULL,
+    score INT,
+    rank INT NOT NULL,
+    PRIMARY KEY (period, game_id, player_id)
+);
+
+-- every player's daily score, forever (see reset_job.py)
+-- monthly partitions, created by the reset job as needed
+-- day: UTC date the period started on
+-- pkey serves a player's history & streaks
+CREATE TABLE IF NOT EXISTS score_history (
+    day DATE NOT NULL,
+    period INT NOT NULL,
+    player_id BIGINT NOT NULL,
+    game_id TEXT NOT NULL,
+    score INT,
+    rank INT NOT NULL,
+    PRIMARY KEY (player_id, game_id, day)
+) PARTITION BY RANGE (day);
+
+-- per game per day aggregates, so averages never scan score_history
+CREATE TABLE IF NOT EXISTS daily_stats (
+    game_id TEXT NOT NULL,
+    day DATE NOT NULL,
+    period INT NOT NULL,
+    nplayers INT NOT NULL,
+    average FLOAT,
+    PRIMARY KEY (game_id, day)
+);
@@ -0,0 +1,10 @@
+-- the snapshot the bot polls reads 1 period in (game_id, rank, player_id)
+-- order (see reset_job.load_snapshot), this returns it w/o a sort
+CREATE INDEX IF NOT EXISTS daily_results_period_rank_idx
+    ON daily_results (period, game_id, rank, player_id);
+
+-- the pkey leads w/ player_id, so deleting a game (ON DELETE CASCADE)
+-- would scan all of highscores w/o this
+CREATE INDEX IF NOT EXISTS highscores_game_id_idx
+    ON highscores (game_id);
+
@@ -0,0 +1,6 @@
+-- auth tokens revoked before they expire (see auth_token.py), rows are
+-- dropped once expires_at is past so this stays small
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    jti TEXT PRIMARY KEY,
+    expires_at BIGINT NOT NULL
+);
@@ -0,0 +1,171 @@
+# native
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+
+'''
+Opt-in per request profiler, for finding where a slow request spends its
+time in production (e.g. flood_reveal, save_reveal, the rankings loop).
+
+A request gets profiled if it comes w/ the admin token, as the
+'X-Profile: <token>' header or ?profile=<token>, or at random w/
+PROFILER['sample_rate']. The whole wsgi call runs under sys.setprofile on
+its own thread (other requests are untouched), which adds up the self
+time of every call stack. Python calls & C calls both count.
+
+The result is saved in collapsed-stack format (`a;b;c <usecs>` per line,
+what flamegraph.pl & speedscope read) to a ring buffer of at most
+max_profiles files in PROFILER['dir'], shared by all worker procs, and
+read back thru /api/profiles w/ the same token.
+
+W/o a token & w/ sample_rate 0 nothing gets installed, so it costs
+nothing. Otherwise an unprofiled request costs a couple of dict lookups.
+'''
+def init_app(app):
+    cfg = app.config['PROFILER']
+    if not cfg['token'] and not cfg['sample_rate']:
+        app.profiles = None
+        return
+    app.profiles = ProfileStore(cfg['dir'], cfg['max_profiles'], cfg['max_stacks'])
+    app.wsgi_app = Middleware(app.wsgi_app, app.profiles, cfg['token'], cfg['sample_rate'])
+
+
+# header or ?profile= matches token, in constant time
+def has_token(environ, token):
+    if not token:
+        return False
+    given = environ.get('HTTP_X_PROFILE')
+    if given is None and 'profile=' in environ.get('QUERY_STRING', ''):
+        given = parse_qs(environ['QUERY_STRING']).get('profile', [''])[0]
+    return given is not None and hmac.compare_digest(given.encode(), token.encode())
+
+
+class Middleware:
+    def __init__(self, wsgi_app, store, token=None, sample_rate=0):
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if (not has_token(environ, self.token)
+                and not (self.sample_rate and random.random() < self.sample_rate)):
+            return self.wsgi_app(environ, start_response)
+        # not the reads of the profiles themselves
+        if path.startswith('/api/profiles'):
+            return self.wsgi_app(environ, start_response)
+        prof = StackProfiler()
+        start = time.perf_counter()
+        prof.start()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            prof.stop()
+            self.store.save(prof.stacks, environ['REQUEST_METHOD'], path,
+                            time.perf_counter() - start)
+
+
+def frame_name(code, module):
+    return f'{module}.{code.co_qualname}'
+
+
+'''
+Self time per call stack of the thread that calls start(). Stacks are
+tuples of frame names from the outermost call down, only the calls made
+after start() (so the middleware's own frames aren't in them).
+'''
+class StackProfiler:
+    def __init__(self):
+        # stack -> secs spent in its innermost call itself
+        self.stacks = Counter()
+        self._names = []
+        self._started = []
+        # secs spent in the children of each open call
+        self._children = []
+
+    def start(self):
+        sys.setprofile(self._event)
+
+    def stop(self):
+        sys.setprofile(None)
+
+    def _event(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == 'call':
+            self._push(frame_name(frame.f_code, frame.f_globals.get('__name__')), now)
+        elif event == 'c_call':
+            self._push(f"{getattr(arg, '__module__', None) or 'builtins'}."
+                       f"{getattr(arg, '__qualname__', arg.__name__)}", now)
+        # returns of calls made before start() have nothing to pop
+        elif self._names:
+            total = now - self._started.pop()
+            self.stacks[tuple(self._names)] += total - self._children.pop()
+            self._names.pop()
+            if self._children:
+                self._children[-1] += total
+
+    def _push(self, name, now):
+        self._names.append(name)
+        self._started.append(now)
+        self._children.append(0.0)
+
+
+'''
+At most max_profiles files in path, the oldest deleted 1st. Names sort by
+time: <ms since epoch>-<pid>_<METHOD>_<path>_<ms taken>.folded
+'''
+class ProfileStore:
+    NAME = re.compile(r'^\d{13}-\d+_[\w.-]+\.folded$')
+
+    def __init__(self, path='profiles', max_profiles=100, max_stacks=2000):
+        self.path = path
+        self.max_profiles = max_profiles
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    # stacks: {stack tuple: secs}, only the max_stacks heaviest are kept
+    def save(self, stacks, method, path, secs):
+        slug = re.sub(r'[^\w.-]+', '-', path).strip('-')[:60] or 'root'
+        name = (f'{int(time.time() * 1000):013d}-{os.getpid()}'
+                f'_{method}_{slug}_{secs * 1000:.0f}ms.folded')
+        lines = [f'{";".join(stack)} {round(s * 1e6)}'
+                 for stack, s in stacks.most_common(self.max_stacks)]
+        tmp = os.path.join(self.path, f'.{name}.tmp')
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        # readers never see a half written profile
+        os.replace(tmp, os.path.join(self.path, name))
+        with self._lock:
+            self.evict()
+
+    def evict(self):
+        names = self.list()
+        for name in names[self.max_profiles:]:
+            try:
+                os.remove(os.path.join(self.path, name))
+            # another proc got to it 1st
+            except FileNotFoundError:
+                pass
+
+    # return: profile names, newest 1st
+    def list(self):
+        return sorted((n for n in os.listdir(self.path) if self.NAME.match(n)), reverse=True)
+
+    # return: collapsed stacks of name, None if it's not (or no longer) there
+    def read(self, name):
+        if not self.NAME.match(name):
+            return
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return
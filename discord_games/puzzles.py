@@ -0,0 +1,65 @@
+'''
+Daily puzzles: everyone in the guild gets the same minesweeper board,
+simon sequence and num_guess answer for the day, so the daily rankings
+compare the same game.
+
+Each (game_id, day, guild) gets a seed (keyed w/ PUZZLE_SECRET so players
+can't work out the layout from the date), and a game's layout is built
+from its seed by the builder the game registers:
+
+    @puzzles.builder(gid)
+    def build_layout(seed):
+        ...
+
+    st['seed'] = puzzles.seed(gid)
+    layout = puzzles.layout(gid, st['seed'])
+
+Player state only keeps the seed. Layouts are built once per process and
+cached, and can always be rebuilt from the seed. Builders should return
+something immutable since the cached layout is shared by every player.
+'''
+# native
+import hashlib
+import hmac
+from datetime import datetime, timezone
+from functools import lru_cache
+# custom
+import config
+import db_utils
+
+
+# game_id -> fn(seed) -> layout
+builders = {}
+
+
+def builder(game_id):
+    def register(f):
+        builders[game_id] = f
+        return f
+    return register
+
+
+'''
+The ranking day == until the next daily reset, since that's when scores
+(and played) get reset. UTC date before the 1st reset time is set.
+'''
+def day():
+    reset_t = db_utils.get_reset_time()
+    if reset_t is None:
+        return datetime.now(timezone.utc).date().isoformat()
+    return reset_t.isoformat()
+
+
+# return: 64-bit seed of today's puzzle for game_id
+def seed(game_id, day_=None, guild=None):
+    day_ = day() if day_ is None else day_
+    guild = config.GUILD_ID if guild is None else guild
+    msg = f'{game_id}:{day_}:{guild}'.encode()
+    digest = hmac.new(config.PUZZLE_SECRET.encode(), msg, hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+# a few days' worth of layouts per game
+@lru_cache(maxsize=64)
+def layout(game_id, seed):
+    return builders[game_id](seed)
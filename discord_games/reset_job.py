@@ -0,0 +1,228 @@
+# native
+import threading
+import time
+from datetime import timedelta, timezone
+# extra
+from flask import current_app
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, Json
+# custom
+import db
+
+
+# advisory lock id, any constant as long as it's the same in every proc
+LOCK_KEY = 0x5e5e7
+
+
+'''
+Daily reset, decoupled from /api/rankings (which only reads the result).
+Once reset_time has passed, 1 txn:
+    1. archives the period's rankings into daily_results w/ 1 INSERT ... SELECT
+    2. copies them into score_history (partitioned by month) for good, and
+       the per game averages into daily_stats
+    3. swaps in a fresh scores table (create + rename, no row-by-row delete)
+    4. moves reset_time on by 24h & bumps the streak
+It runs under a txn-level advisory lock and reset_log has 1 row per
+period (unique on the reset time it ends at), so any nr of procs can run
+it at once, or retry it, and a period still only gets archived once.
+
+The server runs it every RESET['check_every'] secs on a background thread.
+Outside a request: with app.app_context(): reset_job.run_reset()
+'''
+def init_app(app):
+    cfg = app.config['RESET']
+    app.rankings_cache = SnapshotCache(cfg['snapshot_ttl'])
+    if cfg['run_in_server']:
+        start_scheduler(app, cfg['check_every'])
+
+
+def start_scheduler(app, every):
+    def loop():
+        while True:
+            try:
+                with app.app_context():
+                    period = run_reset()
+                if period is not None:
+                    app.logger.info(f'daily reset: archived period {period}')
+            except Exception:
+                app.logger.exception('daily reset failed')
+            time.sleep(every)
+    threading.Thread(target=loop, name='reset-job', daemon=True).start()
+
+
+# return: period archived, None if nothing to do
+def run_reset():
+    # this proc's buffered scores belong to the period being archived
+    buf = getattr(current_app, 'score_buffer', None)
+    if buf is not None:
+        buf.flush()
+    with db.cursor(RealDictCursor) as cur:
+        # waits for any other proc mid reset, released on commit
+        cur.execute("select pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+        # not a request, can take longer than DB_POOL's statement_timeout
+        cur.execute("set local statement_timeout = 0;")
+        cur.execute("""
+            select time, streak, time <= now() as due
+            from reset_time;
+        """)
+        row = cur.fetchone()
+        # reset time only exists once someone got to /home
+        if row is None or not row['due']:
+            return
+
+        # not a single soul played this period,
+        # so delete reset time to be init'd later (& the streak w/ it)
+        cur.execute("select exists (select 1 from scores) as played;")
+        if not cur.fetchone()['played']:
+            cur.execute("truncate table reset_time;")
+            return
+
+        cur.execute("""
+            insert into reset_log (ends_at, streak, max_scores)
+            values (%s, %s, %s)
+            on conflict (ends_at) do nothing
+            returning period;
+        """, (row['time'], row['streak'] + 1, Json(current_app.games.max_scores())))
+        logged = cur.fetchone()
+        # already archived
+        if logged is None:
+            return
+        period = logged['period']
+
+        cur.execute("""
+            insert into daily_results (period, game_id, player_id, score, rank)
+            select
+                %s,
+                game_id,
+                player_id,
+                score,
+                dense_rank() over (
+                    partition by game_id
+                    order by
+                        case
+                            when rank_order = 'asc' then score
+                            else -score
+                        end
+                )
+            from scores join games g
+            on game_id = g.id;
+        """, (period,))
+
+        # day the period started on
+        day = (row['time'] - timedelta(days=1)).astimezone(timezone.utc).date()
+        ensure_partition(cur, day)
+        cur.execute("""
+            insert into score_history (day, period, player_id, game_id, score, rank)
+            select %(day)s, period, player_id, game_id, score, rank
+            from daily_results
+            where period = %(period)s
+            on conflict do nothing;
+
+            insert into daily_stats (game_id, day, period, nplayers, average)
+            select game_id, %(day)s, period, count(*), avg(score)
+            from daily_results
+            where period = %(period)s
+            group by game_id, period
+            on conflict do nothing;
+        """, {'day': day, 'period': period})
+
+        # fresh scores table, same columns/defaults/pkey via LIKE but
+        # LIKE doesn't copy foreign keys
+        cur.execute("""
+            create table scores_next (like scores including all);
+            alter table scores_next
+                add constraint scores_player_id_fkey foreign key (player_id)
+                    references players(id) on delete cascade,
+                add constraint scores_game_id_fkey foreign key (game_id)
+                    references games(id) on delete cascade;
+            drop table scores;
+            alter table scores_next rename to scores;
+            alter index scores_next_pkey rename to scores_pkey;
+        """)
+
+        cur.execute("""
+            update reset_time
+            set time = now() + interval '24 hours',
+                streak = streak + 1;
+        """)
+
+    # the live boards & cached snapshot go w/ the old scores once committed
+    app = current_app._get_current_object()
+    db.after_commit(app.leaderboards.clear)
+    db.after_commit(app.rankings_cache.invalidate)
+    return period
+
+
+# monthly partition of score_history that day goes in
+def ensure_partition(cur, day):
+    lo = day.replace(day=1)
+    hi = (lo + timedelta(days=32)).replace(day=1)
+    cur.execute(sql.SQL("""
+        create table if not exists {} partition of score_history
+        for values from (%s) to (%s);
+    """).format(sql.Identifier(f'score_history_{lo:%Y_%m}')), (lo, hi))
+
+
+'''
+Latest archived rankings for the bot, in the old /api/rankings format
+plus the period: {period, rankings, max_scores, streak}.
+Only checks reset_log for a newer period every ttl secs, and only reads
+daily_results when there is one, so polls never touch the live tables.
+'''
+class SnapshotCache:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.snapshot = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self.checked_at = None
+
+    # return: snapshot or None if nothing's been archived yet
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.checked_at is None or now - self.checked_at >= self.ttl:
+                self.snapshot = load_snapshot(self.snapshot)
+                self.checked_at = now
+            return self.snapshot
+
+
+# cached: current snapshot, returned as is if it's still the latest
+def load_snapshot(cached=None):
+    with db.cursor(RealDictCursor) as cur:
+        cur.execute("""
+            select period, streak, max_scores from reset_log
+            order by period desc
+            limit 1;
+        """)
+        latest = cur.fetchone()
+        if latest is None:
+            return
+        if cached is not None and cached['period'] == latest['period']:
+            return cached
+
+        cur.execute("""
+            select game_id, player_id, score, rank from daily_results
+            where period = %s
+            order by game_id, rank, player_id;
+        """, (latest['period'],))
+        rows = cur.fetchall()
+    return {'period': latest['period'],
+            'rankings': group_rankings(rows),
+            'max_scores': latest['max_scores'],
+            'streak': latest['streak']}
+
+
+# the /api/rankings format: [{game, players: [{id, score, rank}]}]
+# rows: [{game_id, player_id, score, rank}, ...]
+def group_rankings(rows):
+    games = {}
+    for r in rows:
+        games.setdefault(r['game_id'], []).append({
+            'id': r['player_id'],
+            'score': r['score'],
+            'rank': r['rank'],
+        })
+    return [{'game': gid, 'players': plist} for gid, plist in games.items()]
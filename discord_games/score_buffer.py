@@ -0,0 +1,324 @@
+# native
+import atexit
+import operator
+import os
+import re
+import threading
+# extra
+from psycopg2.extras import execute_values
+# custom
+import db
+
+
+'''
+Write-behind buffer for the end of game score writes, so a request only
+waits on a dict update (+ a journal append) instead of a Postgres commit.
+
+Updates are coalesced per (player, game) the same way they'd land in the
+db unbuffered: the latest daily score wins (like update_score()), and the
+better hscore by the game's rank_order. They're flushed in 1 batched
+UPDATE per table every flush_every secs, or as soon as max_pending players
+are waiting. The hscore flush also takes the better of the buffered &
+stored hscore, so it can never make a highscore worse, even w/ several
+worker procs.
+
+Durability: every accepted update is appended to the proc's own journal
+first (score_journal.<pid>.log, so no 2 procs ever share one). On boot the
+journals of procs that are gone get replayed & flushed, so a crash loses
+nothing that was accepted. Replaying twice is harmless since coalescing
+is idempotent. It's also flushed at exit, and before every daily reset
+(see reset_job.py).
+'''
+def init_app(app):
+    cfg = app.config['SCORE_BUFFER']
+    app.score_buffer = None
+    if not cfg['enabled'] or reloader_parent(app):
+        return
+    journal = cfg['journal']
+    if journal:
+        if cfg['recover']:
+            for path in stale_journals(journal):
+                recover(app, app.games.rank_orders(), path)
+        journal = worker_journal(journal, os.getpid())
+    buf = ScoreBuffer(app, app.games.rank_orders(), cfg['max_pending'], journal, cfg['fsync'])
+    app.score_buffer = buf
+    # a reused pid (e.g. pid 1 in a container) finds its last run's journal
+    buf.replay()
+    buf.flush()
+    buf.start(cfg['flush_every'])
+    atexit.register(buf.close)
+
+
+# python3 server.py: the dev server's reloader parent only restarts its
+# child (run w/ WERKZEUG_RUN_MAIN set) on code changes, the child serves
+def reloader_parent(app):
+    return app.import_name == '__main__' and 'WERKZEUG_RUN_MAIN' not in os.environ
+
+
+class ScoreBuffer:
+    def __init__(self, app, rank_orders, max_pending=500, journal=None, fsync=False):
+        self.app = app
+        self.rank_orders = rank_orders
+        self.max_pending = max_pending
+        self.journal_path = journal
+        self.fsync = fsync
+        # (player_id, game_id) -> score
+        self.scores = {}
+        self.hscores = {}
+        # (scores, hscores) being written by a flush right now
+        self._flushing = ({}, {})
+        self._lock = threading.Lock()
+        # held for a whole flush, so flushes never overlap
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._journal = None
+        # journal files whose updates are buffered but not flushed yet
+        self._unflushed = []
+        if journal:
+            self._journal = open(journal, 'a')
+
+    # ------------------------------ accept ------------------------------
+    # the better of a & b for game_id
+    def best(self, game_id, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        if self.rank_orders[game_id] == 'asc':
+            return min(a, b)
+        return max(a, b)
+
+    # daily scores: the newer one, like the unbuffered UPDATE
+    def latest(self, game_id, old, new):
+        return old if new is None else new
+
+    # only ints get in (numpy ints too), anything else raises TypeError
+    # before it's journaled, so it can't break replay() or a flush batch
+    # return: the coalesced score now buffered
+    def add_score(self, player_id, game_id, score):
+        return self._add(self.scores, 's', player_id, game_id, operator.index(score))
+
+    def add_hscore(self, player_id, game_id, hscore):
+        return self._add(self.hscores, 'h', player_id, game_id, operator.index(hscore))
+
+    def _add(self, pending, kind, player_id, game_id, score, log=True):
+        k = (player_id, game_id)
+        merge = self.latest if kind == 's' else self.best
+        with self._lock:
+            if log and self._journal is not None:
+                self._journal.write(f'{kind}\t{player_id}\t{game_id}\t{score}\n')
+                self._journal.flush()
+                if self.fsync:
+                    os.fsync(self._journal.fileno())
+            pending[k] = score = merge(game_id, pending.get(k), score)
+            full = len(pending) >= self.max_pending
+        if full:
+            self._wake.set()
+        return score
+
+    # return: (score, hscore) still waiting to be flushed, None if not buffered
+    def pending(self, player_id, game_id):
+        k = (player_id, game_id)
+        with self._lock:
+            return (self.latest(game_id, self._flushing[0].get(k), self.scores.get(k)),
+                    self.best(game_id, self._flushing[1].get(k), self.hscores.get(k)))
+
+    # return: ({(player_id, game_id): score}, {...: hscore}) of everything
+    #         not in the db yet
+    def snapshot(self):
+        with self._lock:
+            scores, hscores = dict(self._flushing[0]), dict(self._flushing[1])
+            for k, v in self.scores.items():
+                scores[k] = v
+            for k, v in self.hscores.items():
+                hscores[k] = self.best(k[1], hscores.get(k), v)
+        return scores, hscores
+
+    # ------------------------------ flush -------------------------------
+    def start(self, every):
+        def loop():
+            while not self._stop.is_set():
+                self._wake.wait(every)
+                self._wake.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('score buffer flush failed')
+        self._thread = threading.Thread(target=loop, name='score-buffer', daemon=True)
+        self._thread.start()
+
+    # writes everything buffered so far, on its own conn & txn
+    # on failure it's all put back (coalesced w/ anything newer) and raised
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                scores, self.scores = self.scores, {}
+                hscores, self.hscores = self.hscores, {}
+                self._flushing = (scores, hscores)
+                self._rotate_journal()
+            if not scores and not hscores:
+                self._drop_journals()
+                return
+            try:
+                with self.app.app_context():
+                    write(scores, hscores)
+            except Exception:
+                with self._lock:
+                    # anything buffered since is newer
+                    for k, v in scores.items():
+                        self.scores[k] = self.latest(k[1], v, self.scores.get(k))
+                    for k, v in hscores.items():
+                        self.hscores[k] = self.best(k[1], self.hscores.get(k), v)
+                    self._flushing = ({}, {})
+                raise
+            with self._lock:
+                self._flushing = ({}, {})
+            self._drop_journals()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        try:
+            self.flush()
+        finally:
+            journal, self._journal = self._journal, None
+            if journal is not None:
+                journal.close()
+        # everything's in the db, so nothing's left to recover
+        if journal is not None:
+            os.remove(self.journal_path)
+
+    # ------------------------------ journal -----------------------------
+    # what's being flushed moves to <journal>.<n>, newer updates go to a
+    # fresh journal
+    def _rotate_journal(self):
+        if self._journal is None:
+            return
+        self._journal.close()
+        n = 0
+        while os.path.exists(f'{self.journal_path}.{n}'):
+            n += 1
+        flushing = f'{self.journal_path}.{n}'
+        os.replace(self.journal_path, flushing)
+        self._unflushed.append(flushing)
+        self._journal = open(self.journal_path, 'a')
+
+    # everything in them is in the db now
+    def _drop_journals(self):
+        for path in self._unflushed:
+            os.remove(path)
+        self._unflushed = []
+
+    # buffers every journal left behind by a crash (or a failed flush)
+    # oldest 1st, so the latest daily score wins: <journal>.0, .1, ... and
+    # <journal> itself last
+    def replay(self):
+        if not self.journal_path:
+            return
+        d = os.path.dirname(os.path.abspath(self.journal_path))
+        base = os.path.basename(self.journal_path)
+        names = [n for n in os.listdir(d)
+                 if n == base or re.fullmatch(re.escape(base) + r'\.\d+', n)]
+        names.sort(key=lambda n: (n == base, int(n[len(base)+1:] or 0)))
+        for name in names:
+            path = os.path.join(d, name)
+            # the live journal gets moved aside by the next flush anyway
+            if name != base:
+                self._unflushed.append(path)
+            with open(path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    # torn last line
+                    if len(parts) != 4:
+                        continue
+                    kind, pid, gid, score = parts
+                    if kind not in ('s', 'h') or gid not in self.rank_orders:
+                        continue
+                    # skipped like a torn line, e.g. 'None' from an old build
+                    try:
+                        pid, score = int(pid), int(score)
+                    except ValueError:
+                        continue
+                    pending = self.scores if kind == 's' else self.hscores
+                    self._add(pending, kind, pid, gid, score, log=False)
+
+
+# ------------------------------ workers -------------------------------
+# each proc gets its own journal, e.g. /abs/path/score_journal.<pid>.log,
+# absolute so a chdir after boot can't split it
+def worker_journal(base, worker_id):
+    root, ext = os.path.splitext(os.path.abspath(base))
+    return f'{root}.{worker_id}{ext}'
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # someone else's proc
+    except PermissionError:
+        pass
+    return True
+
+
+# return: journals under base whose proc is gone (or that have no pid),
+#         the ones a live proc is still writing are left alone
+def stale_journals(base):
+    root, ext = os.path.splitext(os.path.abspath(base))
+    stale = []
+    for path in find_journals(os.path.abspath(base)):
+        pid = path[len(root)+1:len(path)-len(ext)]
+        if pid.isdigit() and pid_alive(int(pid)):
+            continue
+        stale.append(path)
+    return stale
+
+
+# return: journals (incl. every worker's) that base or its rotations are
+#         left under, e.g. by procs that crashed
+def find_journals(base):
+    d = os.path.dirname(base)
+    root, ext = os.path.splitext(os.path.basename(base))
+    name = re.compile(re.escape(root) + r'(\.\d+)?' + re.escape(ext) + r'(\.\d+)?')
+    found = set()
+    for f in os.listdir(d or '.'):
+        m = name.fullmatch(f)
+        if m:
+            found.add(os.path.join(d, f'{root}{m[1] or ""}{ext}'))
+    return sorted(found)
+
+
+# flushes & deletes what a proc that's gone left in its journal
+# never on a live proc's journal, its own flushes would race this one's
+def recover(app, rank_orders, journal):
+    buf = ScoreBuffer(app, rank_orders, journal=journal)
+    buf.replay()
+    buf.close()
+
+
+# 1 batched statement per table, rows that don't exist anymore (e.g. scores
+# after a reset) are skipped like update_score() would
+def write(scores, hscores):
+    with db.cursor() as cur:
+        if scores:
+            # last write wins, same as update_score()
+            execute_values(cur, """
+                update scores as s
+                set score = v.score
+                from (values %s) as v(player_id, game_id, score)
+                where s.player_id = v.player_id and s.game_id = v.game_id;
+            """, [(pid, gid, score) for (pid, gid), score in scores.items()])
+        if hscores:
+            execute_values(cur, """
+                update highscores as h
+                set hscore = case
+                    when h.hscore is null then v.hscore
+                    when g.rank_order = 'asc' then least(h.hscore, v.hscore)
+                    else greatest(h.hscore, v.hscore)
+                end
+                from (values %s) as v(player_id, game_id, hscore), games g
+                where h.player_id = v.player_id and h.game_id = v.game_id
+                  and g.id = v.game_id;
+            """, [(pid, gid, hscore) for (pid, gid), hscore in hscores.items()])
@@ -1,16 +1,24 @@
 # native
 import time
-from datetime import datetime, timezone, timedelta
-import requests
 from urllib.parse import quote
 from functools import wraps
 # extra
 from flask import Flask, session, request, render_template, redirect, url_for, jsonify
-from flask_session import Session
-from psycopg2.extras import RealDictCursor
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 # custom
+import auth_token
 import db
 import db_utils
+import discord_api
+import game_registry
+import game_state
+import leaderboard
+import metrics
+import migrate
+import profiler
+import reset_job
+import score_buffer
+import token_cache
 from games.simon import simon_bp
 from games.minesweeper import mines_bp
 from games.num_guess import guess_bp
@@ -20,94 +28,39 @@ from games.num_guess import guess_bp
 app = Flask(__name__)
 app.config.from_object('config')
 # used to sign cookies
+# the (cookie) session only holds who the player is, game state lives in game_state
 app.secret_key = app.config['SECRET_KEY']
-# opts: filesystem, redis, memcached, mongodb, sqlalchemy
-app.config['SESSION_TYPE'] = 'filesystem'
 # remember to incl url prefix in the JS fetches
 app.register_blueprint(simon_bp)
 app.register_blueprint(mines_bp)
 app.register_blueprint(guess_bp)
-# cached data per user session
-Session(app)
+# per player per game state, server-side
+game_state.init_app(app)
 
 
 #============================== INIT ===================================
 # init a pool of conns instead of constantly creating and closing new conns
 db.init_app(app)
-# b/c db code only works inside url methods
-with app.app_context():
-    try:
-        conn = db.get_conn()
-        # DictCursor is faster that RealDictCursor but doesnt return a python dict
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                drop table if exists tokens;
-                drop table if exists highscores;
-                drop table if exists scores;
-                drop table if exists players;
-                drop table if exists games;
-                drop table if exists reset_time;
-            """)
-            # id: discord id
-            # access_t: access token from discord to request info about player
-            # refresh_t: use to get a new access_t after expiry
-            # expires_at: access_t expiry time [secs since unix epoch UTC]
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS tokens (
-                    id BIGINT PRIMARY KEY,
-                    access_t TEXT UNIQUE NOT NULL,
-                    refresh_t TEXT UNIQUE NOT NULL,
-                    expires_at BIGINT NOT NULL
-                );
-            """)
-            # id: discord id
-            # username: discord username
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS players (
-                    id BIGINT PRIMARY KEY,
-                    username TEXT NOT NULL
-                );
-            """)
-            # id: game name ('simon', 'minesweeper', ...)
-            # max_score: max possible score per game
-            # rank_order: 'asc' or 'desc'
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS games (
-                    id TEXT PRIMARY KEY,
-                    max_score INT NOT NULL,
-                    rank_order TEXT NOT NULL
-                 );
-            """)
-            # hscore: all-time highscore (IS NULL TO BE INIT'D)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS highscores (
-                    player_id BIGINT REFERENCES players(id) ON DELETE CASCADE,
-                    game_id TEXT REFERENCES games(id) ON DELETE CASCADE,
-                    hscore INT,
-                    PRIMARY KEY (player_id, game_id)
-                 );
-            """)
-            # score: daily score that resets every 24h
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS scores (
-                    player_id BIGINT REFERENCES players(id) ON DELETE CASCADE,
-                    game_id TEXT REFERENCES games(id) ON DELETE CASCADE,
-                    score INT DEFAULT 0,
-                    PRIMARY KEY (player_id, game_id)
-                 );
-            """)
-            # to track when the rankings should be announced
-            # time: TIMESTAMP in UTC for standarization
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS reset_time (
-                    id INT PRIMARY KEY DEFAULT 1,
-                    time TIMESTAMPTZ,
-                    streak INT DEFAULT 0
-                );
-            """)
-        conn.commit()
-    finally:
-        db.close_conn()
+# creates/upgrades the schema, a single version check once it's up to date
+# never drops anything, see migrate.py & migrations/
+migrate.init_app(app)
+# game metadata, synced to the games table once here, see game_registry.py
+game_registry.init_app(app)
+# daily leaderboards, warm started from the scores table
+leaderboard.init_app(app)
+# end of game score writes don't wait on the db, see score_buffer.py
+score_buffer.init_app(app)
+# archives & resets the daily scores in the background, see reset_job.py
+reset_job.init_app(app)
+# discord access tokens, see token_cache.py
+token_cache.init_app(app)
+# signed-token sessions if AUTH['mode'] is 'token', see auth_token.py
+auth_token.init_app(app)
+# last, so it wraps whichever session interface the app ended up w/
+# route latency, db & session timings at /metrics, see metrics.py
+metrics.init_app(app)
+# opt-in per request profiles, nothing installed unless configured, see profiler.py
+profiler.init_app(app)
 
 
 #================================= LOGIN/AUTH ====================================
@@ -155,20 +108,21 @@ def auth():
         return "You look lost, friend", 400
 
     # gets an access token to get user deets
-    r = exchange_code(code)
+    r = discord_api.exchange_code(code)
     access_t = r['access_token']
     # access tokens expire so refresh tokens are used to get a new one
     refresh_t = r['refresh_token']
     # expires_in is given in secs so add now in secs
     expires_at = r['expires_in'] + int(time.time())
 
-    r = get_user_deets(access_t)
-    session['id'] = r['id']
+    r = discord_api.get_user_deets(access_t)
+    # discord sends ids as strings, the db (& so the leaderboards) has ints
+    player_id = int(r['id'])
+    session['id'] = player_id
     session['username'] = r['username']
-    store_tokens(r['id'], access_t, refresh_t, expires_at)
+    token_cache.store(player_id, access_t, refresh_t, expires_at)
 
-    conn = db.get_conn()
-    with conn.cursor() as cur:
+    with db.cursor() as cur:
         # store deets
         # prevents SQL injection this way
         cur.execute("""
@@ -176,112 +130,43 @@ def auth():
             values (%s, %s)
             on conflict (id) do update
             set username = excluded.username;
-        """, (r['id'], r['username']))
-    conn.commit()
+        """, (player_id, r['username']))
 
     return redirect(url_for('home'))
 
 
-"""
-return:
-{
-    access_token: ...
-    token_type: 'Bearer'
-    expires_in: 604800  #secs (7 days)
-    refresh_token: ...
-    scope: 'identify'
-}
-"""
-def exchange_code(code):
-    # redirect_uri needs to match exactly with the one in the dev page
-    # url will get encoded since sending thru body as data
-    data = {'grant_type': 'authorization_code',
-            'code': code,
-            'redirect_uri': app.config['REDIR_URI']
-    }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    r = requests.post(f'{app.config['API_ENDPOINT']}/oauth2/token',
-                      data=data,
-                      headers=headers,
-                      auth=(app.config['CLIENT_ID'], app.config['CLIENT_SECRET'])
-    )
-    r.raise_for_status()
-    return r.json()
-
-
-# return: identical to exchange_code()
-def refresh_token(refresh_token):
-    data = {'grant_type': 'refresh_token',
-            'refresh_token': refresh_token
-    }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    r = requests.post(f'{app.config['API_ENDPOINT']}/oauth2/token',
-                      data=data,
-                      headers=headers,
-                      auth=(app.config['CLIENT_ID'], app.config['CLIENT_SECRET'])
-    )
-    r.raise_for_status()
-    return r.json()
-
-
-"""
-return:
-{
-    id: ...
-    username: ...
-    discriminator: digit that differentiations users w/ same username
-    ...
-}
-"""
-def get_user_deets(access_token):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    r = requests.get(f"{app.config['API_ENDPOINT']}/users/@me",
-                     headers=headers
-    )
-    r.raise_for_status()
-    return r.json()
+# the async server (asgi.py) does the OAuth dance itself, then hands the
+# user over to the flask session thru this short-lived signed link
+handoff = URLSafeTimedSerializer(app.secret_key, salt='auth-handoff')
 
 
-def store_tokens(id, access_t, refresh_t, expires_at):
-    conn = db.get_conn()
+@app.route('/auth/session', methods=['GET'])
+def auth_session():
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO tokens
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE
-                SET access_t = EXCLUDED.access_t,
-                    refresh_t = EXCLUDED.refresh_t,
-                    expires_at = EXCLUDED.expires_at;
-            """, (id, access_t, refresh_t, expires_at))
-        conn.commit()
-    finally:
-        db.close_conn()
+        r = handoff.loads(request.args.get('t', ''), max_age=30)
+    except BadSignature:
+        return "You look lost, friend", 400
+    session['id'] = int(r['id'])
+    session['username'] = r['username']
+    return redirect(url_for('home'))
+
+
+# revokes the token too in token mode, so a copy of it is no good either
+# POST only, so another site can't log players out w/ an <img> tag
+@app.route('/logout', methods=['POST'])
+def logout():
+    auth_token.revoke_current()
+    session.clear()
+    return "Logged out"
 
 
 # returns either the old access_t or a new one if expired by refreshing
+# cached & refreshed single-flight, see token_cache.py
 def get_access_token(id):
-    conn = db.get_conn()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                select access_t, refresh_t, expires_at from tokens
-                where id = %s;
-            """, (id,))
-            row = cur.fetchone()
-            if row is None:
-                return "Discord user not found", 400
-            # if now has passed expire time - 60s
-            if row['expires_at'] - 60 <= int(time.time()):
-                r = refresh_token(row['refresh_t'])
-                access_t = r['access_token']
-                expires_at = r['expires_in'] + int(time.time())
-                store_tokens(id, access_t, r['refresh_token'], expires_at)
-                return access_t
-            else:
-                return row['access_t']
-    finally:
-        db.close_conn()
+    access_t = app.tokens.get(id)
+    if access_t is None:
+        return "Discord user not found", 400
+    return access_t
 
 
 #================================= GAME =================================
@@ -300,148 +185,195 @@ def home():
 @app.route('/play/<game_id>', methods=['GET'])
 @login_required
 def play(game_id):
-    if game_id not in app.config['GAMES']:
+    if game_id not in app.games:
         return 'Game not found', 404
 
-    # init 2d session vars if not def
-    init_scores(game_id)
-    init_hscores(game_id)
-    init_played(game_id)
-    init_finished(game_id)
-
-    # resets played 4 today if scores db got truncated
-    if db_utils.get_score(session['id'], game_id) is None:
-        session['played'][game_id] = False
+    # init game state vars if not def
+    st = init_state(game_id)
 
     # init db or refill if truncated
-    db_utils.init_games_db(game_id)
-    db_utils.init_highscores_db(session['id'], game_id)
-    db_utils.init_scores_db(session['id'], game_id)
+    row = db_utils.enter_game(session['id'], game_id)
+    # resets played 4 today if scores db got truncated
+    if row['score'] is None:
+        st['played'] = False
     return render_template(f'{game_id}.html')
 
 
-def init_scores(game_id):
-    if 'score' not in session:
-        session['score'] = {}
-    if game_id not in session['score']:
-        session['score'][game_id] = 0
-
-
-def init_hscores(game_id):
-    if 'hscore' not in session:
-        session['hscore'] = {}
-    if game_id not in session['hscore']:
-        session['hscore'][game_id] = {}
-
-
-def init_played(game_id):
-    if 'played' not in session:
-        session['played'] = {}
-    if game_id not in session['played']:
-        session['played'][game_id] = False
-
-
-def init_finished(game_id):
-    if 'finished' not in session:
-        session['finished'] = {}
-    if game_id not in session['finished']:
-        session['finished'][game_id] = False
+def init_state(game_id):
+    st = game_state.get(game_id)
+    st.setdefault('score', 0)
+    st.setdefault('hscore', 0)
+    st.setdefault('played', False)
+    st.setdefault('finished', False)
+    return st
 
 
 # =================================== API ===================================
 # UPSERT: successive calls shouldnt do anything
 def init_reset_time():
-    conn = db.get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                insert into reset_time (id, time)
-                values (1, now() + interval '24 hours')
-                on conflict (id) do nothing;
-            """)
-            conn.commit()
-        return jsonify(None)
-    finally:
-        db.close_conn()
+    with db.cursor() as cur:
+        cur.execute("""
+            insert into reset_time (id, time)
+            values (1, now() + interval '24 hours')
+            on conflict (id) do nothing;
+        """)
+    return jsonify(None)
 
 
 # bot has a background scheduler that pings every hour for rankings
 # pinging method only accepts status 200
 @app.route('/api/rankings')
 def get_daily_rankings():
-    reset_t = db_utils.get_reset_time()
-    if reset_t is None:
-        return jsonify(error='Reset time uninitialized'), 404
-
-    # if before reset time, 204 No Content
-    if datetime.now(timezone.utc) <= reset_t:
+    # period of the last announced rankings
+    after = request.args.get('after', type=int)
+    snapshot = app.rankings_cache.get()
+    # nothing new since, 204 No Content
+    if snapshot is None or (after is not None and snapshot['period'] <= after):
         return jsonify(None), 204
-
-    # else, return rankings
-    conn = db.get_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            select
-                game_id,
-                player_id,
-                score,
-                dense_rank() over (
-                    partition by game_id
-                    order by
-                        case
-                            when rank_order = 'asc' then score
-                            else -score
-                        end
-                ) as rank
-            from scores join games g
-            on game_id = g.id;
-        """)
-        # fetchall returns [] or [...], never None
-        rows = cur.fetchall()
-        # if rows == [], not a single soul has played a game today
-        # b/c scores db gets deleted every 24h to be refilled
-        # so delete reset time to be init'd later
-        if not rows:
-            cur.execute("truncate table reset_time;")
-            conn.commit()
-            return jsonify(None), 204
-
-        # else get requested info and reset scores
-        # delete daily scores
-        cur.execute("truncate table scores;")
-
-        # update daily reset time & streak
-        cur.execute("""
-            update reset_time
-            set time = now() + interval '24 hours',
-                streak = streak + 1;
-        """)
-        conn.commit()
-
-        # structure rankings in appropriate format
-        games = {}
-        for r in rows:
-            games.setdefault(r['game_id'], []).append({
-                'id': r['player_id'],
-                'score': r['score'],
-                'rank': r['rank'],
-            })
-        rankings = [{'game': gid, 'players': plist} for gid, plist in games.items()]
-
-        # get max scores per game
-        cur.execute("select id, max_score from games;")
-        games = cur.fetchall()
-        if not games:
-            return jsonify(error='No games found'), 404
-        max_scores = {}
-        for game in games:
-            max_scores[game['id']] = game['max_score']
-
-        # by this point, streak should be init'd
-        cur.execute("select streak from reset_time;")
-        streak = cur.fetchone()['streak']
-
-        return jsonify(rankings=rankings, max_scores=max_scores, streak=streak)
+    return jsonify(snapshot)
+
+
+# live leaderboards, read-only and served from memory (see leaderboard.py)
+# board: 'daily' (today's scores) or 'alltime' (highscores)
+# top: nr of players, offset: nr of players to skip (paging)
+@app.route('/api/leaderboard/<game_id>')
+def get_leaderboard(game_id):
+    boards, board = pick_boards(game_id)
+    if boards is None:
+        return jsonify(error='Game or board not found'), 404
+    cfg = app.config['LEADERBOARD']
+    top = min(max(request.args.get('top', 10, type=int), 0), cfg['max_top'])
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    def build():
+        return jsonify(game=game_id,
+                       board=board,
+                       total=boards.size(game_id),
+                       players=boards.top(game_id, top, offset))
+    etag = f'{board}.{game_id}.{boards.version(game_id)}.{top}.{offset}'
+    return conditional(etag, build)
+
+
+# logged in player's rank and up to n players above & below
+@app.route('/api/leaderboard/<game_id>/me')
+@login_required
+def get_my_leaderboard(game_id):
+    boards, board = pick_boards(game_id)
+    if boards is None:
+        return jsonify(error='Game or board not found'), 404
+    cfg = app.config['LEADERBOARD']
+    n = min(max(request.args.get('n', 2, type=int), 0), cfg['max_around'])
+    pid = session['id']
+
+    def build():
+        return jsonify(game=game_id,
+                       board=board,
+                       id=pid,
+                       rank=boards.rank(game_id, pid),
+                       total=boards.size(game_id),
+                       players=boards.around(game_id, pid, n))
+    etag = f'{board}.{game_id}.{boards.version(game_id)}.{pid}.{n}'
+    return conditional(etag, build, private=True)
+
+
+# return: (boards, board name) or (None, None) if there's no such board
+def pick_boards(game_id):
+    board = request.args.get('board', 'daily')
+    boards = {'daily': app.leaderboards, 'alltime': app.alltime_boards}.get(board)
+    if boards is None or game_id not in boards:
+        return None, None
+    return boards, board
+
+
+'''
+Conditional GET: 304 w/o building the body if the client's ETag still
+matches. The boards' versions are in the ETag, so it changes whenever
+the board does. max_age lets clients & proxies skip even the revalidation
+for a few secs.
+build: fn() -> response
+private: per player, so shared caches must not keep it
+'''
+def conditional(etag, build, private=False):
+    if request.if_none_match.contains(etag):
+        r = app.response_class(status=304)
+    else:
+        r = build()
+    r.set_etag(etag)
+    r.cache_control.max_age = app.config['LEADERBOARD']['max_age']
+    if private:
+        r.cache_control.private = True
+    else:
+        r.cache_control.public = True
+    return r
+
+
+# logged in player's archived daily scores of a game & their streaks
+# days: how far back the history goes
+@app.route('/api/history/<game_id>/me')
+@login_required
+def get_my_history(game_id):
+    if game_id not in app.games:
+        return jsonify(error='Game not found'), 404
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    history = db_utils.get_history(session['id'], game_id, days)
+    stats = db_utils.get_player_stats(session['id'], game_id)
+    return jsonify(game=game_id,
+                   history=[{**h, 'day': h['day'].isoformat()} for h in history],
+                   **stats)
+
+
+# everyone's daily average score of a game
+@app.route('/api/history/<game_id>')
+def get_game_history(game_id):
+    if game_id not in app.games:
+        return jsonify(error='Game not found'), 404
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    averages = db_utils.get_daily_averages(game_id, days)
+    return jsonify(game=game_id,
+                   averages=[{**a, 'day': a['day'].isoformat()} for a in averages])
+
+
+# db conn pool counters (checkouts, wait time, in use, errors, ...)
+@app.route('/api/db/pool')
+def get_pool_stats():
+    return jsonify(app.db.get_stats())
+
+
+# discord api latency histograms & retry/error counters, token cache counters
+@app.route('/api/discord/stats')
+def get_discord_stats():
+    return jsonify(**discord_api.stats(), tokens=app.tokens.stats)
+
+
+# prometheus text format
+@app.route('/metrics')
+def get_metrics():
+    if app.metrics is None:
+        return "Metrics are off", 404
+    return app.response_class(metrics.render(app), mimetype='text/plain; version=0.0.4')
+
+
+# saved request profiles, newest 1st, admins only (the PROFILER token)
+@app.route('/api/profiles')
+def get_profiles():
+    if app.profiles is None:
+        return jsonify(error='Profiler is off'), 404
+    if not profiler.has_token(request.environ, app.config['PROFILER']['token']):
+        return jsonify(error='Forbidden'), 403
+    return jsonify(profiles=app.profiles.list())
+
+
+# 1 profile in collapsed-stack format, e.g. for flamegraph.pl or speedscope
+@app.route('/api/profiles/<name>')
+def get_profile(name):
+    if app.profiles is None:
+        return jsonify(error='Profiler is off'), 404
+    if not profiler.has_token(request.environ, app.config['PROFILER']['token']):
+        return jsonify(error='Forbidden'), 403
+    folded = app.profiles.read(name)
+    if folded is None:
+        return jsonify(error='Profile not found'), 404
+    return app.response_class(folded, mimetype='text/plain')
 
 
 #=============================== MAIN ================================
@@ -453,5 +385,8 @@ if __name__ == '__main__':
                 ssl_context=('cert/127.0.0.1.pem', 'cert/127.0.0.1-key.pem'),
                 debug=True)
     finally:
+        if app.score_buffer is not None:
+            app.score_buffer.close()
+        discord_api.close()
         db.close_all()
 
@@ -0,0 +1,165 @@
+# native
+import threading
+import time
+from collections import OrderedDict
+# extra
+from flask import current_app, has_request_context
+from psycopg2.extras import RealDictCursor
+# custom
+import db
+import discord_api
+
+
+'''
+In-process cache of the players' discord access tokens, keyed by discord
+id, so getting one is a dict lookup instead of a tokens query.
+
+Discord rotates the refresh token on every refresh, so 2 refreshes of the
+same token race and all but 1 fail. Refreshes are single-flight: per
+player, 1 thread refreshes while the others wait for its result, and the
+tokens row is locked FOR UPDATE while it does, so other worker procs wait
+on it too and then pick up the new token instead of refreshing again.
+
+A token counts as expired `margin` secs before its expires_at. Every
+check_every secs, a background thread refreshes the cached tokens that
+are within refresh_ahead secs of that, so requests don't wait on discord.
+
+    access_t = current_app.tokens.get(player_id)   (None if never auth'd)
+'''
+def init_app(app):
+    cfg = app.config['TOKENS']
+    app.tokens = TokenCache(app, cfg['margin'], cfg['max_entries'])
+    if cfg['check_every']:
+        app.tokens.start(cfg['check_every'], cfg['refresh_ahead'])
+
+
+# new tokens of player_id (e.g. from /auth), in the request's txn and
+# cached once that commits
+def store(player_id, access_t, refresh_t, expires_at):
+    with db.cursor() as cur:
+        write(cur, player_id, access_t, refresh_t, expires_at)
+    tokens = current_app.tokens
+    db.after_commit(lambda: tokens.put(player_id, access_t, expires_at))
+
+
+def write(cur, player_id, access_t, refresh_t, expires_at):
+    cur.execute("""
+        INSERT INTO tokens
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE
+        SET access_t = EXCLUDED.access_t,
+            refresh_t = EXCLUDED.refresh_t,
+            expires_at = EXCLUDED.expires_at;
+    """, (player_id, access_t, refresh_t, expires_at))
+
+
+class TokenCache:
+    def __init__(self, app, margin=60, max_entries=10000):
+        self.app = app
+        self.margin = margin
+        self.max_entries = max_entries
+        # player_id -> (access_t, expires_at), oldest used 1st
+        self._data = OrderedDict()
+        # player_id -> lock held by the thread refreshing it
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    # still good for more than margin (+ ahead) secs
+    def fresh(self, expires_at, ahead=0):
+        return expires_at - self.margin - ahead > time.time()
+
+    def put(self, player_id, access_t, expires_at):
+        with self._lock:
+            self._data[player_id] = (access_t, expires_at)
+            self._data.move_to_end(player_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    # return: access_t, refreshed 1st if it's (about to be) expired,
+    #         None if the player never auth'd
+    def get(self, player_id):
+        with self._lock:
+            entry = self._data.get(player_id)
+            if entry is not None and self.fresh(entry[1]):
+                self._data.move_to_end(player_id)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+        return self.refresh(player_id)
+
+    # single-flight, see above
+    # ahead: also refresh if it expires within ahead secs of the margin
+    def refresh(self, player_id, ahead=0):
+        with self._lock:
+            flight = self._flights.setdefault(player_id, threading.Lock())
+        with flight:
+            # whoever held the lock before may have just refreshed it
+            with self._lock:
+                entry = self._data.get(player_id)
+            if entry is not None and self.fresh(entry[1], ahead):
+                return entry[0]
+            try:
+                return self._load(player_id, ahead)
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._flights.pop(player_id, None)
+
+    # in a request, on the request's conn & txn: a 2nd conn from the pool
+    # would wait forever once every conn is held by a request doing this.
+    # cached once it commits (if it fails, so does the refresh token
+    # rotation & the player has to log in again)
+    # else (the refresh thread) on its own conn & txn
+    def _load(self, player_id, ahead):
+        if has_request_context():
+            row = self._read(player_id, ahead)
+            if row is not None:
+                db.after_commit(lambda: self.put(player_id, row['access_t'], row['expires_at']))
+        else:
+            with self.app.app_context():
+                row = self._read(player_id, ahead)
+            # committed here
+            if row is not None:
+                self.put(player_id, row['access_t'], row['expires_at'])
+        if row is not None:
+            return row['access_t']
+
+    # return: {access_t, expires_at} of player_id, refreshed 1st if it's
+    #         not fresh, None if the player never auth'd
+    def _read(self, player_id, ahead):
+        with db.cursor(RealDictCursor) as cur:
+            # other procs refreshing this player wait here, released on commit
+            cur.execute("""
+                select access_t, refresh_t, expires_at from tokens
+                where id = %s
+                for update;
+            """, (player_id,))
+            row = cur.fetchone()
+            if row is None:
+                return
+            if not self.fresh(row['expires_at'], ahead):
+                r = discord_api.refresh_token(row['refresh_t'])
+                row = {'access_t': r['access_token'],
+                       'expires_at': r['expires_in'] + int(time.time())}
+                write(cur, player_id, row['access_t'], r['refresh_token'], row['expires_at'])
+                with self._lock:
+                    self.stats['refreshes'] += 1
+        return row
+
+    def start(self, every, ahead):
+        def loop():
+            while True:
+                time.sleep(every)
+                with self._lock:
+                    due = [pid for pid, (_, expires_at) in self._data.items()
+                           if not self.fresh(expires_at, ahead)]
+                for pid in due:
+                    try:
+                        self.refresh(pid, ahead)
+                    except Exception:
+                        self.app.logger.exception(f'token refresh failed for {pid}')
+        threading.Thread(target=loop, name='token-refresh', daemon=True).start()
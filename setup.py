@@ -8,7 +8,17 @@ setup(
     version="0.1.0",
     packages=find_packages(),
     include_package_data=True,
+    # schema migrations, see discord_games/migrate.py
+    package_data={'discord_games': ['migrations/*.sql']},
     install_requires=requirements,
+    extras_require={
+        # async (ASGI) deployment mode, see discord_games/asgi.py
+        'async': ['Quart==0.22.0', 'hypercorn==0.18.0', 'asyncpg==0.32.0'],
+        # vectorized minesweeper big board gen, see MINESWEEPER in config.py
+        'big_board': ['numpy==2.5.4'],
+        # prefork multi-worker deployment mode, see discord_games/gunicorn.conf.py
+        'prefork': ['gunicorn==23.0.0'],
+    },
     python_requires=">=3.12",
     author="Kevin Sohn",
     description="A suite of simple games to play with ur mates in ur discord server",